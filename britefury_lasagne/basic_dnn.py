@@ -1,11 +1,13 @@
 import six
+import collections
+import threading
 import numpy as np
 from functools import partial
 import theano
 import theano.tensor as T
 import lasagne
 from batchup import data_source
-from . import trainer, dnn_objective
+from . import trainer, dnn_objective, param_store, profiling
 
 
 def _is_sequence_of_layers(xs):
@@ -34,11 +36,18 @@ def _get_network_params(layer, updates=None):
 
     return layer_params
 
+def _prediction_list(prediction):
+    if isinstance(prediction, (list, tuple)):
+        return list(prediction)
+    else:
+        return [prediction]
+
 
 class BasicDNN (object):
     def __init__(self, input_vars, target_and_mask_vars, final_layers, objectives,
                  score_objective=None,
-                 trainable_params=None, updates_fn=None, params_source=None):
+                 trainable_params=None, updates_fn=None, params_source=None, profile=False,
+                 per_sample_loss=False):
         """
         Constructor - construct a `SampleDNN` instance given variables for
         input, target and a final layer (a Lasagne layer)
@@ -59,6 +68,11 @@ class BasicDNN (object):
         :param params_source: [optional] source from which to obtain network parameters; either
             a str/unicode that contains the path of a NumPy array file from which to load the parameters,
             or a `BasicDNN` or Lasagne layer from which to copy the parameters
+        :param profile: (default=False) if `True`, compile the training, validation and prediction functions
+            with Theano profiling enabled; use `profile_report` to retrieve the results
+        :param per_sample_loss: (default=False) if `True`, the training function takes a per-sample weight
+            vector as an additional input after the targets and masks, and returns the weighted per-sample training
+            loss as an additional output; used for loss prioritised sampling (see `train_prioritised`)
         """
         self.input_vars = input_vars
         self.target_and_mask_vars = target_and_mask_vars
@@ -94,15 +108,34 @@ class BasicDNN (object):
         self.eval_results_indices = []
         self.score_objective_index = self.objectives.index(score_objective)
         predictions = []
+        prediction_inputs = []
         for obj_res in self.objective_results:
             self.train_results_indices.append(len(train_results))
             train_results.extend(obj_res.train_results)
             self.eval_results_indices.append(len(eval_results))
             eval_results.extend(obj_res.eval_results)
-            predictions.append(obj_res.prediction)
+            predictions.extend(_prediction_list(obj_res.prediction))
+            prediction_inputs.extend(obj_res.prediction_inputs)
         self.train_results_indices.append(len(train_results))
         self.eval_results_indices.append(len(eval_results))
 
+        self.per_sample_loss = per_sample_loss
+        train_inputs = input_vars + target_and_mask_vars
+        train_outputs = list(train_results)
+        if per_sample_loss:
+            # Weight the per-sample losses (e.g. by importance sampling weights) and also output them
+            self.sample_weight_var = T.vector('sample_weight')
+            sample_loss = 0
+            for obj, obj_res in zip(self.objectives, self.objective_results):
+                if obj_res.train_sample_loss is None:
+                    raise ValueError('Objective {} does not provide a per-sample loss'.format(obj.name))
+                sample_loss = sample_loss + obj_res.train_sample_loss * obj.cost_weight
+            train_cost = (sample_loss * self.sample_weight_var).mean()
+            train_inputs.append(self.sample_weight_var)
+            train_outputs.append(sample_loss)
+        else:
+            self.sample_weight_var = None
+
         # Create update expressions for training, i.e., how to modify the
         # parameters at each training step. Here, we'll use Stochastic Gradient
         # Descent (SGD) with Nesterov momentum, but Lasagne offers plenty more.
@@ -116,28 +149,84 @@ class BasicDNN (object):
 
         # Compile a function performing a training step on a mini-batch (by giving
         # the updates dictionary) and returning the corresponding training loss:
-        self._train_fn = theano.function(input_vars + target_and_mask_vars, train_results, updates=self._updates)
+        if profile:
+            self._profiles = collections.OrderedDict([(name, profiling.new_profile_stats(name))
+                                                      for name in ('train', 'val', 'predict')])
+        else:
+            self._profiles = None
+        self._train_fn = theano.function(train_inputs, train_outputs, updates=self._updates,
+                                         profile=self._profile_stats('train'))
 
         # Compile a function computing the validation loss and error:
-        self._val_fn = theano.function(input_vars + target_and_mask_vars, eval_results)
-
-        # Compile a function computing the predicted probability
-        self._predict_fn = theano.function(input_vars, predictions)
+        self._val_fn = theano.function(input_vars + target_and_mask_vars, eval_results,
+                                       profile=self._profile_stats('val'))
+
+        # Compile a function computing the predicted probability; settings such as the softmax temperature
+        # are passed as additional inputs, so predictions with different settings can run concurrently.
+        # Each thread uses its own copy of the compiled function, as function storage is not thread-safe
+        self.prediction_exprs = predictions
+        self.prediction_inputs = prediction_inputs
+        self._predict_fn_compiled = theano.function(input_vars + prediction_inputs, predictions,
+                                                    profile=self._profile_stats('predict'))
+        # Functions that compute a subset of the predictions are compiled on demand and cached, keyed by
+        # `(objective_indices, raw)`
+        self._all_outputs_key = (tuple(range(len(self.objectives))), False)
+        self._predict_fns_compiled = {self._all_outputs_key: self._predict_fn_compiled}
+        self._predict_fns_lock = threading.Lock()
+        self._predict_fn_local = threading.local()
+        self._predict_fn = self._predict_batch
 
         # Construct a training function
-        self.train = partial(trainer.train,
-                             train_batch_func=self._train_fn, train_log_msg=self._train_log,
-                             train_epoch_results_check_func=self._check_train_epoch_results,
-                             eval_batch_func=self._val_fn, eval_log_msg=self._eval_log,
-                             val_improved_func=self._score_improved,
-                             epoch_log_msg=self._epoch_log, layer_to_restore=final_layers)
+        self._train_kwargs = dict(train_log_msg=self._train_log,
+                                  train_epoch_results_check_func=self._check_train_epoch_results,
+                                  eval_batch_func=self._val_fn, eval_log_msg=self._eval_log,
+                                  val_improved_func=self._score_improved,
+                                  epoch_log_msg=self._epoch_log, layer_to_restore=final_layers)
+        if per_sample_loss:
+            train_batch_func = self._train_batch_unweighted
+        else:
+            train_batch_func = self._train_fn
+        self.train = partial(trainer.train, train_batch_func=train_batch_func, **self._train_kwargs)
+
+    def _train_batch_unweighted(self, *batch):
+        weights = np.ones((batch[0].shape[0],), dtype=theano.config.floatX)
+        return self._train_fn(*(list(batch) + [weights]))[:-1]
+
+    def train_prioritised(self, sampler, *args, **kwargs):
+        """
+        Train the network using loss prioritised sampling. The network must have been constructed with
+        `per_sample_loss=True`. After each training step the per-sample losses are passed to
+        `sampler.update_priorities`.
+
+        :param sampler: a `sampling.LossPrioritisedSampler` whose mini-batches consist of the inputs, targets and
+            masks followed by the importance sampling weights and the sample indices
+        :param args: positional arguments passed to `trainer.train` after the training set
+        :param kwargs: keyword arguments passed to `trainer.train`
+        :return: the value returned by `trainer.train`
+        """
+        if not self.per_sample_loss:
+            raise ValueError('train_prioritised requires the network to be constructed with per_sample_loss=True')
+
+        def train_batch(*batch):
+            res = self._train_fn(*batch[:-1])
+            sampler.update_priorities(batch[-1], res[-1])
+            return res[:-1]
+
+        train_kwargs = dict(self._train_kwargs)
+        train_kwargs.update(kwargs)
+        return trainer.train(sampler, train_batch_func=train_batch, *args, **train_kwargs)
 
 
     def load_params(self, params_path, include_updates=False):
         """
-        Load parameters from an NPZ file found at the specified path
+        Load parameters from an NPZ file found at the specified path, or from a named parameter
+        directory (see `save_named_params`) if `params_path` refers to one
         :param params_path: path of file from which to load parameters
         """
+        if param_store.is_named_params_path(params_path):
+            self.load_named_params(params_path, include_updates=include_updates)
+            return
+
         updates = self._updates if include_updates else None
         with np.load(params_path) as f:
             param_values = [f['arr_%d' % i] for i in range(len(f.files))]
@@ -156,6 +245,61 @@ class BasicDNN (object):
         param_values = [p.get_value() for p in params]
         np.savez(params_path, *param_values)
 
+    def get_named_params(self, include_updates=False):
+        """
+        Get all parameters in the network, keyed by layer path and parameter name
+        (see `param_store.network_param_keys`)
+        :param include_updates: if True, include parameters used for updates
+        :return: an `OrderedDict` mapping key to Theano shared variable
+        """
+        updates = self._updates if include_updates else None
+        return param_store.network_param_keys(self.final_layers, updates=updates)
+
+    def save_named_params(self, params_path, include_updates=False):
+        """
+        Save parameters to a directory containing an uncompressed `.npy` file for each parameter,
+        keyed by layer path and parameter name (see `param_store`)
+        :param params_path: path of the directory to save parameters to
+        :param include_updates: if True, include parameters used for updates
+        """
+        named_params = self.get_named_params(include_updates=include_updates)
+        param_store.save_named_params(params_path, collections.OrderedDict(
+            [(key, p.get_value()) for key, p in named_params.items()]))
+
+    def load_named_params(self, params_path, layers=None, include_updates=False, mmap_mode='r'):
+        """
+        Load parameters from a directory saved by `save_named_params`. Parameters are matched by key
+        rather than by position, so only the parameters that are needed are read.
+        :param params_path: path of the directory from which to load parameters
+        :param layers: [optional] a list of layers, or layer names, whose parameters should be loaded;
+            if `None` the parameters of all layers are loaded
+        :param include_updates: if True, include parameters used for updates
+        :param mmap_mode: (default='r') memory map mode used to open the parameter files; `None` to read
+            them into memory
+        """
+        named_params = self.get_named_params(include_updates=include_updates)
+        if layers is not None:
+            all_layers = lasagne.layers.get_all_layers(self.final_layers)
+            paths = set()
+            for layer in layers:
+                if isinstance(layer, lasagne.layers.Layer):
+                    paths.add(param_store.layer_path(layer, all_layers.index(layer)))
+                else:
+                    paths.add(layer)
+            named_params = collections.OrderedDict(
+                [(key, p) for key, p in named_params.items() if key.rsplit('/', 1)[0] in paths])
+            found_paths = {key.rsplit('/', 1)[0] for key in named_params.keys()}
+            if found_paths != paths:
+                raise KeyError('Could not find parameters for layers {}'.format(sorted(paths - found_paths)))
+
+        values = param_store.load_named_params(params_path, keys=list(named_params.keys()), mmap_mode=mmap_mode)
+        for key, p in named_params.items():
+            v = values[key]
+            if v.shape != p.get_value(borrow=True).shape:
+                raise ValueError('Parameter {} has shape {} but the value loaded has shape {}'.format(
+                    key, p.get_value(borrow=True).shape, v.shape))
+            p.set_value(v)
+
 
     def get_param_values(self, include_updates=False):
         """
@@ -245,17 +389,235 @@ class BasicDNN (object):
         return ''.join(items)
 
 
-    def predict(self, X, batchsize=500):
+    def _profile_stats(self, name):
+        return self._profiles[name] if self._profiles is not None else None
+
+    def profile_report(self, sample_batch=None, n_repeats=5):
+        """
+        Aggregate the profiling statistics gathered for the training, validation and prediction functions.
+        Requires that the network was constructed with `profile=True`.
+
+        :param sample_batch: [optional] a mini-batch of inputs (a list of arrays, one per input variable);
+            if given, each layer is timed separately on it (see `profiling.layer_report`)
+        :param n_repeats: (default=5) the number of times each layer is run when timing layers
+        :return: a dict with the entries `'functions'`, an `OrderedDict` mapping function name
+            (`'train'`, `'val'` or `'predict'`) to a per-op report (see `profiling.op_report`) and `'layers'`,
+            a list of per-layer reports or `None` if `sample_batch` is not given.
+            Use `profiling.format_report` to format it as a table.
+        """
+        if self._profiles is None:
+            raise ValueError('profile_report requires the network to be constructed with profile=True')
+        functions = collections.OrderedDict([(name, profiling.op_report(prof))
+                                             for name, prof in self._profiles.items()])
+        layers = None
+        if sample_batch is not None:
+            layers = profiling.layer_report(self.final_layers, self.input_vars, sample_batch, n_repeats=n_repeats)
+        return {'functions': functions, 'layers': layers}
+
+    def _output_indices(self, outputs):
+        if outputs is None:
+            return tuple(range(len(self.objectives)))
+        if isinstance(outputs, (six.string_types, int)):
+            outputs = [outputs]
+        names = [obj.name for obj in self.objectives]
+        indices = []
+        for out in outputs:
+            if isinstance(out, six.string_types):
+                if out not in names:
+                    raise ValueError('No objective named {}; objectives are {}'.format(out, names))
+                indices.append(names.index(out))
+            elif isinstance(out, int):
+                if out < 0 or out >= len(self.objectives):
+                    raise ValueError('Objective index {} out of range'.format(out))
+                indices.append(out)
+            else:
+                raise TypeError('outputs should contain objective names or indices, not {}'.format(type(out)))
+        return tuple(indices)
+
+    def _compiled_predict_fn(self, key):
+        with self._predict_fns_lock:
+            fn = self._predict_fns_compiled.get(key)
+            if fn is None:
+                indices, raw = key
+                exprs = []
+                pred_inputs = []
+                for i in indices:
+                    obj_res = self.objective_results[i]
+                    if raw:
+                        exprs.append(obj_res.raw_prediction)
+                    else:
+                        exprs.extend(_prediction_list(obj_res.prediction))
+                        pred_inputs.extend(obj_res.prediction_inputs)
+                fn = theano.function(self.input_vars + pred_inputs, exprs, profile=self._profile_stats('predict'))
+                self._predict_fns_compiled[key] = fn
+        return fn
+
+    def _thread_predict_fn(self, key=None):
+        if key is None:
+            key = self._all_outputs_key
+        fns = getattr(self._predict_fn_local, 'fns', None)
+        if fns is None:
+            fns = {}
+            self._predict_fn_local.fns = fns
+        fn = fns.get(key)
+        if fn is None:
+            # `Function.copy` does not carry over the profile, so the copies must be given it to record into
+            fn = self._compiled_predict_fn(key).copy(profile=self._profile_stats('predict'))
+            fns[key] = fn
+        return fn
+
+    def _n_prediction_outputs(self, indices, raw):
+        if raw:
+            return len(indices)
+        return sum([len(_prediction_list(self.objective_results[i].prediction)) for i in indices])
+
+    def _prediction_input_values(self, temperature=None, indices=None, raw=False):
+        if raw:
+            return []
+        if indices is None:
+            indices = range(len(self.objectives))
+        values = []
+        for i in indices:
+            values.extend(self.objectives[i].prediction_input_values(temperature=temperature))
+        return values
+
+    def _predict_batch(self, *batch):
+        return self._thread_predict_fn()(*(list(batch) + self._prediction_input_values()))
+
+    def predict_batch_fn(self, temperature=None, tta=None, outputs=None, raw=False):
+        """
+        Get a function that predicts the outputs for a mini-batch. The function may be called concurrently
+        from multiple threads.
+
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`,
+        the temperature of each objective is used
+        :param tta: [optional] a `tta.TestTimeAugmentation` instance; if given, each mini-batch is augmented,
+        evaluated as one larger mini-batch and the inverted predictions averaged
+        :param outputs: [optional] the objectives whose predictions are computed; a list of objective names
+        or indices. If `None`, the predictions of all objectives are computed. A function that computes only the
+        selected predictions is compiled on first use and cached.
+        :param raw: (default=False) if `True`, compute the raw output of each objective's layer, e.g. the
+        pre-softmax activations of a classifier in `(sample, class, spatial...)` layout
+        :return: a function of the form `fn(*batch_inputs) -> list of arrays`
+        """
+        key = (self._output_indices(outputs), bool(raw))
+        values = self._prediction_input_values(temperature=temperature, indices=key[0], raw=raw)
+        def predict_batch(*batch):
+            return self._thread_predict_fn(key)(*(list(batch) + values))
+        if tta is not None:
+            predict_batch = tta.wrap(predict_batch)
+        return predict_batch
+
+    def predict(self, X, batchsize=500, temperature=None, tta=None, outputs=None, raw=False):
         """
         Evaluate the network, returning its predictions
 
         :param X: input data as a data source
         :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`,
+        the temperature of each objective is used
+        :param tta: [optional] a `tta.TestTimeAugmentation` instance; if given, each mini-batch is augmented,
+        evaluated as one larger mini-batch and the inverted predictions averaged
+        :param outputs: [optional] the objectives whose predictions are computed; a list of objective names
+        or indices. If `None`, the predictions of all objectives are computed. A function that computes only the
+        selected predictions is compiled on first use and cached.
+        :param raw: (default=False) if `True`, compute the raw output of each objective's layer, e.g. the
+        pre-softmax activations of a classifier in `(sample, class, spatial...)` layout
         :return: a list of predicted outputs, where each entry corresponds to a training objective
         e.g. a simple classifier will return the list `[pred_prob]` where `pred_prob` is the predicted class
-        probabilities
+        probabilities. Objectives whose prediction consists of several outputs (e.g. a classifier in
+        `'topk'` prediction mode) contribute an entry for each of them.
+        """
+        predict_fn = self.predict_batch_fn(temperature=temperature, tta=tta, outputs=outputs, raw=raw)
+        return data_source.coerce_data_source(X).batch_map_concat(predict_fn, batch_size=batchsize)
+
+    def predict_batches(self, X, batchsize=500, temperature=None, tta=None, outputs=None, raw=False):
+        """
+        Evaluate the network, yielding its predictions one mini-batch at a time. Only one mini-batch
+        of predictions is held in memory at a time, so this is suitable for data sets whose predictions
+        are too large to fit in memory.
+
+        :param X: input data as a data source
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`,
+        the temperature of each objective is used
+        :param tta: [optional] a `tta.TestTimeAugmentation` instance; if given, each mini-batch is augmented,
+        evaluated as one larger mini-batch and the inverted predictions averaged
+        :param outputs: [optional] the objectives whose predictions are computed; a list of objective names
+        or indices. If `None`, the predictions of all objectives are computed. A function that computes only the
+        selected predictions is compiled on first use and cached.
+        :param raw: (default=False) if `True`, compute the raw output of each objective's layer, e.g. the
+        pre-softmax activations of a classifier in `(sample, class, spatial...)` layout
+        :return: an iterator that yields a list of predicted outputs for each mini-batch, where each entry
+        corresponds to a training objective
+        """
+        predict_fn = self.predict_batch_fn(temperature=temperature, tta=tta, outputs=outputs, raw=raw)
+        for batch in data_source.coerce_data_source(X).batch_iterator(batchsize):
+            yield predict_fn(*batch)
+
+    def predict_to(self, X, out, batchsize=500, temperature=None, tta=None, outputs=None, raw=False):
+        """
+        Evaluate the network, writing its predictions into pre-allocated arrays one mini-batch at a time,
+        so that memory usage is bounded by the mini-batch size rather than the size of the data set.
+
+        :param X: input data as a data source; the number of samples must be known and non-zero
+        :param out: destination for the predictions; either a single destination or a list with a destination
+        for each predicted output of the selected objectives (see `outputs`). Each destination is either a str/unicode path, in which case a NumPy `.npy`
+        file is created and memory mapped, or an array-like (e.g. a `np.memmap`) of the correct shape
+        into which the predictions are written
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`,
+        the temperature of each objective is used
+        :param tta: [optional] a `tta.TestTimeAugmentation` instance; if given, each mini-batch is augmented,
+        evaluated as one larger mini-batch and the inverted predictions averaged
+        :param outputs: [optional] the objectives whose predictions are computed; a list of objective names
+        or indices. If `None`, the predictions of all objectives are computed. A function that computes only the
+        selected predictions is compiled on first use and cached.
+        :param raw: (default=False) if `True`, compute the raw output of each objective's layer, e.g. the
+        pre-softmax activations of a classifier in `(sample, class, spatial...)` layout
+        :return: a list of the arrays into which the predictions were written, where each entry corresponds
+        to a training objective
         """
-        return data_source.coerce_data_source(X).batch_map_concat(self._predict_fn, batch_size=batchsize)
+        if not isinstance(out, (list, tuple)):
+            out = [out]
+        n_outputs = self._n_prediction_outputs(self._output_indices(outputs), raw)
+        if len(out) != n_outputs:
+            raise ValueError('out should provide a destination for each of the {} outputs, not {}'.format(
+                n_outputs, len(out)))
+
+        X = data_source.coerce_data_source(X)
+        N = X.num_samples()
+        if N is None or N == np.inf:
+            raise ValueError('predict_to requires a data source with a known finite number of samples')
+        if N == 0:
+            # The shapes of the destinations are only known once the first mini-batch has been predicted
+            raise ValueError('predict_to requires a data source with at least one sample')
+
+        dests = None
+        pos = 0
+        for batch_pred in self.predict_batches(X, batchsize=batchsize, temperature=temperature, tta=tta,
+                                                 outputs=outputs, raw=raw):
+            if dests is None:
+                dests = [_open_prediction_dest(d, N, pred) for d, pred in zip(out, batch_pred)]
+            n = batch_pred[0].shape[0]
+            for dest, pred in zip(dests, batch_pred):
+                dest[pos:pos + n] = pred
+            pos += n
+
+        for dest in dests:
+            if isinstance(dest, np.memmap):
+                dest.flush()
+        return dests
+
+
+def _open_prediction_dest(dest, n_samples, batch_pred):
+    shape = (n_samples,) + batch_pred.shape[1:]
+    if isinstance(dest, six.string_types):
+        return np.lib.format.open_memmap(dest, mode='w+', dtype=batch_pred.dtype, shape=shape)
+    else:
+        if tuple(dest.shape) != shape:
+            raise ValueError('prediction destination has shape {}, should be {}'.format(dest.shape, shape))
+        return dest
 
 
 class BasicClassifierDNN (BasicDNN):
@@ -266,13 +628,15 @@ class BasicClassifierDNN (BasicDNN):
     """
     def __init__(self, input_vars, target_and_mask_vars, final_layers, classifier_objective,
                  score_objective=None,
-                 trainable_params=None, updates_fn=None, params_source=None):
+                 trainable_params=None, updates_fn=None, params_source=None, profile=False,
+                 per_sample_loss=False):
         if not isinstance(classifier_objective, dnn_objective.ClassifierObjective):
             raise TypeError('classifier_objective must be an instance of dnn_objective.ClassifierObjective')
         super(BasicClassifierDNN, self).__init__(input_vars, target_and_mask_vars, final_layers,
                                                  [classifier_objective], score_objective=score_objective,
                                                  trainable_params=trainable_params, updates_fn=updates_fn,
-                                                 params_source=params_source)
+                                                 params_source=params_source, profile=profile,
+                                                 per_sample_loss=per_sample_loss)
         self._classifier_objective = classifier_objective
 
     @property
@@ -283,26 +647,6 @@ class BasicClassifierDNN (BasicDNN):
     def temperature(self, t):
         self._classifier_objective.temperature = t
 
-    def predict(self, X, batchsize=500, temperature=None):
-        """
-        Evaluate the network, returning its predictions
-
-        :param X: input data as a data source
-        :param batchsize: the mini-batch size
-        :return: a list of predicted outputs, where each entry corresponds to a training objective
-        e.g. a simple classifier will return the list `[pred_prob]` where `pred_prob` is the predicted class
-        probabilities
-        """
-        old_temperature = None
-        if temperature is not None:
-            old_temperature = self.temperature
-            self.temperature = temperature
-        res = super(BasicClassifierDNN, self).predict(X, batchsize=batchsize)
-        if temperature is not None:
-            self.temperature = old_temperature
-
-        return res
-
 
 def _get_input_layers(final_layer):
     layers = lasagne.layers.get_all_layers(final_layer)
@@ -314,7 +658,9 @@ def _get_input_vars(final_layer):
 
 def simple_classifier(network_build_fn, n_input_spatial_dims=0, n_target_spatial_dims=0,
                       target_channel_index=None, score=dnn_objective.ClassifierObjective.SCORE_ERROR, mask=False,
-                      includes_softmax=False, params_source=None, *args, **kwargs):
+                      includes_softmax=False, params_source=None,
+                      prediction_mode=dnn_objective.ClassifierObjective.PREDICTION_PROB, top_k=5, ignore_label=None,
+                      *args, **kwargs):
     """
     Construct an image classifier, given a network building function
     and an optional path from which to load parameters.
@@ -345,6 +691,11 @@ def simple_classifier(network_build_fn, n_input_spatial_dims=0, n_target_spatial
     :param params_source: [optional] source from which to obtain network parameters; either
         a str/unicode that contains the path of a NumPy array file from which to load the parameters,
         or a `BasicDNN` or Lasagne layer from which to copy the parameters
+    :param prediction_mode: (default='prob') what the classifier predicts; `'prob'`, `'argmax'` or `'topk'`
+        (see `dnn_objective.ClassifierObjective`)
+    :param top_k: (default=5) the number of classes predicted in `'topk'` mode
+    :param ignore_label: [optional] target value that marks samples/pixels to be ignored; the mask is computed
+        from the target, so `mask` can be left as `False`
     :return: a classifier instance
     """
     if n_input_spatial_dims == 0:
@@ -361,12 +712,14 @@ def simple_classifier(network_build_fn, n_input_spatial_dims=0, n_target_spatial
             n_target_spatial_dims))
     return classifier(input_vars, network_build_fn, n_target_spatial_dims=n_target_spatial_dims,
                       target_channel_index=target_channel_index, score=score, mask=mask,
-                      includes_softmax=includes_softmax, params_source=params_source, *args, **kwargs)
+                      includes_softmax=includes_softmax, prediction_mode=prediction_mode, top_k=top_k,
+                      ignore_label=ignore_label, params_source=params_source, *args, **kwargs)
 
 
 def classifier(input_vars, network_build_fn, n_target_spatial_dims=0, target_channel_index=None,
                score=dnn_objective.ClassifierObjective.SCORE_ERROR, mask=False, includes_softmax=False,
-               params_source=None, *args, **kwargs):
+               params_source=None, prediction_mode=dnn_objective.ClassifierObjective.PREDICTION_PROB, top_k=5,
+               ignore_label=None, *args, **kwargs):
     """
     Construct a classifier, given input variables and a network building function
     and an optional path from which to load parameters.
@@ -394,6 +747,11 @@ def classifier(input_vars, network_build_fn, n_target_spatial_dims=0, target_cha
     :param params_source: [optional] source from which to obtain network parameters; either
         a str/unicode that contains the path of a NumPy array file from which to load the parameters,
         or a `BasicDNN` or Lasagne layer from which to copy the parameters
+    :param prediction_mode: (default='prob') what the classifier predicts; `'prob'`, `'argmax'` or `'topk'`
+        (see `dnn_objective.ClassifierObjective`)
+    :param top_k: (default=5) the number of classes predicted in `'topk'` mode
+    :param ignore_label: [optional] target value that marks samples/pixels to be ignored; the mask is computed
+        from the target, so `mask` can be left as `False`
     :return: a classifier instance
     """
     # Prepare Theano variables for inputs and targets
@@ -436,13 +794,15 @@ def classifier(input_vars, network_build_fn, n_target_spatial_dims=0, target_cha
     objective = dnn_objective.ClassifierObjective('y', network, target_var, mask_expr=mask_var,
                                                   n_target_spatial_dims=n_target_spatial_dims,
                                                   target_channel_index=target_channel_index, score=score,
-                                                  includes_softmax=includes_softmax)
+                                                  includes_softmax=includes_softmax,
+                                                  prediction_mode=prediction_mode, top_k=top_k,
+                                                  ignore_label=ignore_label)
 
     return BasicClassifierDNN(input_vars, [target_var] + mask_vars, network, objective,
                               params_source=params_source, *args, **kwargs)
 
 def simple_regressor(network_build_fn, n_input_spatial_dims=0, n_target_spatial_dims=0, mask=False,
-                     params_source=None, *args, **kwargs):
+                     params_source=None, nan_targets=False, *args, **kwargs):
     """
     Construct a vector regressor, given a network building function
     and an optional path from which to load parameters.
@@ -463,6 +823,8 @@ def simple_regressor(network_build_fn, n_input_spatial_dims=0, n_target_spatial_
     :param params_source: [optional] source from which to obtain network parameters; either
         a str/unicode that contains the path of a NumPy array file from which to load the parameters,
         or a `BasicDNN` or Lasagne layer from which to copy the parameters
+    :param nan_targets: (default=False) if True, target elements that are NaN are ignored; the mask is computed
+        from the target, so `mask` can be left as `False`
     :return: a classifier instance
     """
     if n_input_spatial_dims == 0:
@@ -478,11 +840,11 @@ def simple_regressor(network_build_fn, n_input_spatial_dims=0, n_target_spatial_
         raise ValueError('Valid values for n_input_spatial_dims are in the range 0-3, not {}'.format(
             n_target_spatial_dims))
     return regressor(input_vars, network_build_fn, n_target_spatial_dims=n_target_spatial_dims,
-                     mask=mask, params_source=params_source, *args, **kwargs)
+                     mask=mask, nan_targets=nan_targets, params_source=params_source, *args, **kwargs)
 
 
-def regressor(input_vars, network_build_fn, n_target_spatial_dims=0, mask=False,
-              params_source=None, *args, **kwargs):
+def regressor(input_vars, network_build_fn, n_target_spatial_dims=0, mask=False, params_source=None,
+              nan_targets=False, *args, **kwargs):
     """
     Construct a regressor, given a network building function
     and an optional path from which to load parameters.
@@ -500,6 +862,8 @@ def regressor(input_vars, network_build_fn, n_target_spatial_dims=0, mask=False,
     :param params_source: [optional] source from which to obtain network parameters; either
         a str/unicode that contains the path of a NumPy array file from which to load the parameters,
         or a `BasicDNN` or Lasagne layer from which to copy the parameters
+    :param nan_targets: (default=False) if True, target elements that are NaN are ignored; the mask is computed
+        from the target, so `mask` can be left as `False`
     :return: a classifier instance
     """
     # Prepare Theano variables for inputs and targets
@@ -539,7 +903,33 @@ def regressor(input_vars, network_build_fn, n_target_spatial_dims=0, mask=False,
         input_vars = _get_input_vars(network)
 
     objective = dnn_objective.RegressorObjective('y', network, target_var, mask_expr=mask_var,
-                                                 n_target_spatial_dims=n_target_spatial_dims)
+                                                 nan_targets=nan_targets)
 
     return BasicDNN(input_vars, [target_var] + mask_vars, network, [objective],
                     params_source=params_source, *args, **kwargs)
+
+
+import unittest
+
+class Test_BasicDNN (unittest.TestCase):
+    def test_profile_predict(self):
+        def build_net(input_vars):
+            net = lasagne.layers.InputLayer(shape=(None, 4), input_var=input_vars[0])
+            return lasagne.layers.DenseLayer(net, num_units=3, nonlinearity=None)
+        clf = simple_classifier(build_net, profile=True)
+        X = np.random.normal(size=(10, 4)).astype(theano.config.floatX)
+        clf.predict(X, batchsize=5)
+        clf.predict(X, batchsize=5, outputs=[0], raw=True)
+        self.assertTrue(clf._profiles['predict'].fct_callcount > 0)
+        self.assertTrue(len(clf.profile_report()['functions']['predict']['ops']) > 0)
+
+    def test_predict_to_empty(self):
+        import os, tempfile
+        def build_net(input_vars):
+            net = lasagne.layers.InputLayer(shape=(None, 4), input_var=input_vars[0])
+            return lasagne.layers.DenseLayer(net, num_units=3, nonlinearity=None)
+        clf = simple_classifier(build_net)
+        path = os.path.join(tempfile.mkdtemp(), 'pred.npy')
+        X = np.zeros((0, 4), dtype=theano.config.floatX)
+        self.assertRaises(ValueError, clf.predict_to, X, path)
+        self.assertFalse(os.path.exists(path))
@@ -5,6 +5,8 @@ import theano.tensor as T
 import lasagne
 from lasagne.utils import floatX
 
+from . import metrics
+
 
 class TemperatureSoftmax (object):
     """
@@ -98,13 +100,23 @@ def _unflatten_spatial(x, spatial_shape, n_channels):
 
 class ObjectiveOutput (object):
     def __init__(self, train_cost, train_results, train_results_str_fn,
-                 eval_results, eval_results_str_fn, prediction):
+                 eval_results, eval_results_str_fn, prediction, prediction_inputs=None, raw_prediction=None,
+                 train_sample_loss=None):
         self.train_cost = train_cost
         self.train_results = train_results
         self.train_results_str_fn = train_results_str_fn
         self.eval_results = eval_results
         self.eval_results_str_fn = eval_results_str_fn
+        # Either a single expression or a list of expressions, e.g. the classes and scores of a top-k classifier
         self.prediction = prediction
+        # Additional input variables required to compute `prediction`; their values are provided
+        # by the objective's `prediction_input_values` method
+        self.prediction_inputs = prediction_inputs if prediction_inputs is not None else []
+        # The raw output of the objective layer, e.g. pre-softmax activations; requires no prediction inputs
+        self.raw_prediction = raw_prediction if raw_prediction is not None else prediction
+        # Per-sample training loss; optional. For unmasked objectives its mean is `train_cost / cost_weight`;
+        # masked objectives may weight samples differently in `train_cost`, see the objective for details
+        self.train_sample_loss = train_sample_loss
 
 
 class AbstractObjective (object):
@@ -124,6 +136,15 @@ class AbstractObjective (object):
     def build(self):
         raise NotImplementedError('Abstract for {}'.format(type(self)))
 
+    def prediction_input_values(self, temperature=None):
+        """
+        Get the values for the `prediction_inputs` of the `ObjectiveOutput` returned by `build`
+
+        :param temperature: [optional] softmax temperature; ignored by objectives that do not use one
+        :return: a list of values
+        """
+        return []
+
     def score_improved(self, new_results, best_so_far_results):
         raise NotImplementedError('Abstract for {}'.format(type(self)))
 
@@ -135,9 +156,17 @@ class ClassifierObjective (AbstractObjective):
     SCORE_PRECISION = 'precision'
     SCORE_RECALL = 'recall'
     SCORE_F1 = 'f1'
+    SCORE_ROC_AUC = 'roc_auc'
+    SCORE_PR_AUC = 'pr_auc'
+    SCORE_ECE = 'ece'
+
+    PREDICTION_PROB = 'prob'
+    PREDICTION_ARGMAX = 'argmax'
+    PREDICTION_TOPK = 'topk'
 
     def __init__(self, name, objective_layer, target_expr, mask_expr=None, n_target_spatial_dims=0,
-                 target_channel_index=None, score=SCORE_ERROR, includes_softmax=False, cost_weight=1.0):
+                 target_channel_index=None, score=SCORE_ERROR, includes_softmax=False, cost_weight=1.0,
+                 prediction_mode=PREDICTION_PROB, top_k=5, score_bins=100, ignore_label=None):
         """
         Multi-class classifier objective
 
@@ -150,13 +179,30 @@ class ClassifierObjective (AbstractObjective):
         :param target_channel_index: (default=None) if the target has a channel dimension, this is the index into
         that channel for this objective
         :param score: (default=`'err'`) how to evaluate this objective; one of `'err'`, `'jaccard'`, `'precision'`,
-        `'recall'`, `'f1'` or use the constants `ClassifierObjective.SCORE_ERROR`, `ClassifierObjective.SCORE_JACCARD`,
-        `ClassifierObjective.SCORE_PRECISION`, `ClassifierObjective.SCORE_RECALL`, `ClassifierObjective.SCORE_F1`
-        respectively
+        `'recall'`, `'f1'`, `'roc_auc'`, `'pr_auc'` or `'ece'`, or use the constants `ClassifierObjective.SCORE_ERROR`,
+        `ClassifierObjective.SCORE_JACCARD`, `ClassifierObjective.SCORE_PRECISION`, `ClassifierObjective.SCORE_RECALL`,
+        `ClassifierObjective.SCORE_F1`, `ClassifierObjective.SCORE_ROC_AUC`, `ClassifierObjective.SCORE_PR_AUC`,
+        `ClassifierObjective.SCORE_ECE` respectively. `'roc_auc'` and `'pr_auc'` are one-vs-rest scores averaged over
+        classes and `'ece'` is the expected calibration error of the predicted class; they are computed from score
+        histograms with `score_bins` bins that are accumulated during evaluation (see the `metrics` module)
         :param includes_softmax: `True` indicates that the objective_layer includes the softmax non-linearity,
         `False` indicates that it does not, in which case a non-linearity layer will be added
         :param cost_weight: (default=1.0) weight applied to the cost of this objective
+        :param prediction_mode: (default=`'prob'`) what the prediction consists of; `'prob'` for the class
+        probabilities of shape `(sample, class, spatial...)`, `'argmax'` for the predicted class as an int32 array of
+        shape `(sample, spatial...)` or `'topk'` for two predictions: the indices of the `top_k` most probable
+        classes as an int32 array of shape `(sample, k, spatial...)` followed by their probabilities of the same
+        shape. Use the constants `ClassifierObjective.PREDICTION_PROB`, `ClassifierObjective.PREDICTION_ARGMAX`
+        and `ClassifierObjective.PREDICTION_TOPK`
+        :param top_k: (default=5) the number of classes predicted in `'topk'` mode
+        :param score_bins: (default=100) the number of histogram bins used by the `'roc_auc'`, `'pr_auc'` and
+        `'ece'` scores
+        :param ignore_label: [optional] target value that marks samples/pixels to be ignored; if given,
+        a mask is computed from the target in the graph, so a separate mask is not needed. It is combined
+        with `mask_expr` if both are given
         """
+        if prediction_mode not in {self.PREDICTION_PROB, self.PREDICTION_ARGMAX, self.PREDICTION_TOPK}:
+            raise ValueError('prediction_mode is not valid ({})'.format(prediction_mode))
         super(ClassifierObjective, self).__init__(name, cost_weight)
         self.objective_layer = objective_layer
         self.target_expr = target_expr
@@ -164,6 +210,10 @@ class ClassifierObjective (AbstractObjective):
         self.n_target_spatial_dims = n_target_spatial_dims
         self.target_channel_index = target_channel_index
         self.score = score
+        self.prediction_mode = prediction_mode
+        self.top_k = top_k
+        self.score_bins = score_bins
+        self.ignore_label = ignore_label
         # The value of the `softmax` attribute indicates if the network came with it already in place
         if includes_softmax:
             self.softmax = None
@@ -183,6 +233,14 @@ class ClassifierObjective (AbstractObjective):
         if self.softmax is not None:
             self.softmax.temperature = t
 
+    def prediction_input_values(self, temperature=None):
+        if self.softmax is not None and self.prediction_mode != self.PREDICTION_ARGMAX:
+            if temperature is None:
+                temperature = self.temperature
+            return [floatX(1.0 / temperature)]
+        else:
+            return []
+
 
     def build(self):
         if self.target_channel_index is not None:
@@ -192,8 +250,15 @@ class ClassifierObjective (AbstractObjective):
             target_expr = self.target_expr
             mask_expr = self.mask_expr
 
+        if self.ignore_label is not None:
+            # Mask out ignored samples and replace their targets with a valid class index
+            valid = T.neq(target_expr, self.ignore_label)
+            target_expr = T.switch(valid, target_expr, 0)
+            valid = valid.astype(theano.config.floatX)
+            mask_expr = mask_expr * valid if mask_expr is not None else valid
+
         flat_target = _flatten_spatial_theano(target_expr, None)
-        flat_mask = _flatten_spatial_theano(mask_expr, None) if self.mask_expr is not None else None
+        flat_mask = _flatten_spatial_theano(mask_expr, None) if mask_expr is not None else None
 
         # Flatten the objective layer (if the objective layer generates an
         # output with 2 dimensions then this is a no-op)
@@ -241,22 +306,43 @@ class ClassifierObjective (AbstractObjective):
             else:
                 eval_scores = [errors.sum() * inv_n_spatial]
         elif self.score in {self.SCORE_JACCARD, self.SCORE_PRECISION, self.SCORE_RECALL, self.SCORE_F1}:
-            for cls_i in range(n_classes):
-                truth = T.eq(flat_target, cls_i).astype(theano.config.floatX)
-                pred = T.eq(eval_pred_cls, cls_i).astype(theano.config.floatX)
-                inv_truth = T.neq(flat_target, cls_i).astype(theano.config.floatX)
-                inv_pred = T.neq(eval_pred_cls, cls_i).astype(theano.config.floatX)
-                true_neg = inv_truth * inv_pred
-                true_pos = truth * pred
-                false_neg = truth * inv_pred
-                false_pos = inv_truth * pred
-                if flat_mask is not None:
-                    true_neg = true_neg * flat_mask
-                    true_pos = true_pos * flat_mask
-                    false_neg = false_neg * flat_mask
-                    false_pos = false_pos * flat_mask
-
-                eval_scores.extend([true_neg.sum(), false_neg.sum(), false_pos.sum(), true_pos.sum()])
+            # Confusion matrix; rows are indexed by ground truth class, columns by predicted class
+            n_cm = n_classes * n_classes
+            cm_index = flat_target * n_classes + eval_pred_cls
+            confusion = T.extra_ops.bincount(cm_index, weights=flat_mask, minlength=n_cm)[:n_cm]
+            eval_scores = [confusion.reshape((n_classes, n_classes)).astype(theano.config.floatX)]
+        elif self.score in {self.SCORE_ROC_AUC, self.SCORE_PR_AUC}:
+            # Histograms of the probability of each class for samples of that class (positive) and samples
+            # of other classes (negative); shape (class, bin)
+            n_bins = self.score_bins
+            n_hist = n_classes * n_bins
+            bins = T.clip(T.floor(eval_pred_prob * n_bins), 0, n_bins - 1).astype('int64')
+            hist_index = (T.arange(n_classes).dimshuffle('x', 0) * n_bins + bins).flatten()
+            positive = T.eq(flat_target.dimshuffle(0, 'x'),
+                            T.arange(n_classes).dimshuffle('x', 0)).astype(theano.config.floatX)
+            negative = 1.0 - positive
+            if flat_mask is not None:
+                positive = positive * flat_mask.dimshuffle(0, 'x')
+                negative = negative * flat_mask.dimshuffle(0, 'x')
+            pos_hist = T.extra_ops.bincount(hist_index, weights=positive.flatten(), minlength=n_hist)[:n_hist]
+            neg_hist = T.extra_ops.bincount(hist_index, weights=negative.flatten(), minlength=n_hist)[:n_hist]
+            eval_scores = [pos_hist.reshape((n_classes, n_bins)).astype(theano.config.floatX),
+                           neg_hist.reshape((n_classes, n_bins)).astype(theano.config.floatX)]
+        elif self.score == self.SCORE_ECE:
+            # Per-bin sample count, sum of confidence and number of correct predictions, binned by
+            # the probability of the predicted class; shape (3, bin)
+            n_bins = self.score_bins
+            confidence = T.max(eval_pred_prob, axis=1)
+            bins = T.clip(T.floor(confidence * n_bins), 0, n_bins - 1).astype('int64')
+            count = T.ones_like(confidence)
+            correct = T.eq(eval_pred_cls, flat_target).astype(theano.config.floatX)
+            if flat_mask is not None:
+                count = count * flat_mask
+                confidence = confidence * flat_mask
+                correct = correct * flat_mask
+            hists = [T.extra_ops.bincount(bins, weights=w, minlength=n_bins)[:n_bins]
+                     for w in [count, confidence, correct]]
+            eval_scores = [T.stack(hists).astype(theano.config.floatX)]
         else:
             raise ValueError('score is not valid ({})'.format(self.score))
 
@@ -267,8 +353,38 @@ class ClassifierObjective (AbstractObjective):
             train_loss_batch = train_loss.sum() * inv_n_spatial
             eval_loss_batch = eval_loss.sum() * inv_n_spatial
 
-        # Unflatten prediction
-        pred_prob = _unflatten_spatial_theano(eval_pred_prob, spatial_shape, n_classes)
+        # Per-sample loss; mean over spatial dimensions
+        if int(n_spatial) > 1:
+            train_sample_loss = train_loss.reshape((-1, int(n_spatial))).mean(axis=1)
+        else:
+            train_sample_loss = train_loss
+
+        if self.prediction_mode == self.PREDICTION_ARGMAX:
+            # The predicted class does not depend on the temperature
+            prediction_inputs = []
+            prediction = _unflatten_spatial_theano(eval_pred_cls.astype('int32'), spatial_shape, None)
+        else:
+            # The prediction takes the inverse temperature as an input rather than using the shared variable
+            # in `self.softmax`, so that predictions at different temperatures can be computed concurrently
+            if self.softmax is not None:
+                inv_temperature = T.scalar('inv_temperature')
+                prediction_inputs = [inv_temperature]
+                eval_logits = lasagne.layers.get_output(obj_flat_layer, deterministic=True)
+                pred_prob_flat = lasagne.nonlinearities.softmax(eval_logits * inv_temperature)
+            else:
+                prediction_inputs = []
+                pred_prob_flat = eval_pred_prob
+
+            if self.prediction_mode == self.PREDICTION_PROB:
+                # Unflatten prediction
+                prediction = _unflatten_spatial_theano(pred_prob_flat, spatial_shape, n_classes)
+            else:
+                k = min(self.top_k, n_classes)
+                # (Sample:spatial...,Class) -> (Sample:spatial...,k)
+                top_cls = T.argsort(-pred_prob_flat, axis=1)[:, :k]
+                top_prob = pred_prob_flat[T.arange(pred_prob_flat.shape[0]).dimshuffle(0, 'x'), top_cls]
+                prediction = [_unflatten_spatial_theano(top_cls.astype('int32'), spatial_shape, k),
+                              _unflatten_spatial_theano(top_prob, spatial_shape, k)]
 
         def train_results_str_fn(train_res):
             return '{} loss={:.6f}'.format(self.name, train_res[0])
@@ -281,49 +397,56 @@ class ClassifierObjective (AbstractObjective):
                                train_results_str_fn=train_results_str_fn,
                                eval_results=[eval_loss_batch] + eval_scores,
                                eval_results_str_fn=eval_results_str_fn,
-                               prediction=pred_prob)
+                               prediction=prediction, prediction_inputs=prediction_inputs,
+                               raw_prediction=lasagne.layers.get_output(self.objective_layer, deterministic=True),
+                               train_sample_loss=train_sample_loss)
 
     def _score_frac(self, numerator, denominator):
-        if denominator == 0.0:
-            return 0.0
-        else:
-            return numerator / denominator
+        # Element-wise `numerator / denominator`, giving 0 where the denominator is 0
+        denominator = np.asarray(denominator, dtype=float)
+        return np.where(denominator == 0.0, 0.0,
+                        np.asarray(numerator, dtype=float) / np.where(denominator == 0.0, 1.0, denominator))
 
     def _compute_score(self, eval_results):
         if self.score == self.SCORE_ERROR:
             return eval_results[1]
         elif self.score in {self.SCORE_JACCARD, self.SCORE_PRECISION, self.SCORE_RECALL, self.SCORE_F1}:
-            components = eval_results[1:]
-            cls_scores = []
-            for cls_i in range(len(components) // 4):
-                true_neg = components[cls_i * 4 + 0]
-                false_neg = components[cls_i * 4 + 1]
-                false_pos = components[cls_i * 4 + 2]
-                true_pos = components[cls_i * 4 + 3]
-
-                cls_n = false_neg + false_pos + true_pos
-
-                if cls_n > 0:
-                    if self.score == self.SCORE_JACCARD:
-                        cls_scores.append(self._score_frac(true_pos, false_pos + false_neg + true_pos))
-                    elif self.score == self.SCORE_PRECISION:
-                        cls_scores.append(self._score_frac(true_pos, false_pos + true_pos))
-                    elif self.score == self.SCORE_RECALL:
-                        cls_scores.append(self._score_frac(true_pos, false_neg + true_pos))
-                    elif self.score == self.SCORE_F1:
-                        precision = self._score_frac(true_pos, false_pos + true_pos)
-                        recall = self._score_frac(true_pos, false_neg + true_pos)
-                        f1 = self._score_frac(2.0 * (precision * recall), precision + recall)
-                        cls_scores.append(f1)
-                    else:
-                        raise ValueError('score is not valid ({})'.format(self.score))
-            return np.mean(cls_scores)
+            confusion = np.asarray(eval_results[1])
+            true_pos = np.diag(confusion)
+            false_neg = confusion.sum(axis=1) - true_pos
+            false_pos = confusion.sum(axis=0) - true_pos
+
+            if self.score == self.SCORE_JACCARD:
+                cls_scores = self._score_frac(true_pos, false_pos + false_neg + true_pos)
+            elif self.score == self.SCORE_PRECISION:
+                cls_scores = self._score_frac(true_pos, false_pos + true_pos)
+            elif self.score == self.SCORE_RECALL:
+                cls_scores = self._score_frac(true_pos, false_neg + true_pos)
+            else:
+                precision = self._score_frac(true_pos, false_pos + true_pos)
+                recall = self._score_frac(true_pos, false_neg + true_pos)
+                cls_scores = self._score_frac(2.0 * (precision * recall), precision + recall)
+
+            # Only classes that are present in the ground truth or predictions contribute
+            cls_present = (false_neg + false_pos + true_pos) > 0
+            return np.mean(cls_scores[cls_present])
+        elif self.score == self.SCORE_ROC_AUC:
+            return metrics.roc_auc_from_histograms(eval_results[1], eval_results[2])
+        elif self.score == self.SCORE_PR_AUC:
+            return metrics.pr_auc_from_histograms(eval_results[1], eval_results[2])
+        elif self.score == self.SCORE_ECE:
+            return metrics.ece_from_histograms(*eval_results[1])
+        else:
+            raise ValueError('score is not valid ({})'.format(self.score))
 
 
 
     def score_improved(self, new_results, best_so_far_results):
         if self.score == self.SCORE_ERROR:
             return new_results[1] < best_so_far_results[1]
+        elif self.score == self.SCORE_ECE:
+            # Lower calibration error is better
+            return self._compute_score(new_results) < self._compute_score(best_so_far_results)
         else:
             return self._compute_score(new_results) > self._compute_score(best_so_far_results)
 
@@ -331,49 +454,87 @@ class ClassifierObjective (AbstractObjective):
 
 class RegressorObjective (AbstractObjective):
     def __init__(self, name, objective_layer, target_expr, mask_expr=None, n_target_spatial_dims=0,
-                 cost_weight=1.0):
+                 cost_weight=1.0, nan_targets=False):
         """
         Regression objective
 
+        The training cost is the mean squared error over the target elements that contribute to the loss;
+        if a mask is used (`mask_expr` or `nan_targets`), it is divided by the mask sum, so masked out elements
+        do not dilute it. The per-sample loss (`ObjectiveOutput.train_sample_loss`) is the masked mean of each
+        sample, so the training cost is its mean weighted by each sample's mask sum (its plain mean if
+        unmasked). The logged training and evaluation losses are the sum over samples and channels of the
+        mean over spatial dimensions, counting masked out elements as zero; they are not divided by the mask sum,
+        so their values are unchanged from earlier versions and remain comparable for early stopping.
+
         :param name: objective name
         :param objective_layer: Lasagne layer that will predict the output
         :param target_expr: ground truth target expression
         :param mask_expr: [optional] mask expression
-        :param n_target_spatial_dims: (default=0) number of spatial dimensions for the target
+        :param n_target_spatial_dims: ignored; losses are normalised using the shape of the target.
+        Retained for backward compatibility
         :param cost_weight: (default=1.0) weight applied to the cost of this objective
+        :param nan_targets: (default=False) if `True`, target elements that are NaN are ignored; a mask is
+        computed from the target in the graph, so a separate mask is not needed. It is combined with `mask_expr`
+        if both are given
         """
         super(RegressorObjective, self).__init__(name, cost_weight)
         self.objective_layer = objective_layer
         self.target_expr = target_expr
         # Broadcast dimension 1
-        self.mask_expr = T.addbroadcast(mask_expr, 1)
-        self.n_target_spatial_dims = n_target_spatial_dims
+        self.mask_expr = T.addbroadcast(mask_expr, 1) if mask_expr is not None else None
+        self.nan_targets = nan_targets
 
 
     def build(self):
-        # Get an expression representing the predicted probability
-        train_pred = lasagne.layers.get_output(self.objective_layer)
+        target_expr = self.target_expr
+        mask_expr = self.mask_expr
+        if self.nan_targets:
+            # Mask out NaN targets and replace them with 0 so that they do not propagate through the loss
+            is_nan = T.isnan(target_expr)
+            target_expr = T.switch(is_nan, 0, target_expr)
+            valid = (1 - is_nan).astype(theano.config.floatX)
+            mask_expr = mask_expr * valid if mask_expr is not None else valid
+
+        # The number of target elements in each sample, and the number that contribute to the loss; computed
+        # once and shared by the training and evaluation losses
+        n_elements = T.prod(target_expr.shape[1:]).astype(theano.config.floatX)
+        if mask_expr is not None:
+            sample_norm = mask_expr.flatten(2).sum(axis=1)
+            if mask_expr.broadcastable[1]:
+                # The mask is broadcast across channels
+                sample_norm = sample_norm * target_expr.shape[1]
+            sample_norm = T.maximum(sample_norm, lasagne.utils.floatX(1.0e-8))
+        else:
+            sample_norm = n_elements
+        n_channels = target_expr.shape[1].astype(theano.config.floatX)
+
+        def reduce_loss(pred):
+            # Squared error; a single reduction over the loss tensor yields per-sample sums,
+            # the remaining reductions operate on per-sample vectors
+            loss = lasagne.objectives.squared_error(pred, target_expr)
+            if mask_expr is not None:
+                loss = loss * mask_expr
+            sample_sum = loss.flatten(2).sum(axis=1)
+            # Per-sample (masked) mean
+            sample_loss = sample_sum / sample_norm
+            if mask_expr is not None:
+                # Masked mean over the mini-batch
+                mean_loss = sample_sum.sum() / sample_norm.sum()
+            else:
+                mean_loss = sample_loss.mean()
+            # Sum over samples and channels of the mean over spatial dimensions, as expected by the trainer;
+            # masked out elements count as zero, as in the unmasked normalisation
+            batch_loss = sample_sum.sum() * (n_channels / n_elements)
+            return sample_loss, mean_loss, batch_loss
 
-        # Create a loss expression for training, i.e., a scalar objective we want
-        # to minimize; squared error
-        train_loss = lasagne.objectives.squared_error(train_pred, self.target_expr)
-        if self.mask_expr is not None:
-            train_loss = train_loss * self.mask_expr
+        # Training loss uses the non-deterministic forward pass
+        train_pred = lasagne.layers.get_output(self.objective_layer)
+        train_sample_loss, train_mean_loss, train_loss_batch = reduce_loss(train_pred)
 
         # Create prediction expressions; use deterministic forward pass (disable
         # dropout layers)
         eval_pred = lasagne.layers.get_output(self.objective_layer, deterministic=True)
-        # Create evaluation loss expression
-        eval_loss = lasagne.objectives.squared_error(eval_pred, self.target_expr)
-        if self.mask_expr is not None:
-            eval_loss = eval_loss * self.mask_expr
-
-        if self.n_target_spatial_dims == 0:
-            train_loss_batch = train_loss.sum()
-            eval_loss_batch = eval_loss.sum()
-        else:
-            train_loss_batch = train_loss.mean(axis=tuple(range(2,2+self.n_target_spatial_dims))).sum()
-            eval_loss_batch = eval_loss.mean(axis=tuple(range(2,2+self.n_target_spatial_dims))).sum()
+        eval_loss_batch = reduce_loss(eval_pred)[2]
 
         def train_results_str_fn(train_res):
             return '{} loss={:.6f}'.format(self.name, train_res[0])
@@ -381,12 +542,13 @@ class RegressorObjective (AbstractObjective):
         def eval_results_str_fn(eval_res):
             return '{} loss={:.6f}'.format(self.name, eval_res[0])
 
-        return ObjectiveOutput(train_cost=train_loss.mean() * self.cost_weight,
+        return ObjectiveOutput(train_cost=train_mean_loss * self.cost_weight,
                                train_results=[train_loss_batch],
                                train_results_str_fn=train_results_str_fn,
                                eval_results=[eval_loss_batch],
                                eval_results_str_fn=eval_results_str_fn,
-                               prediction=eval_pred)
+                               prediction=eval_pred,
+                               train_sample_loss=train_sample_loss)
 
     def score_improved(self, new_results, best_so_far_results):
         return new_results[0] < best_so_far_results[0]
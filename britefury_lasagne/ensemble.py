@@ -0,0 +1,310 @@
+"""
+Ensemble prediction
+
+`EnsembleDNN` fuses the prediction graphs of several `basic_dnn.BasicDNN` instances that share the same input
+layout into a single compiled function, so that each mini-batch is read once and evaluated by one Theano call:
+
+>>> ens = ensemble.EnsembleDNN([clf_a, clf_b, clf_c])
+>>> pred_prob = ens.predict(X)[0]
+
+`ProcessEnsemble` runs members that are too large to fuse in separate worker processes. Each member is
+constructed in its worker by a picklable factory function; the data is read and batched once in the parent
+and each mini-batch is sent to all of the workers, which evaluate it in parallel:
+
+>>> with ensemble.ProcessEnsemble([partial(build_clf, 'a.npz'), partial(build_clf, 'b.npz')]) as ens:
+...     pred_prob = ens.predict(X)[0]
+"""
+import threading
+import multiprocessing
+import numpy as np
+import theano
+from batchup import data_source
+
+
+COMBINE_MEAN = 'mean'
+
+
+def _combine_predictions(member_predictions, combine):
+    """
+    Combine the predictions of the members of an ensemble
+
+    :param member_predictions: a list with an entry for each member that is a list of predicted outputs;
+        either NumPy arrays or Theano expressions
+    :param combine: `'mean'` to average each output over the members, or `None` to return the outputs of
+        all members, in member-major order. Integer outputs (e.g. from a classifier in `'argmax'` or `'topk'`
+        prediction mode) cannot be averaged, so require `None`.
+    :return: a list of predicted outputs
+    """
+    if combine == COMBINE_MEAN:
+        n_outputs = len(member_predictions[0])
+        for preds in member_predictions:
+            if len(preds) != n_outputs:
+                raise ValueError('All members must have the same number of outputs to combine them '
+                                 'with \'mean\'')
+            for pred in preds:
+                if np.issubdtype(np.dtype(pred.dtype), np.integer):
+                    raise ValueError('Integer predictions (e.g. from a classifier in \'argmax\' or \'topk\' '
+                                     'prediction mode) cannot be averaged; use combine=None')
+        return [sum(preds[i] for preds in member_predictions) / float(len(member_predictions))
+                for i in range(n_outputs)]
+    elif combine is None:
+        return [pred for preds in member_predictions for pred in preds]
+    else:
+        raise ValueError('combine should be \'mean\' or None, not {}'.format(combine))
+
+
+class EnsembleDNN (object):
+    """
+    An ensemble of `basic_dnn.BasicDNN` instances whose predictions are computed by a single
+    compiled function.
+    """
+    def __init__(self, members, combine=COMBINE_MEAN):
+        """
+        :param members: a list of `basic_dnn.BasicDNN` instances that take the same inputs
+        :param combine: (default='mean') `'mean'` to average each output over the members, or `None` to return
+            the outputs of all members, in member-major order
+        """
+        if len(members) == 0:
+            raise ValueError('An ensemble requires at least one member')
+        n_inputs = len(members[0].input_vars)
+        for member in members:
+            if len(member.input_vars) != n_inputs:
+                raise ValueError('All members of an ensemble must have the same number of inputs')
+
+        self.members = members
+        self.combine = combine
+        self.input_vars = members[0].input_vars
+
+        member_predictions = []
+        prediction_inputs = []
+        for i, member in enumerate(members):
+            preds = member.prediction_exprs
+            if i > 0:
+                # Replace the member's input variables with those of the first member
+                preds = theano.clone(preds, replace=dict(zip(member.input_vars, self.input_vars)))
+            member_predictions.append(preds)
+            prediction_inputs.extend(member.prediction_inputs)
+
+        predictions = _combine_predictions(member_predictions, combine)
+        self._predict_fn_compiled = theano.function(self.input_vars + prediction_inputs, predictions)
+        self._predict_fn_local = threading.local()
+
+    def _thread_predict_fn(self):
+        fn = getattr(self._predict_fn_local, 'fn', None)
+        if fn is None:
+            fn = self._predict_fn_compiled.copy()
+            self._predict_fn_local.fn = fn
+        return fn
+
+    def predict_batch_fn(self, temperature=None):
+        """
+        Get a function that predicts the outputs for a mini-batch. The function may be called concurrently
+        from multiple threads.
+
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`,
+            the temperature of each objective is used
+        :return: a function of the form `fn(*batch_inputs) -> list of arrays`
+        """
+        values = []
+        for member in self.members:
+            values.extend(member._prediction_input_values(temperature=temperature))
+        def predict_batch(*batch):
+            return self._thread_predict_fn()(*(list(batch) + values))
+        return predict_batch
+
+    def predict(self, X, batchsize=500, temperature=None):
+        """
+        Evaluate the ensemble, returning its predictions
+
+        :param X: input data as a data source
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :return: a list of predicted outputs
+        """
+        return data_source.coerce_data_source(X).batch_map_concat(self.predict_batch_fn(temperature=temperature),
+                                                                  batch_size=batchsize)
+
+    def predict_batches(self, X, batchsize=500, temperature=None):
+        """
+        Evaluate the ensemble, yielding its predictions one mini-batch at a time
+
+        :param X: input data as a data source
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :return: an iterator that yields a list of predicted outputs for each mini-batch
+        """
+        predict_fn = self.predict_batch_fn(temperature=temperature)
+        for batch in data_source.coerce_data_source(X).batch_iterator(batchsize):
+            yield predict_fn(*batch)
+
+
+def _ensemble_worker(member_factory, conn):
+    try:
+        member = member_factory()
+    except Exception as e:
+        conn.send(('error', e))
+        return
+    conn.send(('ready', None))
+
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        temperature, batch = msg
+        try:
+            if hasattr(member, 'predict_batch_fn'):
+                preds = member.predict_batch_fn(temperature=temperature)(*batch)
+            else:
+                preds = member(*batch)
+            conn.send(('ok', [np.asarray(p) for p in preds]))
+        except Exception as e:
+            conn.send(('error', e))
+
+
+class ProcessEnsemble (object):
+    """
+    An ensemble whose members are evaluated in parallel in separate worker processes.
+    """
+    def __init__(self, member_factories, combine=COMBINE_MEAN):
+        """
+        :param member_factories: a list of picklable functions of the form `fn() -> member` that construct
+            the members in the worker processes. A member is either a `basic_dnn.BasicDNN` (or any object
+            with a `predict_batch_fn` method) or a function of the form `fn(*batch_inputs) -> list of arrays`,
+            e.g. a `numpy_engine.NumpyNetwork`
+        :param combine: (default='mean') `'mean'` to average each output over the members, or `None` to return
+            the outputs of all members, in member-major order
+        """
+        if len(member_factories) == 0:
+            raise ValueError('An ensemble requires at least one member')
+        self.member_factories = member_factories
+        self.combine = combine
+        self._workers = None
+
+    def start(self):
+        """
+        Start the worker processes and wait for them to construct their members
+        """
+        if self._workers is None:
+            workers = []
+            for factory in self.member_factories:
+                parent_conn, child_conn = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=_ensemble_worker, args=(factory, child_conn))
+                proc.daemon = True
+                proc.start()
+                workers.append((proc, parent_conn))
+            self._workers = workers
+            for proc, conn in workers:
+                status, err = conn.recv()
+                if status == 'error':
+                    self.stop()
+                    raise err
+
+    def stop(self):
+        """
+        Stop the worker processes
+        """
+        if self._workers is not None:
+            for proc, conn in self._workers:
+                try:
+                    conn.send(None)
+                except (IOError, OSError):
+                    pass
+            for proc, conn in self._workers:
+                proc.join()
+                conn.close()
+            self._workers = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def predict_batch_fn(self, temperature=None):
+        """
+        Get a function that predicts the outputs for a mini-batch. The mini-batch is sent to all
+        workers before any results are collected so that the members are evaluated in parallel.
+
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :return: a function of the form `fn(*batch_inputs) -> list of arrays`
+        """
+        def predict_batch(*batch):
+            if self._workers is None:
+                raise RuntimeError('ProcessEnsemble has not been started')
+            for proc, conn in self._workers:
+                conn.send((temperature, list(batch)))
+            member_predictions = []
+            error = None
+            for proc, conn in self._workers:
+                status, result = conn.recv()
+                if status == 'error':
+                    error = result
+                member_predictions.append(result)
+            if error is not None:
+                raise error
+            return _combine_predictions(member_predictions, self.combine)
+        return predict_batch
+
+    def predict(self, X, batchsize=500, temperature=None):
+        """
+        Evaluate the ensemble, returning its predictions
+
+        :param X: input data as a data source
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :return: a list of predicted outputs
+        """
+        return data_source.coerce_data_source(X).batch_map_concat(self.predict_batch_fn(temperature=temperature),
+                                                                  batch_size=batchsize)
+
+    def predict_batches(self, X, batchsize=500, temperature=None):
+        """
+        Evaluate the ensemble, yielding its predictions one mini-batch at a time
+
+        :param X: input data as a data source
+        :param batchsize: the mini-batch size
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :return: an iterator that yields a list of predicted outputs for each mini-batch
+        """
+        predict_fn = self.predict_batch_fn(temperature=temperature)
+        for batch in data_source.coerce_data_source(X).batch_iterator(batchsize):
+            yield predict_fn(*batch)
+
+
+import unittest
+
+class _ScaleMember (object):
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, x):
+        return [x * self.scale]
+
+
+def _scale_member_factory(scale):
+    return _ScaleMember(scale)
+
+
+class Test_ProcessEnsemble (unittest.TestCase):
+    def test_mean(self):
+        from functools import partial
+        X = np.arange(20, dtype=np.float32).reshape((10, 2))
+        ens = ProcessEnsemble([partial(_scale_member_factory, 1.0), partial(_scale_member_factory, 3.0)])
+        with ens:
+            pred = ens.predict([X], batchsize=4)[0]
+        self.assertTrue(np.allclose(pred, X * 2.0))
+
+    def test_combine_integer(self):
+        int_preds = [[np.zeros(2, dtype=np.int32)], [np.ones(2, dtype=np.int32)]]
+        self.assertRaises(ValueError, _combine_predictions, int_preds, COMBINE_MEAN)
+        self.assertEqual(len(_combine_predictions(int_preds, None)), 2)
+        # Symbolic predictions, as combined by `EnsembleDNN`
+        import theano.tensor as T
+        self.assertRaises(ValueError, _combine_predictions, [[T.ivector()], [T.ivector()]], COMBINE_MEAN)
+        self.assertEqual(_combine_predictions([[T.vector()], [T.vector()]], COMBINE_MEAN)[0].ndim, 1)
+
+    def test_combine_none(self):
+        preds = _combine_predictions([[np.zeros(2)], [np.ones(2)]], None)
+        self.assertEqual(len(preds), 2)
+        self.assertTrue((preds[1] == 1).all())
@@ -0,0 +1,218 @@
+"""
+A thread-safe least-recently-used cache for decoded images
+
+`ImageCache` is bounded by number of entries and/or total bytes. It can be shared between extractors
+(e.g. the sub-extractors of a `CacheingNonUniformImageWindowExtractor`) and between threads; images that are
+being loaded by one thread are not loaded again by another. If given a `store_dir`, loaded images are also
+saved there and later loaded from there as memory maps, allowing processes to share them:
+
+>>> cache = image_cache.ImageCache(max_bytes=4 * 1024**3)
+>>> x = cache.get(key, lambda: read_image(path))
+"""
+import os
+import threading
+import collections
+import numpy as np
+
+
+def _nbytes(x):
+    if isinstance(x, (list, tuple)):
+        return sum([a.nbytes for a in x])
+    return x.nbytes
+
+
+class ImageCache (object):
+    """
+    A thread-safe LRU cache mapping keys to NumPy arrays, bounded by number of entries and/or total size in bytes.
+    Values may also be lists of arrays, e.g. an image and its label map, but only arrays can be saved
+    in the store.
+
+    Keys must be hashable; if `store_dir` is used they must be strings that are valid file names, e.g. hex digests.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, store_dir=None):
+        """
+        :param max_entries: [optional] the maximum number of entries
+        :param max_bytes: [optional] the maximum total size of the entries in bytes. The most recently
+            used entry is always retained, even if it exceeds this on its own
+        :param store_dir: [optional] a directory in which loaded arrays are saved as `.npy` files; on a miss the
+            array is memory mapped from there if present, rather than being loaded again
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.store_dir = store_dir
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def nbytes(self):
+        """
+        The total size of the cached arrays in bytes
+        """
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def stats(self):
+        """
+        Get cache statistics
+
+        :return: a dict with the entries `'hits'`, `'misses'`, `'evictions'`, `'entries'` and `'nbytes'`
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'nbytes': self._nbytes}
+
+    def clear(self):
+        """
+        Remove all entries; does not affect the on-disk store
+        """
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def get(self, key, load_fn):
+        """
+        Get the array identified by `key`, loading it with `load_fn` on a miss
+
+        :param key: the key
+        :param load_fn: a function of the form `fn() -> np.array` (or a list of arrays) that loads the array
+        :return: the array
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    # Re-insert to move to the most recently used position
+                    x = self._entries.pop(key)
+                    self._entries[key] = x
+                    self.hits += 1
+                    return x
+                event = self._loading.get(key)
+                if event is None:
+                    # This thread will load it
+                    event = threading.Event()
+                    self._loading[key] = event
+                    self.misses += 1
+                    break
+            # Another thread is loading it; wait and try again
+            event.wait()
+
+        try:
+            x = self._load(key, load_fn)
+            with self._lock:
+                self._insert(key, x)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+        return x
+
+    def _store_path(self, key):
+        return os.path.join(self.store_dir, '{}.npy'.format(key))
+
+    def _load(self, key, load_fn):
+        if self.store_dir is None:
+            return load_fn()
+        path = self._store_path(key)
+        if not os.path.exists(path):
+            x = load_fn()
+            if not isinstance(x, np.ndarray):
+                raise TypeError('Only NumPy arrays can be saved in the store of an ImageCache, not a {}'.format(
+                    type(x)))
+            if not os.path.exists(self.store_dir):
+                try:
+                    os.makedirs(self.store_dir)
+                except OSError:
+                    if not os.path.isdir(self.store_dir):
+                        raise
+            # Save under a temporary name and rename so that other processes never see a partial file
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, x)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                os.remove(tmp_path)
+                if not os.path.exists(path):
+                    raise
+        return np.load(path, mmap_mode='r')
+
+    def _insert(self, key, x):
+        self._entries[key] = x
+        self._nbytes += _nbytes(x)
+        while len(self._entries) > 1 and \
+                ((self.max_entries is not None and len(self._entries) > self.max_entries) or
+                 (self.max_bytes is not None and self._nbytes > self.max_bytes)):
+            _, evicted = self._entries.popitem(last=False)
+            self._nbytes -= _nbytes(evicted)
+            self.evictions += 1
+
+    def __repr__(self):
+        return 'ImageCache(max_entries={}, max_bytes={}, entries={}, nbytes={}, hits={}, misses={})'.format(
+            self.max_entries, self.max_bytes, len(self._entries), self._nbytes, self.hits, self.misses)
+
+
+import unittest
+
+class Test_ImageCache (unittest.TestCase):
+    def test_lru(self):
+        cache = ImageCache(max_entries=2)
+        loads = []
+        def loader(v):
+            def load():
+                loads.append(v)
+                return np.full((4,), v, dtype=np.float32)
+            return load
+        self.assertEqual(cache.get('a', loader(1))[0], 1)
+        cache.get('b', loader(2))
+        # Touch 'a' so that 'b' is evicted
+        cache.get('a', loader(1))
+        cache.get('c', loader(3))
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual(loads, [1, 2, 3])
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3, 'evictions': 1, 'entries': 2, 'nbytes': 32})
+
+    def test_max_bytes(self):
+        cache = ImageCache(max_bytes=100)
+        for i in range(5):
+            cache.get(i, lambda: np.zeros((40,), dtype=np.uint8))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nbytes, 80)
+        # An entry larger than the budget is retained on its own
+        cache.get('big', lambda: np.zeros((200,), dtype=np.uint8))
+        self.assertEqual(len(cache), 1)
+
+    def test_threads(self):
+        cache = ImageCache(max_entries=4)
+        loads = []
+        def load():
+            loads.append(1)
+            return np.zeros((3,))
+        threads = [threading.Thread(target=cache.get, args=('k', load)) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(cache.hits + cache.misses, 8)
+
+    def test_store(self):
+        import shutil, tempfile
+        store_dir = tempfile.mkdtemp()
+        try:
+            ImageCache(store_dir=store_dir).get('k', lambda: np.arange(5))
+            x = ImageCache(store_dir=store_dir).get('k', lambda: None)
+            self.assertTrue(isinstance(x, np.memmap))
+            self.assertTrue((x == np.arange(5)).all())
+        finally:
+            shutil.rmtree(store_dir)
@@ -1,10 +1,363 @@
-import six, collections
+import os, six, collections, hashlib
+import multiprocessing, multiprocessing.pool
 import numpy as np
 import skimage.util
 import skimage.transform
-from britefury_lasagne import tiling_scheme
+from britefury_lasagne import tiling_scheme, image_cache
 
 
+def _window_view(X, tile_shape, writeable=False):
+    # View of `X` of shape (N, C, H, W) or (N, H, W) with shape (N, n_win_y, n_win_x, [C,] tile_h, tile_w) that has
+    # a window at every pixel offset
+    th, tw = tile_shape
+    n_images, height, width = X.shape[0], X.shape[-2], X.shape[-1]
+    s_n, s_y, s_x = X.strides[0], X.strides[-2], X.strides[-1]
+    shape = (n_images, height - th + 1, width - tw + 1) + X.shape[1:-2] + (th, tw)
+    strides = (s_n, s_y, s_x) + X.strides[1:-2] + (s_y, s_x)
+    return np.lib.stride_tricks.as_strided(X, shape=shape, strides=strides, writeable=writeable)
+
+
+def _gather_windows(X, img_i, block_y, block_x, tile_shape, out=None):
+    """
+    Gather windows from a stack of images in a single vectorised operation, by indexing a strided window
+    view of `X` (as generated by `skimage.util.view_as_windows`) with the window co-ordinates.
+
+    :param X: images as an array of shape `(N, C, H, W)`
+    :param img_i: array of shape `(M,)` giving the image index of each window
+    :param block_y: array of shape `(M,)` giving the y-co-ordinate of the top of each window in pixels
+    :param block_x: array of shape `(M,)` giving the x-co-ordinate of the left of each window in pixels
+    :param tile_shape: the window shape `(tile_h, tile_w)`
+    :param out: [optional] an array of shape `(M, C, tile_h, tile_w)` into which the windows are copied
+    :return: the windows as an array of shape `(M, C, tile_h, tile_w)`
+    """
+    windows = _window_view(X, tile_shape)[img_i, block_y, block_x]
+    if out is not None:
+        out[...] = windows
+        return out
+    return windows
+
+
+def _non_overlapping_layers(img_i, block_y, block_x, tile_shape):
+    """
+    Partition windows into layers within which no two windows overlap, so that each layer can be
+    accumulated with a single buffered `+=`.
+
+    Windows are binned into tile-sized cells; windows in cells whose row and column parities match cannot
+    overlap unless they are in the same cell, so they are separated by their rank within the cell.
+
+    :return: an array of shape `(M,)` giving the layer of each window
+    """
+    cell_y = block_y // tile_shape[0]
+    cell_x = block_x // tile_shape[1]
+    cell = (img_i * (cell_y.max() + 1) + cell_y) * (cell_x.max() + 1) + cell_x
+    order = np.argsort(cell, kind='stable')
+    sorted_cell = cell[order]
+    run_start = np.append([0], np.flatnonzero(np.diff(sorted_cell)) + 1)
+    run_len = np.diff(np.append(run_start, [len(cell)]))
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(cell)) - np.repeat(run_start, run_len)
+    return (rank * 2 + cell_y % 2) * 2 + cell_x % 2
+
+
+def _scatter_windows(X, img_i, block_y, block_x, windows, accumulate=False):
+    """
+    Write windows into a stack of images by indexing a writeable strided window view of `X`;
+    the counterpart of `_gather_windows`.
+
+    :param X: images as an array of shape `(N, C, H, W)` or `(N, H, W)`
+    :param img_i: array of shape `(M,)` giving the image index of each window
+    :param block_y: array of shape `(M,)` giving the y-co-ordinate of the top of each window in pixels
+    :param block_x: array of shape `(M,)` giving the x-co-ordinate of the left of each window in pixels
+    :param windows: an array of shape `(M, C, tile_h, tile_w)` or `(M, tile_h, tile_w)`, or an array that
+        broadcasts to it
+    :param accumulate: if True, windows are added to `X`, otherwise they overwrite it
+    """
+    view = _window_view(X, np.shape(windows)[-2:], writeable=True)
+    if not accumulate:
+        # Where windows overlap, which one wins is not defined
+        view[img_i, block_y, block_x] = windows
+    else:
+        # A buffered `+=` applies only one update to each element, so overlapping windows must be
+        # accumulated in separate steps
+        windows = np.broadcast_to(windows, (len(img_i),) + view.shape[3:])
+        layers = _non_overlapping_layers(img_i, block_y, block_x, view.shape[-2:])
+        for layer in np.unique(layers):
+            sel = layers == layer
+            view[img_i[sel], block_y[sel], block_x[sel]] += windows[sel]
+
+
+WORKERS_THREAD = 'thread'
+WORKERS_PROCESS = 'process'
+
+DOWNSAMPLE_MEAN = 'mean'
+DOWNSAMPLE_NEAREST = 'nearest'
+
+BLEND_MEAN = 'mean'
+BLEND_GAUSSIAN = 'gaussian'
+BLEND_LINEAR = 'linear'
+
+
+def blend_weights(tile_shape, blend, gaussian_sigma=0.125):
+    """
+    Compute the per-pixel weights with which windows are accumulated by an `ImageWindowAssembler`
+
+    :param tile_shape: the shape of a window `(tile_h, tile_w)`
+    :param blend: `'mean'` for uniform weights, `'gaussian'` for weights that fall off with a Gaussian profile
+        from the centre of the window or `'linear'` for weights that fall off linearly towards the edges
+    :param gaussian_sigma: (default=0.125) the standard deviation of the Gaussian as a fraction of the tile size
+    :return: an array of shape `tile_shape`, with a maximum of 1
+    """
+    profiles = []
+    for n in tile_shape:
+        # Distance of pixel centres from the centre of the window
+        d = np.arange(n) + 0.5 - n * 0.5
+        if blend == BLEND_MEAN:
+            p = np.ones((n,))
+        elif blend == BLEND_GAUSSIAN:
+            p = np.exp(-0.5 * (d / (n * gaussian_sigma)) ** 2)
+        elif blend == BLEND_LINEAR:
+            # Edge pixels retain a non-zero weight so that image borders covered by a single window are defined
+            p = 1.0 - np.abs(d) / (n * 0.5)
+        else:
+            raise ValueError('blend should be \'{}\', \'{}\' or \'{}\', not {}'.format(
+                BLEND_MEAN, BLEND_GAUSSIAN, BLEND_LINEAR, blend))
+        profiles.append(p / p.max())
+    return (profiles[0][:, None] * profiles[1][None, :]).astype(np.float32)
+
+
+def _downsample_nearest(x, downsample):
+    # Select the pixel at the centre of each block, matching the output shape of `downscale_local_mean`
+    for axis, f in enumerate(downsample):
+        n = -(-x.shape[axis] // f)
+        x = np.take(x, np.minimum(np.arange(n) * f + f // 2, x.shape[axis] - 1), axis=axis)
+    return x
+
+
+def _window_clusters(block_y, block_x, tile_shape):
+    """
+    Split windows into clusters, such that windows in different clusters are separated by a gap larger
+    than a window along one of the axes, so that the bounding box of each cluster is not much larger than the
+    area covered by its windows
+
+    :return: a list of index arrays, one per cluster
+    """
+    clusters = []
+    pending = [np.arange(len(block_y))]
+    while len(pending) > 0:
+        ndx = pending.pop()
+        for coords, t in ((block_y, tile_shape[0]), (block_x, tile_shape[1])):
+            order = np.argsort(coords[ndx], kind='stable')
+            gaps = np.flatnonzero(np.diff(coords[ndx][order]) > t * 2)
+            if len(gaps) > 0:
+                pending.extend(np.split(ndx[order], gaps + 1))
+                break
+        else:
+            clusters.append(ndx)
+    return clusters
+
+
+def pad_index_map(v, length, pad_mode):
+    """
+    Map co-ordinates along an axis of a padded array to co-ordinates in the un-padded array, following the
+    padding modes of `np.pad`
+
+    :param v: integer co-ordinates relative to the start of the un-padded array; may be negative or `>= length`
+    :param length: the length of the un-padded array along the axis
+    :param pad_mode: `'reflect'`, `'symmetric'`, `'edge'`, `'wrap'` or `'constant'` (zero padding)
+    :return: `(index, valid)` where `index` are co-ordinates in the range `[0, length)` and `valid` is a boolean
+        array that is `False` for co-ordinates whose value is the padding constant
+    """
+    v = np.asarray(v)
+    valid = np.ones(v.shape, dtype=bool)
+    if pad_mode == 'reflect':
+        if length == 1:
+            index = np.zeros_like(v)
+        else:
+            period = 2 * length - 2
+            index = v % period
+            index = np.where(index >= length, period - index, index)
+    elif pad_mode == 'symmetric':
+        index = v % (2 * length)
+        index = np.where(index >= length, 2 * length - 1 - index, index)
+    elif pad_mode == 'edge':
+        index = np.clip(v, 0, length - 1)
+    elif pad_mode == 'wrap':
+        index = v % length
+    elif pad_mode == 'constant':
+        valid = (v >= 0) & (v < length)
+        index = np.clip(v, 0, length - 1)
+    else:
+        raise ValueError('Padding mode {} is not supported by region reads'.format(pad_mode))
+    return index, valid
+
+
+def _preprocess_image(x, extract_tiling, pad_mode, downsample, downsample_mode=DOWNSAMPLE_MEAN):
+    """
+    Apply the cropping, padding and downsampling described by a tiling scheme to an image and move
+    its channel axis to the front
+
+    :param x: the image as an array of shape `(H, W)` or `(H, W, C)`
+    :param extract_tiling: the `tiling_scheme.DataTilingScheme` that describes the cropping and padding
+    :param pad_mode: the padding mode
+    :param downsample: the downsampling factor or `None`
+    :param downsample_mode: (default='mean') `'mean'` to average each block of pixels, or `'nearest'` to select
+        the pixel at its centre, e.g. for label maps
+    :return: the image as an array of shape `(C, H, W)`
+    """
+    # Apply padding and cropping
+    cropping = extract_tiling.cropping_as_slices
+    if cropping is not None:
+        x = x[cropping[0], cropping[1]]
+    padding = extract_tiling.padding
+    if padding is not None:
+        if len(x.shape) == 3:
+            padding.append((0, 0))
+        x = skimage.util.pad(x, padding, mode=pad_mode)
+
+    if downsample is not None:
+        if downsample_mode == DOWNSAMPLE_MEAN:
+            if len(x.shape) > 2:
+                ds = downsample + (1,) * (len(x.shape)-2)
+            else:
+                ds = downsample
+            x = skimage.transform.downscale_local_mean(x, ds)
+        elif downsample_mode == DOWNSAMPLE_NEAREST:
+            x = _downsample_nearest(x, downsample)
+        else:
+            raise ValueError('downsample_mode should be \'mean\' or \'nearest\', not {}'.format(downsample_mode))
+
+    if len(x.shape) == 2:
+        x = x[None,:,:]
+    else:
+        x = np.rollaxis(x, 2, 0)
+    return x
+
+
+def _read_and_preprocess_image(image_read_fn, image, input_img_shape, extract_tiling, pad_mode, downsample):
+    x = image_read_fn(image)
+    assert x.shape[:2] == input_img_shape
+    return _preprocess_image(x, extract_tiling, pad_mode, downsample)
+
+
+def _read_and_preprocess_image_task(task):
+    # Process pool task; writes the image directly into the memory mapped store at `dest_path` if given,
+    # otherwise returns it to the parent process
+    index, dest_path, args = task
+    x = _read_and_preprocess_image(*args)
+    if dest_path is not None:
+        X = np.load(dest_path, mmap_mode='r+')
+        X[index] = x
+        X.flush()
+        return None
+    return x
+
+
+def _parallel_imap(fn, items, workers=None, worker_type=WORKERS_THREAD):
+    """
+    Apply `fn` to each of `items`, yielding the results in order
+
+    :param fn: the function; must be picklable if `worker_type` is `'process'`
+    :param items: the items
+    :param workers: [optional] the number of workers; if `None` `fn` is applied serially in the calling thread
+    :param worker_type: (default='thread') `'thread'` to use a thread pool or `'process'` to use a process pool
+    :return: an iterator that yields the results
+    """
+    if workers is None:
+        for item in items:
+            yield fn(item)
+    else:
+        if worker_type == WORKERS_THREAD:
+            pool = multiprocessing.pool.ThreadPool(workers)
+        elif worker_type == WORKERS_PROCESS:
+            pool = multiprocessing.Pool(workers)
+        else:
+            raise ValueError('worker_type should be \'thread\' or \'process\', not {}'.format(worker_type))
+        try:
+            for result in pool.imap(fn, items):
+                yield result
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+
+
+def locality_aware_shuffle(image_indices, pool_size, shuffle_rng):
+    """
+    Shuffle samples (e.g. windows) drawn from a set of images in an order that visits the images in a random
+    order, drawing samples at random from a pool of about `pool_size` images at a time. Each image's samples
+    are spread over a span of the order during which about `pool_size` other images are also in use, so
+    a cache that holds a little more than `pool_size` images will rarely miss.
+
+    Each sample is given the key `image_rank + pool_size * u` where `image_rank` is the position of its image
+    in a random permutation of the images and `u ~ U(0,1)`; the samples are sorted by key.
+
+    :param image_indices: an array of shape `(N,)` giving the image index of each sample
+    :param pool_size: the number of images from which samples are drawn at any point
+    :param shuffle_rng: a `np.random.RandomState` used to generate the order
+    :return: a permutation of the samples as an index array of shape `(N,)`
+    """
+    image_indices = np.asarray(image_indices)
+    if len(image_indices) == 0:
+        return np.zeros((0,), dtype=int)
+    image_rank = shuffle_rng.permutation(image_indices.max() + 1)
+    keys = image_rank[image_indices] + pool_size * shuffle_rng.uniform(0.0, 1.0, size=image_indices.shape)
+    return np.argsort(keys)
+
+
+def random_pixel_coords(n, n_y, n_x, rng, image_weights=None):
+    """
+    Draw window co-ordinates uniformly at random
+
+    :param n: the number of windows
+    :param n_y: an array of shape `(N_images,)` giving the number of valid y-offsets in each image
+    :param n_x: an array of shape `(N_images,)` giving the number of valid x-offsets in each image
+    :param rng: a `np.random.RandomState`
+    :param image_weights: [optional] an array of shape `(N_images,)` giving the relative probability
+        of drawing windows from each image; if `None`, images are drawn with equal probability
+    :return: `(img_i, block_y, block_x)`, arrays of shape `(n,)`
+    """
+    n_images = len(n_y)
+    if image_weights is not None:
+        image_weights = np.asarray(image_weights, dtype=float)
+        if image_weights.shape != (n_images,):
+            raise ValueError('image_weights should have shape {}, not {}'.format((n_images,), image_weights.shape))
+        img_i = rng.choice(n_images, size=(n,), p=image_weights / image_weights.sum())
+    else:
+        img_i = rng.randint(0, n_images, size=(n,))
+    block_y = np.floor(rng.uniform(0.0, 1.0, size=(n,)) * n_y[img_i]).astype(int)
+    block_x = np.floor(rng.uniform(0.0, 1.0, size=(n,)) * n_x[img_i]).astype(int)
+    return img_i, block_y, block_x
+
+
+def _image_key_part(image):
+    if isinstance(image, six.string_types):
+        return 'path:{}'.format(image)
+    elif isinstance(image, np.ndarray):
+        return 'array:{}:{}:{}'.format(image.shape, image.dtype,
+                                       hashlib.sha1(np.ascontiguousarray(image).view(np.uint8)).hexdigest())
+    else:
+        return 'repr:{!r}'.format(image)
+
+
+def preprocessed_store_key(images, tiling, pad_mode, downsample, dtype):
+    """
+    Compute the key that identifies the preprocessed images of an `ImageWindowExtractor` in an on-disk store
+
+    :param images: the list of images; paths are identified by their path, NumPy arrays by a hash of their
+        contents and other objects by their `repr`
+    :param tiling: the `tiling_scheme.DataTilingScheme` that describes the cropping and padding applied
+    :param pad_mode: the padding mode
+    :param downsample: the downsampling factor or `None`
+    :param dtype: the data type of the preprocessed images
+    :return: the key as a hex digest string
+    """
+    h = hashlib.sha1()
+    for image in images:
+        h.update(_image_key_part(image).encode('utf-8'))
+        h.update(b'\0')
+    h.update('{!r}|{}|{}|{}'.format(tiling, pad_mode, downsample, np.dtype(dtype).str).encode('utf-8'))
+    return h.hexdigest()
+
 
 class AbstractImageWindowExtractor (object):
     """
@@ -31,7 +384,7 @@ class AbstractImageWindowExtractor (object):
         self.image_read_fn = image_read_fn
         self.postprocess_fn = postprocess_fn
         self.N_images = len(images)
-        img0 = self.image_read_fn(images[0])
+        img0 = self._read_first_image(images[0])
         self.input_img_shape = img0.shape[:2]
 
         self.tiling_scheme = tiling
@@ -60,15 +413,24 @@ class AbstractImageWindowExtractor (object):
 
         self.shape = (self.N, self.n_channels) + self.tiling.tile_shape
 
+        # If not `None`, `batch_iterator` shuffles using `locality_aware_shuffle` with this pool size
+        self.shuffle_pool_size = None
+
+
 
+    def _read_first_image(self, image):
+        # Read the first image, from which the image shape, number of channels and data type are determined
+        return self.image_read_fn(image)
 
-    def assembler(self, image_n_channels=None, n_images=None, upsample_order=0, pad_mode='reflect', img_dtype=None):
+    def assembler(self, image_n_channels=None, n_images=None, upsample_order=0, pad_mode='reflect', img_dtype=None,
+                  blend=None):
         image_n_channels = image_n_channels or self.n_channels
         n_images = n_images or self.N_images
         img_dtype = img_dtype or self.dtype
         return ImageWindowAssembler(image_shape=self.input_img_shape, image_n_channels=image_n_channels,
                                     n_images=n_images, tiling=self.tiling_scheme, upsample=self.downsample,
-                                    upsample_order=upsample_order, pad_mode=pad_mode, img_dtype=img_dtype)
+                                    upsample_order=upsample_order, pad_mode=pad_mode, img_dtype=img_dtype,
+                                    blend=blend)
 
 
     def window_indices_to_coords(self, indices):
@@ -82,25 +444,74 @@ class AbstractImageWindowExtractor (object):
         windows = self.get_windows_by_separate_coords(np.array([img_i]), np.array([window_y]), np.array([window_x]))
         return windows[0,...]
 
-    def get_windows(self, indices):
+    def get_windows(self, indices, out=None):
         if not isinstance(indices, np.ndarray):
             raise TypeError('indices must be a NumPy integer array, not a {}'.format(type(indices)))
         img_i, window_y, window_x = self.window_indices_to_coords(indices)
-        windows = self.get_windows_by_separate_coords(img_i, window_y, window_x)
+        windows = self.get_windows_by_separate_coords(img_i, window_y, window_x, out=out)
         return windows
 
-    def get_windows_by_separate_coords(self, img_i, window_y, window_x):
+    def get_windows_by_separate_coords(self, img_i, window_y, window_x, out=None):
+        """
+        img_i - array of shape (N) providing image indices
+        window_y - array of shape (N) providing window y-co-ordinate in the tiling grid
+        window_x - array of shape (N) providing window x-co-ordinate in the tiling grid
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written; if `postprocess_fn`
+            was given, its result is returned instead
+        """
+        block_y = window_y * self.tiling.step_shape[0]
+        block_x = window_x * self.tiling.step_shape[1]
+        return self.get_windows_by_pixel_coords(img_i, block_y, block_x, out=out)
+
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x, out=None):
+        """
+        Extract windows at arbitrary pixel offsets rather than on the tiling grid
+
+        img_i - array of shape (N) providing image indices
+        block_y - array of shape (N) providing the y-co-ordinate of the top of each window in the preprocessed
+            (cropped, padded and downsampled) image, in the range `[0, img_shape[0] - tile_shape[0]]`
+        block_x - array of shape (N) providing the x-co-ordinate of the left of each window, in the range
+            `[0, img_shape[1] - tile_shape[1]]`
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written; if `postprocess_fn`
+            was given, its result is returned instead
+        """
         raise NotImplementedError('Abstract for type {}'.format(type(self)))
 
+    def image_offset_ranges(self):
+        """
+        Get the number of valid window offsets along each axis of each image, for use with
+        `get_windows_by_pixel_coords`
+
+        :return: `(n_y, n_x)`, arrays of shape `(N_images,)`
+        """
+        n_y = self.img_shape[0] - self.tiling.tile_shape[0] + 1
+        n_x = self.img_shape[1] - self.tiling.tile_shape[1] + 1
+        return np.full((self.N_images,), n_y, dtype=int), np.full((self.N_images,), n_x, dtype=int)
 
-    def get_windows_by_coords(self, coords):
+    def random_pixel_coords(self, n, rng, image_weights=None):
+        """
+        Draw window co-ordinates uniformly at random from the valid pixel offsets, for use with
+        `get_windows_by_pixel_coords`
+
+        :param n: the number of windows
+        :param rng: a `np.random.RandomState`
+        :param image_weights: [optional] an array of shape `(N_images,)` giving the relative probability
+            of drawing windows from each image; if `None`, images are drawn with equal probability
+        :return: `(img_i, block_y, block_x)`, arrays of shape `(n,)`
+        """
+        n_y, n_x = self.image_offset_ranges()
+        return random_pixel_coords(n, n_y, n_x, rng, image_weights=image_weights)
+
+
+    def get_windows_by_coords(self, coords, out=None):
         """
         coords - array of shape (N,3) where each row is (image_index, block_y, block_x)
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written
         """
         window_x = coords[:,2]
         window_y = coords[:,1]
         img_i = coords[:,0]
-        return self.get_windows_by_separate_coords(img_i, window_y, window_x)
+        return self.get_windows_by_separate_coords(img_i, window_y, window_x, out=out)
 
 
     def __len__(self):
@@ -120,7 +531,7 @@ class AbstractImageWindowExtractor (object):
             n_x = len(window_x)
             n_y = len(window_y)
             n_i = len(img_i)
-            window_x = np.tile(window_x, (n_x * n_i,))
+            window_x = np.tile(window_x, (n_y * n_i,))
             window_y = np.tile(np.repeat(window_y, n_x, axis=0), (n_i,))
             img_i = np.repeat(img_i, n_x * n_y, axis=0)
             return self.get_windows_by_separate_coords(img_i, window_y, window_x)
@@ -137,20 +548,29 @@ class AbstractImageWindowExtractor (object):
 
 
 
+    def _shuffled_indices(self, shuffle_rng):
+        indices = np.arange(self.N)
+        if shuffle_rng is not None:
+            if self.shuffle_pool_size is not None:
+                img_i = self.window_indices_to_coords(indices)[0]
+                indices = locality_aware_shuffle(img_i, self.shuffle_pool_size, shuffle_rng)
+            else:
+                shuffle_rng.shuffle(indices)
+        return indices
+
     def batch_iterator(self, batchsize, shuffle_rng=None):
         """
         Please note that this method will extract windows from one set of images. This is often not too useful
-        as you frequently need more than one e.g. an input set and a target set. For this, see the
-        `ImageWindowExtractor.multiplexed_minibatch_iterator` method.
+        as you frequently need more than one e.g. an input set and a target set. For this, see
+        `MultiSourceImageWindowExtractor`.
 
         :param batchsize: the mini-batch size
         :param shuffle_rng: [optional] a random number generator used to shuffle the order in which image windows
-        are extracted
+        are extracted. If `self.shuffle_pool_size` is not `None` the windows are shuffled by
+        `locality_aware_shuffle`, otherwise uniformly.
         :return: an iterator that yields mini-batch lists of the form `[batch_of_windows]`
         """
-        indices = np.arange(self.N)
-        if shuffle_rng is not None:
-            shuffle_rng.shuffle(indices)
+        indices = self._shuffled_indices(shuffle_rng)
         for start_idx in range(0, self.N, batchsize):
             yield [self.get_windows(indices[start_idx:start_idx + batchsize])]
 
@@ -167,7 +587,8 @@ class ImageWindowExtractor (AbstractImageWindowExtractor):
     Is index-able and has a `batch_iterator` method so can be passed as a dataset to
     `batch.batch_iterator`, `Trainer.train`, etc.
     """
-    def __init__(self, images, image_read_fn, tiling, pad_mode='reflect', downsample=None, postprocess_fn=None):
+    def __init__(self, images, image_read_fn, tiling, pad_mode='reflect', downsample=None, postprocess_fn=None,
+                 store_dir=None, workers=None, worker_type=WORKERS_THREAD):
         """
 
         :param images: a list of images to read; these can be paths, IDs, objects
@@ -177,51 +598,90 @@ class ImageWindowExtractor (AbstractImageWindowExtractor):
         :param postprocess_fn: [optional] a post processing function of the form
         `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
         to the extracted data
+        :param store_dir: [optional] a directory in which the preprocessed (cropped, padded and downsampled) images
+        are stored as a `.npy` file that is memory mapped (read-only) into `self.X`. The file is keyed on the
+        image list, tiling, `pad_mode`, `downsample` and data type (see `preprocessed_store_key`), so later
+        constructions and other processes that use the same images attach to it rather than reading them again,
+        and share its pages. `image_read_fn` is assumed to be deterministic.
+        :param workers: [optional] the number of workers used to read and preprocess the images in parallel;
+        if `None` they are read serially
+        :param worker_type: (default='thread') `'thread'` for a thread pool, suitable for readers and
+        preprocessing that release the GIL, or `'process'` for a process pool, in which case `image_read_fn`
+        must be picklable. Process workers write directly into the memory mapped store if `store_dir` is given.
         """
+        self.workers = workers
+        self.worker_type = worker_type
         super(ImageWindowExtractor, self).__init__(images, image_read_fn, tiling, pad_mode=pad_mode,
                                                    downsample=downsample, postprocess_fn=postprocess_fn)
 
-        self.X = np.zeros((self.N_images, self.n_channels) + self.img_shape, dtype=self.dtype)
-        for i, img in enumerate(images):
-            x = self.image_read_fn(img)
-            assert x.shape[:2] == self.input_img_shape
+        X_shape = (self.N_images, self.n_channels) + self.img_shape
+        self.store_path = None
+        if store_dir is not None:
+            key = preprocessed_store_key(images, self._extract_tiling, pad_mode, downsample, self.dtype)
+            self.store_path = os.path.join(store_dir, 'images_{}.npy'.format(key))
+            if not os.path.exists(self.store_path):
+                if not os.path.exists(store_dir):
+                    try:
+                        os.makedirs(store_dir)
+                    except OSError:
+                        # Another process may have created it
+                        if not os.path.isdir(store_dir):
+                            raise
+                # Write to a temporary file that is renamed once complete, so that other processes never
+                # attach to a partially written store
+                tmp_path = '{}.{}.tmp'.format(self.store_path, os.getpid())
+                X = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=X_shape)
+                self._read_images(images, X, dest_path=tmp_path)
+                X.flush()
+                del X
+                try:
+                    os.rename(tmp_path, self.store_path)
+                except OSError:
+                    # On Windows renaming fails if another process has already created the store
+                    os.remove(tmp_path)
+                    if not os.path.exists(self.store_path):
+                        raise
+            self.X = np.load(self.store_path, mmap_mode='r')
+            if self.X.shape != X_shape or self.X.dtype != self.dtype:
+                raise ValueError('Preprocessed image store {} has shape {} and dtype {}; expected {} and {}'.format(
+                    self.store_path, self.X.shape, self.X.dtype, X_shape, self.dtype))
+        else:
+            self.X = np.zeros(X_shape, dtype=self.dtype)
+            self._read_images(images, self.X)
 
-            # Apply padding and cropping
-            cropping = self._extract_tiling.cropping_as_slices
-            if cropping is not None:
-                x = x[cropping[0], cropping[1]]
-            padding = self._extract_tiling.padding
-            if padding is not None:
-                if len(x.shape) == 3:
-                    padding.append((0, 0))
-                x = skimage.util.pad(x, padding, mode=pad_mode)
-
-            if downsample is not None:
-                if len(x.shape) > 2:
-                    ds = downsample + (1,) * (len(x.shape)-2)
-                else:
-                    ds = downsample
-                x = skimage.transform.downscale_local_mean(x, ds)
-
-            if len(x.shape) == 2:
-                x = x[None,:,:]
-            else:
-                x = np.rollaxis(x, 2, 0)
-            self.X[i,:,:,:] = x
+    def _read_images(self, images, X, dest_path=None):
+        """
+        Read and preprocess `images` into `X`, in parallel if `self.workers` is not `None`
 
-    def get_windows_by_separate_coords(self, img_i, window_y, window_x):
+        :param images: the images
+        :param X: the destination array of shape `(N, C, H, W)`
+        :param dest_path: [optional] the path of the `.npy` file that `X` memory maps, if any
+        """
+        if self.workers is not None and self.worker_type == WORKERS_PROCESS:
+            tasks = [(i, dest_path, (self.image_read_fn, img, self.input_img_shape, self._extract_tiling,
+                                     self.pad_mode, self.downsample))
+                     for i, img in enumerate(images)]
+            for i, x in enumerate(_parallel_imap(_read_and_preprocess_image_task, tasks, workers=self.workers,
+                                                 worker_type=WORKERS_PROCESS)):
+                if x is not None:
+                    X[i,:,:,:] = x
+        else:
+            def read_image(i):
+                X[i,:,:,:] = _read_and_preprocess_image(self.image_read_fn, images[i], self.input_img_shape,
+                                                        self._extract_tiling, self.pad_mode, self.downsample)
+            for _ in _parallel_imap(read_image, range(len(images)), workers=self.workers,
+                                    worker_type=self.worker_type):
+                pass
+
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x, out=None):
         """
         img_i - array of shape (N) providing image indices
-        block_y - array of shape (N) providing block y-co-ordinate
-        block_x - array of shape (N) providing block x-co-ordinate
+        block_y - array of shape (N) providing pixel y-co-ordinate in the preprocessed image
+        block_x - array of shape (N) providing pixel x-co-ordinate in the preprocessed image
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written; if `postprocess_fn`
+            was given, its result is returned instead
         """
-        block_y = window_y * self.tiling.step_shape[0]
-        block_x = window_x * self.tiling.step_shape[1]
-        windows = np.zeros((img_i.shape[0], self.n_channels) + self.tiling.tile_shape, dtype=self.dtype)
-        for i in xrange(img_i.shape[0]):
-            win = self.X[img_i[i], :, block_y[i]:block_y[i]+self.tiling.tile_shape[0],
-                  block_x[i]:block_x[i]+self.tiling.tile_shape[1]]
-            windows[i,:,:,:] = win
+        windows = _gather_windows(self.X, img_i, block_y, block_x, self.tiling.tile_shape, out=out)
         if self.postprocess_fn is not None:
             windows = self.postprocess_fn(windows)
         return windows
@@ -235,92 +695,432 @@ class CacheingImageWindowExtractor (AbstractImageWindowExtractor):
     `batch.batch_iterator`, `Trainer.train`, etc.
     """
     def __init__(self, images, image_read_fn, tiling, cache_size, cache=None,
-                 pad_mode='reflect', downsample=None, postprocess_fn=None):
+                 pad_mode='reflect', downsample=None, postprocess_fn=None, cache_bytes=None, shuffle_pool_size=None):
         """
 
         :param images: a list of images to read; these can be paths, IDs, objects
         :param image_read_fn: an image reader function of the form `fn(image) -> np.array[H,W,C]`
         :param tiling: a `tiling_scheme.TilingScheme` instance that describes how windows are to be extracted
         `from the data
+        :param cache_size: the maximum number of preprocessed images held in the cache; `None` for no limit.
+        Ignored if `cache` is given
+        :param cache: [optional] an `image_cache.ImageCache` to use; pass the same cache to several extractors
+        to share it between them
         :param postprocess_fn: [optional] a post processing function of the form
         `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
         to the extracted data
+        :param cache_bytes: [optional] the maximum total size in bytes of the preprocessed images held in the cache.
+        Ignored if `cache` is given
+        :param shuffle_pool_size: [optional] if given, `batch_iterator` shuffles windows with
+        `locality_aware_shuffle`, drawing them from a pool of this many images at a time so that almost all
+        windows are extracted from cached images. Should be somewhat smaller than the number of images the
+        cache can hold; if `None` windows are shuffled uniformly, which causes frequent cache misses.
         """
         super(CacheingImageWindowExtractor, self).__init__(images, image_read_fn, tiling, pad_mode=pad_mode,
                                                    downsample=downsample, postprocess_fn=postprocess_fn)
+        self.shuffle_pool_size = shuffle_pool_size
 
         if cache is None:
-            cache = collections.OrderedDict()
+            cache = image_cache.ImageCache(max_entries=cache_size, max_bytes=cache_bytes)
+        elif not isinstance(cache, image_cache.ImageCache):
+            raise TypeError('cache should be an image_cache.ImageCache, not a {}'.format(type(cache)))
         self.cache = cache
         self.cache_size = cache_size
 
+        # Cache keys identify the image and its preprocessing, so they remain valid when the cache is shared
+        # between extractors or, via its store, between processes
+        self._cache_keys = [preprocessed_store_key([img], self._extract_tiling, pad_mode, downsample, self.dtype)
+                            for img in images]
+
 
     def _read_image(self, img):
-        x = self.image_read_fn(img)
-        assert x.shape[:2] == self.input_img_shape
+        return _read_and_preprocess_image(self.image_read_fn, img, self.input_img_shape, self._extract_tiling,
+                                          self.pad_mode, self.downsample)
 
-        # Apply padding and cropping
-        cropping = self._extract_tiling.cropping_as_slices
-        if cropping is not None:
-            x = x[cropping[0], cropping[1]]
-        padding = self._extract_tiling.padding
-        if padding is not None:
-            if len(x.shape) == 3:
-                padding.append((0, 0))
-            x = skimage.util.pad(x, padding, mode=self.pad_mode)
+    def _get_cached_image(self, img_i):
+        img = self.images[img_i]
+        return self.cache.get(self._cache_keys[img_i], lambda: self._read_image(img))
 
-        if self.downsample is not None:
-            if len(x.shape) > 2:
-                ds = self.downsample + (1,) * (len(x.shape)-2)
-            else:
-                ds = self.downsample
-            x = skimage.transform.downscale_local_mean(x, ds)
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x, out=None):
+        """
+        img_i - array of shape (N) providing image indices
+        block_y - array of shape (N) providing pixel y-co-ordinate in the preprocessed image
+        block_x - array of shape (N) providing pixel x-co-ordinate in the preprocessed image
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written; if `postprocess_fn`
+            was given, its result is returned instead
+        """
+        img_i = np.asarray(img_i)
+        block_y = np.asarray(block_y)
+        block_x = np.asarray(block_x)
+        if out is None:
+            out = np.empty((img_i.shape[0], self.n_channels) + self.tiling.tile_shape, dtype=self.dtype)
+        windows = out
+        # Fetch each image from the cache once and gather all of its windows in one operation
+        for u in np.unique(img_i):
+            x = self._get_cached_image(u)
+            sel = img_i == u
+            windows[sel] = _gather_windows(x[None, ...], np.zeros((sel.sum(),), dtype=int), block_y[sel],
+                                           block_x[sel], self.tiling.tile_shape)
+        if self.postprocess_fn is not None:
+            windows = self.postprocess_fn(windows)
+        return windows
+
+
+class MultiSourceImageWindowExtractor (AbstractImageWindowExtractor):
+    """
+    Extracts aligned windows from groups of images, e.g. an input image, a label map and a mask, according to
+    a tiling scheme. Each group is read by a single call to `image_read_fn` and cached as a unit,
+    and the windows for all sources are extracted at the same co-ordinates.
+
+    Windows are returned as a list with an entry for each source, so `batch_iterator` yields aligned
+    mini-batches of the form `[x, y, mask]`.
+    """
+    def __init__(self, images, image_read_fn, tiling, pad_mode='reflect', downsample=None,
+                 downsample_mode=DOWNSAMPLE_MEAN, postprocess_fn=None, cache_size=None, cache=None,
+                 cache_bytes=None, shuffle_pool_size=None):
+        """
+
+        :param images: a list of images to read; these can be paths, IDs, objects
+        :param image_read_fn: a reader function of the form `fn(image) -> [np.array[H,W,C], ...]` that returns
+        a list of arrays, one for each source, all of which have the same height and width
+        :param tiling: a `tiling_scheme.TilingScheme` instance that describes how windows are to be extracted
+        `from the data
+        :param pad_mode: (default='reflect') the padding mode, or a list giving the padding mode for each source,
+        e.g. `['reflect', 'constant', 'constant']`
+        :param downsample: [optional] the downsampling factor, applied to all sources
+        :param downsample_mode: (default='mean') the downsampling mode (`'mean'` or `'nearest'`), or a list
+        giving the mode for each source; use `'nearest'` for label maps
+        :param postprocess_fn: [optional] a post processing function, or a list with a function (or `None`) for
+        each source, of the form `postprocess_fn(extracted_windows) -> transformed_extracted_windows`
+        :param cache_size: [optional] the maximum number of image groups held in the cache; if `None` and
+        `cache_bytes` is `None`, all image groups are retained once read. Ignored if `cache` is given
+        :param cache: [optional] an `image_cache.ImageCache` to use
+        :param cache_bytes: [optional] the maximum total size in bytes of the image groups held in the cache
+        :param shuffle_pool_size: [optional] if given, `batch_iterator` shuffles windows with
+        `locality_aware_shuffle`, drawing them from a pool of this many images at a time
+        """
+        super(MultiSourceImageWindowExtractor, self).__init__(images, image_read_fn, tiling, pad_mode=pad_mode,
+                                                              downsample=downsample)
+
+        sources0 = self._sources0
+        del self._sources0
+        self.n_sources = len(sources0)
+        self.source_n_channels = [x.shape[2] if len(x.shape) > 2 else 1 for x in sources0]
+        self.source_dtypes = [x.dtype for x in sources0]
+        self.source_pad_modes = self._per_source(pad_mode, 'pad_mode')
+        self.source_downsample_modes = self._per_source(downsample_mode, 'downsample_mode')
+        self.source_postprocess_fns = self._per_source(postprocess_fn, 'postprocess_fn')
+        for x in sources0[1:]:
+            if x.shape[:2] != self.input_img_shape:
+                raise ValueError('All sources should have the same height and width; {} != {}'.format(
+                    x.shape[:2], self.input_img_shape))
+
+        if cache is None:
+            cache = image_cache.ImageCache(max_entries=cache_size, max_bytes=cache_bytes)
+        elif not isinstance(cache, image_cache.ImageCache):
+            raise TypeError('cache should be an image_cache.ImageCache, not a {}'.format(type(cache)))
+        self.cache = cache
+        self.shuffle_pool_size = shuffle_pool_size
+
+        mode_key = '{}|{}'.format(self.source_pad_modes, self.source_downsample_modes)
+        self._cache_keys = [preprocessed_store_key([img], self._extract_tiling, mode_key, downsample, self.dtype)
+                            for img in images]
+
+    def _per_source(self, value, name):
+        if isinstance(value, (list, tuple)):
+            if len(value) != self.n_sources:
+                raise ValueError('{} should have an entry for each of the {} sources, not {}'.format(
+                    name, self.n_sources, len(value)))
+            return list(value)
+        return [value] * self.n_sources
+
+    def _read_first_image(self, image):
+        self._sources0 = [np.asarray(x) for x in self.image_read_fn(image)]
+        return self._sources0[0]
+
+    def _read_image_group(self, img):
+        sources = self.image_read_fn(img)
+        if len(sources) != self.n_sources:
+            raise ValueError('image_read_fn returned {} sources, expected {}'.format(len(sources), self.n_sources))
+        group = []
+        for x, pad_mode, downsample_mode in zip(sources, self.source_pad_modes, self.source_downsample_modes):
+            x = np.asarray(x)
+            assert x.shape[:2] == self.input_img_shape
+            group.append(_preprocess_image(x, self._extract_tiling, pad_mode, self.downsample,
+                                           downsample_mode=downsample_mode))
+        return group
+
+    def _get_cached_image_group(self, img_i):
+        img = self.images[img_i]
+        return self.cache.get(self._cache_keys[img_i], lambda: self._read_image_group(img))
+
+    def get_window(self, index):
+        img_i, window_y, window_x = self.window_indices_to_coords(index)
+        windows = self.get_windows_by_separate_coords(np.array([img_i]), np.array([window_y]), np.array([window_x]))
+        return [w[0,...] for w in windows]
 
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x, out=None):
+        """
+        img_i - array of shape (N) providing image indices
+        block_y - array of shape (N) providing pixel y-co-ordinate in the preprocessed image
+        block_x - array of shape (N) providing pixel x-co-ordinate in the preprocessed image
+        out - [optional] a list of buffers, one per source, each of shape (N,C_source,tile_h,tile_w) into which
+            the windows are written
+
+        Returns a list of window arrays, one per source
+        """
+        img_i = np.asarray(img_i)
+        block_y = np.asarray(block_y)
+        block_x = np.asarray(block_x)
+        if out is None:
+            out = [np.empty((img_i.shape[0], n_channels) + self.tiling.tile_shape, dtype=dtype)
+                   for n_channels, dtype in zip(self.source_n_channels, self.source_dtypes)]
+        elif len(out) != self.n_sources:
+            raise ValueError('out should have a buffer for each of the {} sources, not {}'.format(
+                self.n_sources, len(out)))
+        # Read each image group once and extract the windows for all sources at the same co-ordinates
+        for u in np.unique(img_i):
+            group = self._get_cached_image_group(u)
+            sel = img_i == u
+            zeros = np.zeros((sel.sum(),), dtype=int)
+            for x, windows in zip(group, out):
+                windows[sel] = _gather_windows(x[None, ...], zeros, block_y[sel], block_x[sel],
+                                               self.tiling.tile_shape)
+        return [fn(windows) if fn is not None else windows
+                for windows, fn in zip(out, self.source_postprocess_fns)]
+
+    def batch_iterator(self, batchsize, shuffle_rng=None):
+        """
+        :param batchsize: the mini-batch size
+        :param shuffle_rng: [optional] a random number generator used to shuffle the order in which image windows
+        are extracted. If `self.shuffle_pool_size` is not `None` the windows are shuffled by
+        `locality_aware_shuffle`, otherwise uniformly.
+        :return: an iterator that yields mini-batch lists with an entry for each source, e.g. `[x, y, mask]`
+        """
+        indices = self._shuffled_indices(shuffle_rng)
+        for start_idx in range(0, self.N, batchsize):
+            yield self.get_windows(indices[start_idx:start_idx + batchsize])
+
+
+class RegionImageWindowExtractor (AbstractImageWindowExtractor):
+    """
+    Extracts windows from a list of images that are too large to be read as a whole, e.g. whole-slide or
+    satellite images, using a region reader function that reads a rectangular region of an image.
+
+    Only the rows and columns that a mini-batch of windows needs are read. Images are divided into region tiles
+    that are read and held in an `image_cache.ImageCache`, so neighbouring windows share reads. Padding at
+    image borders is generated by mapping window co-ordinates back into the image (see `pad_index_map`), so the
+    windows are identical to those extracted by `ImageWindowExtractor` from the whole images.
+
+    Is index-able and has a `batch_iterator` method so can be passed as a dataset to
+    `batch.batch_iterator`, `Trainer.train`, etc.
+    """
+    def __init__(self, images, read_region_fn, image_shape_fn, tiling, pad_mode='reflect', downsample=None,
+                 postprocess_fn=None, region_tile_shape=(512, 512), cache_size=256, cache=None, cache_bytes=None,
+                 shuffle_pool_size=None):
+        """
+
+        :param images: a list of images to read; these can be paths, IDs, objects. All images must have the
+        same shape
+        :param read_region_fn: a region reader function of the form `fn(image, y0, x0, h, w) -> np.array[h,w,C]`;
+        it is only asked for regions that lie within the image
+        :param image_shape_fn: an image shape acquisition function of the form `fn(image) -> (height,width,...)`
+        :param tiling: a `tiling_scheme.TilingScheme` instance that describes how windows are to be extracted
+        `from the data
+        :param pad_mode: (default='reflect') `'reflect'`, `'symmetric'`, `'edge'`, `'wrap'` or `'constant'`
+        :param downsample: [optional] the downsampling factor; windows are generated by reading a region that
+        is larger by this factor and averaging each block of pixels
+        :param postprocess_fn: [optional] a post processing function of the form
+        `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
+        to the extracted data
+        :param region_tile_shape: (default=(512, 512)) the shape of the region tiles that are read and cached
+        :param cache_size: (default=256) the maximum number of region tiles held in the cache; `None` for no limit.
+        Ignored if `cache` is given
+        :param cache: [optional] an `image_cache.ImageCache` to use; pass the same cache to several extractors
+        to share it between them
+        :param cache_bytes: [optional] the maximum total size in bytes of the region tiles held in the cache.
+        Ignored if `cache` is given
+        :param shuffle_pool_size: [optional] if given, `batch_iterator` shuffles windows with
+        `locality_aware_shuffle`, drawing them from a pool of this many images at a time
+        """
+        self.image_shape_fn = image_shape_fn
+        self.region_tile_shape = tuple(region_tile_shape)
+        super(RegionImageWindowExtractor, self).__init__(images, read_region_fn, tiling, pad_mode=pad_mode,
+                                                         downsample=downsample, postprocess_fn=postprocess_fn)
+        self.shuffle_pool_size = shuffle_pool_size
+
+        if cache is None:
+            cache = image_cache.ImageCache(max_entries=cache_size, max_bytes=cache_bytes)
+        elif not isinstance(cache, image_cache.ImageCache):
+            raise TypeError('cache should be an image_cache.ImageCache, not a {}'.format(type(cache)))
+        self.cache = cache
+        self.cache_size = cache_size
+
+        self._image_keys = [hashlib.sha1('{}|{}'.format(_image_key_part(img), self.region_tile_shape).encode(
+            'utf-8')).hexdigest() for img in images]
+
+        # The cropping applied to the image and the padding that is applied after it, along each axis
+        self._crop_before = []
+        self._crop_after = []
+        self._pad_before = []
+        for pc in self._extract_tiling.data_pad_or_crop:
+            pc = pc if pc is not None else (0, 0)
+            self._crop_before.append(max(-pc[0], 0))
+            self._crop_after.append(max(-pc[1], 0))
+            self._pad_before.append(max(pc[0], 0))
+
+    def _read_first_image(self, image):
+        # Determine the number of channels and data type by reading a single pixel; the returned array has the
+        # shape of the whole image but only refers to that pixel
+        img_shape = tuple(self.image_shape_fn(image)[:2])
+        px = self._read_region_fn(image, 0, 0, 1, 1)
+        return np.broadcast_to(px, img_shape + px.shape[2:])
+
+    def _read_region_fn(self, image, y0, x0, h, w):
+        x = self.image_read_fn(image, y0, x0, h, w)
+        if x.shape[:2] != (h, w):
+            raise ValueError('read_region_fn returned a region of shape {}; requested ({}, {})'.format(
+                x.shape[:2], h, w))
         if len(x.shape) == 2:
-            x = x[None,:,:]
-        else:
-            x = np.rollaxis(x, 2, 0)
+            x = x[:, :, None]
         return x
 
-    def _get_cached_image(self, img):
-        img_id = id(img)
-        if img_id in self.cache:
-            # Get from the cache and re-insert to maintain LRU order
-            x = self.cache[img_id]
-            del self.cache[img_id]
-            self.cache[img_id] = x
-        else:
-            x = self._read_image(img)
-            self.cache[img_id] = x
-            if len(self.cache) > self.cache_size:
-                keys = self.cache.keys()
-                for key in keys[:-self.cache_size]:
-                    del self.cache[key]
-        return x
+    def read_region(self, img_i, y0, x0, h, w):
+        """
+        Read a region of an image via the region tile cache
+
+        :param img_i: the image index
+        :param y0: the y-co-ordinate of the top of the region
+        :param x0: the x-co-ordinate of the left of the region
+        :param h: the height of the region
+        :param w: the width of the region
+        :return: the region as an array of shape `(h, w, C)`
+        """
+        image = self.images[img_i]
+        img_h, img_w = self.input_img_shape
+        rth, rtw = self.region_tile_shape
+        region = np.empty((h, w, self.n_channels), dtype=self.dtype)
+        for ty in six.moves.range(y0 // rth, (y0 + h - 1) // rth + 1):
+            for tx in six.moves.range(x0 // rtw, (x0 + w - 1) // rtw + 1):
+                ty0, tx0 = ty * rth, tx * rtw
+                key = '{}_{}_{}'.format(self._image_keys[img_i], ty, tx)
+                tile = self.cache.get(key, lambda: self._read_region_fn(image, ty0, tx0, min(rth, img_h - ty0),
+                                                                        min(rtw, img_w - tx0)))
+                # Copy the intersection of the tile and the region
+                sy0, sy1 = max(y0, ty0), min(y0 + h, ty0 + tile.shape[0])
+                sx0, sx1 = max(x0, tx0), min(x0 + w, tx0 + tile.shape[1])
+                region[sy0 - y0:sy1 - y0, sx0 - x0:sx1 - x0] = tile[sy0 - ty0:sy1 - ty0, sx0 - tx0:sx1 - tx0]
+        return region
+
+    def _source_indices(self, axis, u):
+        # Map co-ordinates in the cropped and padded image (prior to downsampling) to co-ordinates in the image
+        length = self.input_img_shape[axis] - self._crop_before[axis] - self._crop_after[axis]
+        index, valid = pad_index_map(u - self._pad_before[axis], length, self.pad_mode)
+        # Downsampling treats pixels beyond the padded image as zero
+        valid &= u < self._extract_tiling.req_data_shape[axis]
+        return index + self._crop_before[axis], valid
+
+    def read_preprocessed_region(self, img_i, y0, x0, h, w):
+        """
+        Read a region of a preprocessed (cropped, padded and downsampled) image, reading only the part of the
+        source image that it covers
+
+        :param img_i: the image index
+        :param y0: the y-co-ordinate of the top of the region in the preprocessed image
+        :param x0: the x-co-ordinate of the left of the region in the preprocessed image
+        :param h: the height of the region
+        :param w: the width of the region
+        :return: the region as an array of shape `(C, h, w)`
+        """
+        fy, fx = self.downsample if self.downsample is not None else (1, 1)
+        rows, row_valid = self._source_indices(0, y0 * fy + np.arange(h * fy))
+        cols, col_valid = self._source_indices(1, x0 * fx + np.arange(w * fx))
+        x = np.zeros((h * fy, w * fx, self.n_channels), dtype=self.dtype)
+        if row_valid.any() and col_valid.any():
+            # Read the bounding box of the rows and columns that are needed; reflected co-ordinates lie within it
+            rows, cols = rows[row_valid], cols[col_valid]
+            y0, x0 = rows.min(), cols.min()
+            region = self.read_region(img_i, y0, x0, rows.max() + 1 - y0, cols.max() + 1 - x0)
+            x[np.ix_(row_valid, col_valid)] = region[np.ix_(rows - y0, cols - x0)]
+        if self.downsample is not None:
+            x = x.reshape((h, fy, w, fx, self.n_channels)).mean(axis=(1, 3)).astype(self.dtype)
+        return x.transpose(2, 0, 1)
 
-    def get_windows_by_separate_coords(self, img_i, window_y, window_x):
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x, out=None):
         """
         img_i - array of shape (N) providing image indices
-        block_y - array of shape (N) providing block y-co-ordinate
-        block_x - array of shape (N) providing block x-co-ordinate
+        block_y - array of shape (N) providing pixel y-co-ordinate in the preprocessed image
+        block_x - array of shape (N) providing pixel x-co-ordinate in the preprocessed image
+        out - [optional] buffer of shape (N,C,tile_h,tile_w) into which the windows are written; if `postprocess_fn`
+            was given, its result is returned instead
         """
-        block_y = window_y * self.tiling.step_shape[0]
-        block_x = window_x * self.tiling.step_shape[1]
-        windows = np.zeros((img_i.shape[0], self.n_channels) + self.tiling.tile_shape, dtype=self.dtype)
-        for i in xrange(img_i.shape[0]):
-            x = self._get_cached_image(self.images[img_i[i]])
-            win = x[:, block_y[i]:block_y[i]+self.tiling.tile_shape[0],
-                  block_x[i]:block_x[i]+self.tiling.tile_shape[1]]
-            windows[i,:,:,:] = win
+        img_i = np.asarray(img_i)
+        block_y = np.asarray(block_y)
+        block_x = np.asarray(block_x)
+        th, tw = self.tiling.tile_shape
+        if out is None:
+            out = np.empty((img_i.shape[0], self.n_channels, th, tw), dtype=self.dtype)
+        windows = out
+        # Read the region covered by each cluster of nearby windows once and gather its windows in
+        # one operation
+        for u in np.unique(img_i):
+            sel = np.flatnonzero(img_i == u)
+            for cluster in _window_clusters(block_y[sel], block_x[sel], self.tiling.tile_shape):
+                ndx = sel[cluster]
+                y0, x0 = block_y[ndx].min(), block_x[ndx].min()
+                region = self.read_preprocessed_region(u, y0, x0, block_y[ndx].max() + th - y0,
+                                                       block_x[ndx].max() + tw - x0)
+                windows[ndx] = _gather_windows(region[None], np.zeros((len(ndx),), dtype=int), block_y[ndx] - y0,
+                                               block_x[ndx] - x0, self.tiling.tile_shape)
         if self.postprocess_fn is not None:
             windows = self.postprocess_fn(windows)
         return windows
 
 
+class RandomWindowSampler (object):
+    """
+    Draws windows at uniformly random pixel offsets, rather than on the tiling grid, from an extractor.
+    Offsets are drawn from the preprocessed (cropped, padded and downsampled) images, so they cover the same
+    region as the grid.
+
+    Has a `batch_iterator` method so can be passed as a dataset to `batch.batch_iterator`, `Trainer.train`, etc.
+    """
+    def __init__(self, extractor, n_samples=None, image_weights=None, rng=None):
+        """
+        :param extractor: an image window extractor
+        :param n_samples: [optional] the number of windows drawn per epoch; defaults to `len(extractor)`
+        :param image_weights: [optional] an array of shape `(N_images,)` giving the relative probability
+            of drawing windows from each image; if `None`, images are drawn with equal probability
+        :param rng: [optional] a `np.random.RandomState` used if `batch_iterator` is not given one
+        """
+        self.extractor = extractor
+        self.n_samples = n_samples if n_samples is not None else len(extractor)
+        self.image_weights = image_weights
+        self.rng = rng if rng is not None else np.random.RandomState()
+
+    def __len__(self):
+        return self.n_samples
+
+    def batch_iterator(self, batchsize, shuffle_rng=None):
+        """
+        :param batchsize: the mini-batch size
+        :param shuffle_rng: [optional] the random number generator used to draw windows; if `None`,
+            `self.rng` is used
+        :return: an iterator that yields mini-batch lists of the form `[batch_of_windows]`, or a list with an entry
+            per source for a `MultiSourceImageWindowExtractor`
+        """
+        rng = shuffle_rng if shuffle_rng is not None else self.rng
+        for start_idx in range(0, self.n_samples, batchsize):
+            n = min(batchsize, self.n_samples - start_idx)
+            img_i, block_y, block_x = self.extractor.random_pixel_coords(n, rng, image_weights=self.image_weights)
+            windows = self.extractor.get_windows_by_pixel_coords(img_i, block_y, block_x)
+            yield windows if isinstance(windows, list) else [windows]
+
+
 class AbstractNonUniformImageWindowExtractor (object):
     def __init__(self, images, image_read_fn, image_shape_fn, tiling,
                  pad_mode='reflect', downsample=None, postprocess_fn=None,
-                 reorder=True):
+                 reorder=True, workers=None, worker_type=WORKERS_THREAD):
         """
 
         :param images: a list of images to read; these can be paths, IDs, objects
@@ -331,12 +1131,18 @@ class AbstractNonUniformImageWindowExtractor (object):
         :param postprocess_fn: [optional] a post processing function of the form
         `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
         to the extracted data
+        :param workers: [optional] the number of workers used to acquire image shapes, and read and
+        preprocess images, in parallel; if `None` this is done serially
+        :param worker_type: (default='thread') `'thread'` for a thread pool or `'process'` for a process pool,
+        in which case `image_read_fn` and `image_shape_fn` must be picklable
         """
         if tiling.ndim != 2:
             raise ValueError('tiling should have 2 dimensions, not {}'.format(tiling.ndim))
 
         self.image_read_fn = image_read_fn
         self.image_shape_fn = image_shape_fn
+        self.workers = workers
+        self.worker_type = worker_type
 
         self.tiling_scheme = tiling
         self.N_images = len(images)
@@ -344,24 +1150,29 @@ class AbstractNonUniformImageWindowExtractor (object):
         self.extractors = []
         self.extractor_image_offsets = [0]
 
+        image_shapes = list(_parallel_imap(image_shape_fn, images, workers=workers, worker_type=worker_type))
+
         if reorder:
             # Collect images by shape
             shape_to_images = collections.OrderedDict()
+            shape_to_indices = collections.OrderedDict()
 
-            for img_id in images:
-                img_shape = image_shape_fn(img_id)
+            for i, (img_id, img_shape) in enumerate(zip(images, image_shapes)):
                 shape_to_images.setdefault(img_shape, list()).append(img_id)
+                shape_to_indices.setdefault(img_shape, list()).append(i)
+
+            # The index in `images` of each image, in the order used by the extractors
+            self.image_order = np.array([i for indices in shape_to_indices.values() for i in indices], dtype=int)
 
             for img_shape in shape_to_images.keys():
                 self.__new_extractor(shape_to_images[img_shape], img_shape, tiling, pad_mode, downsample,
                                      postprocess_fn)
         else:
+            self.image_order = np.arange(len(images))
             images_by_shape = []
             shape = None
 
-            for img_id in images:
-                img_shape = image_shape_fn(img_id)
-
+            for img_id, img_shape in zip(images, image_shapes):
                 if shape is None:
                     shape = img_shape
                 if img_shape != shape:
@@ -379,6 +1190,9 @@ class AbstractNonUniformImageWindowExtractor (object):
 
         self.N = self.extractor_offsets[-1]
 
+        # If not `None`, `batch_iterator` shuffles using `locality_aware_shuffle` with this pool size
+        self.shuffle_pool_size = None
+
 
     def __new_extractor(self, images, shape, tiling, pad_mode, downsample, postprocess_fn):
         extractor = self._create_extractor(images, shape, tiling, pad_mode, downsample, postprocess_fn)
@@ -393,6 +1207,20 @@ class AbstractNonUniformImageWindowExtractor (object):
     def _image_to_append_to_image_list(self, image_id):
         raise NotImplementedError('Abstract for type {}'.format(type(self)))
 
+    def window_image_indices(self, indices):
+        """
+        Get the index of the image that each window is extracted from. Note that image indices
+        follow the order of `self.extractors`, which differs from the order of the images passed to the
+        constructor if `reorder` was `True`.
+
+        :param indices: window indices as an array of shape `(N,)`
+        :return: image indices as an array of shape `(N,)`
+        """
+        extractor_indices = np.searchsorted(self.extractor_offsets, indices, side='right') - 1
+        sample_offsets = indices - self.extractor_offsets[extractor_indices]
+        windows_per_image = np.array([ext.img_windows[0] * ext.img_windows[1] for ext in self.extractors])
+        return self.extractor_image_offsets[extractor_indices] + sample_offsets // windows_per_image[extractor_indices]
+
     def get_window(self, index):
         return self.get_windows(np.array([index]))[0,...]
 
@@ -421,12 +1249,7 @@ class AbstractNonUniformImageWindowExtractor (object):
 
         return np.concatenate(windows, axis=0)
 
-    def get_windows_by_separate_coords(self, img_i, window_y, window_x):
-        """
-        img_i - array of shape (N) providing image indices
-        block_y - array of shape (N) providing block y-co-ordinate
-        block_x - array of shape (N) providing block x-co-ordinate
-        """
+    def _get_windows_by_image(self, method_name, img_i, a, b):
         # Get the indices of the extractors that cover these samples
         extractor_indices = np.searchsorted(self.extractor_image_offsets, img_i, side='right') - 1
         # Get the offsets indices within the relevant extractors
@@ -443,12 +1266,55 @@ class AbstractNonUniformImageWindowExtractor (object):
             # Get the extractor
             extractor = self.extractors[extractor_i]
             # Extract a run of windows
-            wins = extractor.get_windows_by_separate_coords(image_offsets[start:end],
-                                                            window_y[start:end], window_x[start:end])
+            wins = getattr(extractor, method_name)(image_offsets[start:end], a[start:end], b[start:end])
             windows.append(wins)
 
         return np.concatenate(windows, axis=0)
 
+    def get_windows_by_separate_coords(self, img_i, window_y, window_x):
+        """
+        img_i - array of shape (N) providing image indices
+        block_y - array of shape (N) providing block y-co-ordinate
+        block_x - array of shape (N) providing block x-co-ordinate
+        """
+        return self._get_windows_by_image('get_windows_by_separate_coords', img_i, window_y, window_x)
+
+    def get_windows_by_pixel_coords(self, img_i, block_y, block_x):
+        """
+        Extract windows at arbitrary pixel offsets rather than on the tiling grid
+
+        img_i - array of shape (N) providing image indices, in extractor order (see `image_order`)
+        block_y - array of shape (N) providing pixel y-co-ordinate in the preprocessed image
+        block_x - array of shape (N) providing pixel x-co-ordinate in the preprocessed image
+        """
+        return self._get_windows_by_image('get_windows_by_pixel_coords', np.asarray(img_i), np.asarray(block_y),
+                                          np.asarray(block_x))
+
+    def image_offset_ranges(self):
+        """
+        Get the number of valid window offsets along each axis of each image, in extractor order
+
+        :return: `(n_y, n_x)`, arrays of shape `(N_images,)`
+        """
+        ranges = [ext.image_offset_ranges() for ext in self.extractors]
+        return np.concatenate([r[0] for r in ranges]), np.concatenate([r[1] for r in ranges])
+
+    def random_pixel_coords(self, n, rng, image_weights=None):
+        """
+        Draw window co-ordinates uniformly at random from the valid pixel offsets, for use with
+        `get_windows_by_pixel_coords`
+
+        :param n: the number of windows
+        :param rng: a `np.random.RandomState`
+        :param image_weights: [optional] an array of shape `(N_images,)` giving the relative probability
+            of drawing windows from each image, in the order of the images passed to the constructor
+        :return: `(img_i, block_y, block_x)`, arrays of shape `(n,)`; `img_i` is in extractor order
+        """
+        if image_weights is not None:
+            image_weights = np.asarray(image_weights)[self.image_order]
+        n_y, n_x = self.image_offset_ranges()
+        return random_pixel_coords(n, n_y, n_x, rng, image_weights=image_weights)
+
     def get_windows_by_coords(self, coords):
         """
         coords - array of shape (N,3) where each row is (image_index, block_y, block_x)
@@ -479,12 +1345,17 @@ class AbstractNonUniformImageWindowExtractor (object):
 
         :param batchsize: the mini-batch size
         :param shuffle_rng: [optional] a random number generator used to shuffle the order in which image windows
-        are extracted
+        are extracted. If `self.shuffle_pool_size` is not `None` the windows are shuffled by
+        `locality_aware_shuffle`, otherwise uniformly.
         :return: an iterator that yields mini-batch lists of the form `[batch_of_windows]`
         """
         indices = np.arange(self.N)
         if shuffle_rng is not None:
-            shuffle_rng.shuffle(indices)
+            if self.shuffle_pool_size is not None:
+                indices = locality_aware_shuffle(self.window_image_indices(indices), self.shuffle_pool_size,
+                                                 shuffle_rng)
+            else:
+                shuffle_rng.shuffle(indices)
         for start_idx in range(0, self.N, batchsize):
             yield [self[indices[start_idx:start_idx + batchsize]]]
 
@@ -492,15 +1363,17 @@ class AbstractNonUniformImageWindowExtractor (object):
 class NonUniformImageWindowExtractor (AbstractNonUniformImageWindowExtractor):
     def _create_extractor(self, images, shape, tiling, pad_mode, downsample, postprocess_fn):
         return ImageWindowExtractor(
-            images, lambda x: x, tiling, pad_mode=pad_mode, downsample=downsample, postprocess_fn=postprocess_fn)
+            images, self.image_read_fn, tiling, pad_mode=pad_mode, downsample=downsample,
+            postprocess_fn=postprocess_fn, workers=self.workers, worker_type=self.worker_type)
 
     def _image_to_append_to_image_list(self, image_id):
-        return self.image_read_fn(image_id)
+        return image_id
 
 
 class CacheingNonUniformImageWindowExtractor (AbstractNonUniformImageWindowExtractor):
     def __init__(self, images, image_read_fn, image_shape_fn, tiling, pad_mode='reflect',
-                 downsample=None, postprocess_fn=None, reorder=True, cache_size=256):
+                 downsample=None, postprocess_fn=None, reorder=True, cache_size=256, workers=None,
+                 worker_type=WORKERS_THREAD, cache_bytes=None, cache=None, shuffle_pool_size=None):
         """
 
         :param images: a list of images to read; these can be paths, IDs, objects
@@ -510,13 +1383,25 @@ class CacheingNonUniformImageWindowExtractor (AbstractNonUniformImageWindowExtra
         :param postprocess_fn: [optional] a post processing function of the form
         `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
         to the extracted data
+        :param cache_size: (default=256) the maximum number of preprocessed images held in the cache, which is
+        shared by the extractors for each image shape; `None` for no limit. Ignored if `cache` is given
+        :param workers: [optional] the number of workers used to acquire image shapes in parallel
+        :param worker_type: (default='thread') `'thread'` for a thread pool or `'process'` for a process pool
+        :param cache_bytes: [optional] the maximum total size in bytes of the preprocessed images held in the cache.
+        Ignored if `cache` is given
+        :param cache: [optional] an `image_cache.ImageCache` to use
+        :param shuffle_pool_size: [optional] if given, `batch_iterator` shuffles windows with
+        `locality_aware_shuffle`, drawing them from a pool of this many images at a time
         """
+        if cache is None:
+            cache = image_cache.ImageCache(max_entries=cache_size, max_bytes=cache_bytes)
         self.cache_size = cache_size
-        self.cache = collections.OrderedDict()
+        self.cache = cache
 
         super(CacheingNonUniformImageWindowExtractor, self).__init__(
             images, image_read_fn, image_shape_fn, tiling, pad_mode=pad_mode, downsample=downsample,
-            postprocess_fn=postprocess_fn, reorder=reorder)
+            postprocess_fn=postprocess_fn, reorder=reorder, workers=workers, worker_type=worker_type)
+        self.shuffle_pool_size = shuffle_pool_size
 
 
     def _create_extractor(self, images, shape, tiling, pad_mode, downsample, postprocess_fn):
@@ -528,9 +1413,64 @@ class CacheingNonUniformImageWindowExtractor (AbstractNonUniformImageWindowExtra
         return image_id
 
 
+class RegionNonUniformImageWindowExtractor (AbstractNonUniformImageWindowExtractor):
+    def __init__(self, images, read_region_fn, image_shape_fn, tiling, pad_mode='reflect',
+                 downsample=None, postprocess_fn=None, reorder=True, region_tile_shape=(512, 512), cache_size=256,
+                 workers=None, worker_type=WORKERS_THREAD, cache_bytes=None, cache=None, shuffle_pool_size=None):
+        """
+
+        :param images: a list of images to read; these can be paths, IDs, objects
+        :param read_region_fn: a region reader function of the form `fn(image, y0, x0, h, w) -> np.array[h,w,C]`
+        :param image_shape_fn: an image shape acquisition function of the form `fn(image) -> (height,width,channels)`
+        :param tiling: a `tiling_scheme.TilingScheme` instance that describes how windows are to be extracted
+        `from the data
+        :param postprocess_fn: [optional] a post processing function of the form
+        `postprocess_fn(extracted_windows) -> transformed_extracted_windows` that applies some sort of transformation
+        to the extracted data
+        :param region_tile_shape: (default=(512, 512)) the shape of the region tiles that are read and cached
+        :param cache_size: (default=256) the maximum number of region tiles held in the cache, which is
+        shared by the extractors for each image shape; `None` for no limit. Ignored if `cache` is given
+        :param workers: [optional] the number of workers used to acquire image shapes in parallel
+        :param worker_type: (default='thread') `'thread'` for a thread pool or `'process'` for a process pool
+        :param cache_bytes: [optional] the maximum total size in bytes of the region tiles held in the cache.
+        Ignored if `cache` is given
+        :param cache: [optional] an `image_cache.ImageCache` to use
+        :param shuffle_pool_size: [optional] if given, `batch_iterator` shuffles windows with
+        `locality_aware_shuffle`, drawing them from a pool of this many images at a time
+        """
+        if cache is None:
+            cache = image_cache.ImageCache(max_entries=cache_size, max_bytes=cache_bytes)
+        self.region_tile_shape = region_tile_shape
+        self.cache_size = cache_size
+        self.cache = cache
+
+        super(RegionNonUniformImageWindowExtractor, self).__init__(
+            images, read_region_fn, image_shape_fn, tiling, pad_mode=pad_mode, downsample=downsample,
+            postprocess_fn=postprocess_fn, reorder=reorder, workers=workers, worker_type=worker_type)
+        self.shuffle_pool_size = shuffle_pool_size
+
+
+    def _create_extractor(self, images, shape, tiling, pad_mode, downsample, postprocess_fn):
+        return RegionImageWindowExtractor(
+            images, self.image_read_fn, lambda image: shape, tiling, pad_mode=pad_mode, downsample=downsample,
+            postprocess_fn=postprocess_fn, region_tile_shape=self.region_tile_shape, cache_size=self.cache_size,
+            cache=self.cache)
+
+    def _image_to_append_to_image_list(self, image_id):
+        return image_id
+
+
 class ImageWindowAssembler (object):
+    """
+    Assembles images from windows, e.g. dense predictions made for windows drawn by an `ImageWindowExtractor`.
+
+    By default windows overwrite one another where they overlap, so the last window written wins. If `blend` is
+    given, windows are instead accumulated into a weighted sum along with a map of the total weight of each pixel,
+    and `get_image` normalises by the weight map. Blending with `'gaussian'` or `'linear'` weights
+    gives seam-free results from overlapping windows (`step_shape < tile_shape`).
+    """
     def __init__(self, image_shape, image_n_channels, n_images, tiling, upsample=None, upsample_order=0,
-                 pad_mode='reflect', img_dtype=np.float32):
+                 pad_mode='reflect', img_dtype=np.float32, blend=None, gaussian_sigma=0.125):
         """
         :param image_shape: the shape of the images that are to be generated
         :param image_n_channels: the number of channels
@@ -540,6 +1480,10 @@ class ImageWindowAssembler (object):
         :param upsample_order: [default=`0`] the interpolation order used for upsampling
         :param pad_mode: [default=`'reflect'`] the padding mode used to invert the effect of cropping
         :param img_dtype: [default=`np.float32`] the data type used for storing the images
+        :param blend: [default=`None`] how overlapping windows are combined; `None` to overwrite, `'mean'`
+            to average, `'gaussian'` or `'linear'` for a weighted average that favours the centres of windows
+        :param gaussian_sigma: [default=0.125] the standard deviation of the Gaussian weights as a fraction of
+            the tile size, used if `blend` is `'gaussian'`
         """
         self.N_images = n_images
         self.output_img_shape = image_shape
@@ -566,7 +1510,18 @@ class ImageWindowAssembler (object):
         self.n_channels = image_n_channels
         self.dtype = img_dtype
 
-        self.X = np.zeros((self.N_images, self.n_channels) + self.img_shape, dtype=self.dtype)
+        self.blend = blend
+
+        if blend is not None:
+            # Accumulate a weighted sum in floating point, along with the total weight of each pixel
+            self.window_weights = blend_weights(ds_tiling.tile_shape, blend, gaussian_sigma=gaussian_sigma)
+            acc_dtype = np.promote_types(self.dtype, np.float32)
+            self.X = np.zeros((self.N_images, self.n_channels) + self.img_shape, dtype=acc_dtype)
+            self.W = np.zeros((self.N_images,) + self.img_shape, dtype=np.float32)
+        else:
+            self.window_weights = None
+            self.X = np.zeros((self.N_images, self.n_channels) + self.img_shape, dtype=self.dtype)
+            self.W = None
 
         self.img_windows = ds_tiling.tiles
 
@@ -592,13 +1547,27 @@ class ImageWindowAssembler (object):
         self.set_windows_by_separate_coords(img_i, block_y, block_x, X)
 
     def set_windows_by_separate_coords(self, img_i, block_y, block_x, X):
-        for i in xrange(img_i.shape[0]):
-            self.X[img_i[i], :,
-                   block_y[i]:block_y[i]+self.tiling.tile_shape[0],
-                   block_x[i]:block_x[i]+self.tiling.tile_shape[1]] = X[i,:,:,:]
+        """
+        img_i - array of shape (N) providing image indices
+        block_y - array of shape (N) providing pixel y-co-ordinate
+        block_x - array of shape (N) providing pixel x-co-ordinate
+        X - windows, array of shape (N,C,tile_h,tile_w)
+        """
+        img_i = np.asarray(img_i)
+        block_y = np.asarray(block_y)
+        block_x = np.asarray(block_x)
+        if self.blend is None:
+            _scatter_windows(self.X, img_i, block_y, block_x, X)
+        else:
+            _scatter_windows(self.X, img_i, block_y, block_x, X * self.window_weights, accumulate=True)
+            _scatter_windows(self.W, img_i, block_y, block_x, self.window_weights, accumulate=True)
 
     def get_image(self, i):
         x = self.X[i,:,:,:]
+        if self.blend is not None:
+            # Normalise by the weight map; pixels not covered by any window are 0
+            w = self.W[i]
+            x = (x / np.where(w > 0.0, w, 1.0)[None, :, :]).astype(self.dtype)
         # Move channel axis to the back
         x = x.transpose(1,2,0)
 
@@ -617,8 +1586,9 @@ class ImageWindowAssembler (object):
         return x
 
     def __repr__(self):
-        return 'ImageWindowAssembler(n_images={}, output_img_shape={}, upsample={}, N={}, tiling={}, n_channels={}, dtype={})'.format(
-            self.N_images, self.output_img_shape, self.upsample, self.N, self.tiling, self.n_channels, self.dtype
+        return 'ImageWindowAssembler(n_images={}, output_img_shape={}, upsample={}, N={}, tiling={}, n_channels={}, dtype={}, blend={})'.format(
+            self.N_images, self.output_img_shape, self.upsample, self.N, self.tiling, self.n_channels, self.dtype,
+            self.blend
         )
 
 
@@ -659,6 +1629,73 @@ class Test_rle (unittest.TestCase):
         self.assertTrue((y == expected).all())
 
 
+class Test_ImageWindowAssembler (unittest.TestCase):
+    def test_blend(self):
+        img = np.random.uniform(0.0, 1.0, size=(60,60,3)).astype(np.float32)
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(4, 4))
+        wins = ImageWindowExtractor(images=[img], image_read_fn=lambda x: x, tiling=tiling)
+        all_win_indices = np.arange(wins.N)
+        windows = wins.get_windows(all_win_indices)
+        for blend in [BLEND_MEAN, BLEND_GAUSSIAN, BLEND_LINEAR]:
+            # Overlapping windows of the same image blend back to the image
+            assembler = wins.assembler(blend=blend)
+            assembler.set_windows(all_win_indices, windows)
+            self.assertTrue(np.allclose(assembler.get_image(0), img, atol=1e-5))
+            self.assertEqual(assembler.get_image(0).dtype, np.float32)
+
+        # Windows of constant value 0 and 1 at the same position average under 'mean'
+        assembler = wins.assembler(blend=BLEND_MEAN, n_images=1)
+        const = np.concatenate([np.zeros((1,3,16,16)), np.ones((1,3,16,16))], axis=0)
+        assembler.set_windows_by_separate_coords(np.array([0, 0]), np.array([8, 8]), np.array([4, 4]), const)
+        out = assembler.get_image(0)
+        self.assertTrue((out[8:24, 4:20] == 0.5).all())
+        self.assertTrue((out[:8] == 0.0).all())
+
+    def test_scatter_overlapping(self):
+        rng = np.random.RandomState(12345)
+        img_i = rng.randint(0, 2, size=(200,))
+        block_y = rng.randint(0, 25, size=(200,))
+        block_x = rng.randint(0, 17, size=(200,))
+        # Include exact duplicates
+        img_i[150:], block_y[150:], block_x[150:] = img_i[:50], block_y[:50], block_x[:50]
+        windows = rng.uniform(size=(200, 2, 8, 16))
+        X = np.zeros((2, 2, 32, 32))
+        _scatter_windows(X, img_i, block_y, block_x, windows, accumulate=True)
+        expected = np.zeros((2, 2, 32, 32))
+        for i in range(200):
+            expected[img_i[i], :, block_y[i]:block_y[i]+8, block_x[i]:block_x[i]+16] += windows[i]
+        self.assertTrue(np.allclose(X, expected))
+
+    def test_blend_weights(self):
+        w = blend_weights((8, 6), BLEND_LINEAR)
+        self.assertEqual(w.shape, (8, 6))
+        self.assertTrue((w > 0.0).all())
+        self.assertTrue(np.allclose(w, w[::-1, ::-1]))
+        g = blend_weights((8, 8), BLEND_GAUSSIAN)
+        self.assertTrue(g[0, 0] < g[3, 3])
+        self.assertRaises(ValueError, blend_weights, (8, 8), 'median')
+
+
+class Test_locality_aware_shuffle (unittest.TestCase):
+    def test_shuffle(self):
+        rng = np.random.RandomState(12345)
+        img_i = np.repeat(np.arange(100), 50)
+        order = locality_aware_shuffle(img_i, 8, rng)
+        self.assertTrue((np.sort(order) == np.arange(5000)).all())
+        # Simulate an LRU cache of 10 images; each image should be loaded about once
+        cache = collections.OrderedDict()
+        misses = 0
+        for i in img_i[order]:
+            if i in cache:
+                del cache[i]
+            else:
+                misses += 1
+                if len(cache) >= 10:
+                    cache.popitem(last=False)
+            cache[i] = True
+        self.assertTrue(misses < 110)
+
+
 class Test_ImageWindowExtractor (unittest.TestCase):
     def test_simple(self):
         img0 = np.random.uniform(0.0, 1.0, size=(100,100,3))
@@ -878,6 +1915,54 @@ class Test_ImageWindowExtractor (unittest.TestCase):
         self.assertTrue(np.isclose(assembler.get_image(3)[8:-8,8:-8,:], img3_ds_us[8:-8,8:-8,:]).all())
 
 
+    def test_out(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(50,50,3)) for _ in range(3)]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(2,2))
+        indices = np.random.randint(0, 3*18*18, size=(20,))
+        for wins in [ImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling),
+                     CacheingImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling,
+                                                  cache_size=3)]:
+            out = np.zeros((20,3,16,16))
+            self.assertTrue(wins.get_windows(indices, out=out) is out)
+            expected = np.concatenate([wins.get_window(i)[None] for i in indices], axis=0)
+            self.assertTrue((out == expected).all())
+
+
+    def test_store(self):
+        import shutil, tempfile
+        imgs = [np.random.uniform(0.0, 1.0, size=(50,50,3)) for _ in range(3)]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(2,2))
+        store_dir = tempfile.mkdtemp()
+        try:
+            reads = []
+            def read_fn(x):
+                reads.append(x)
+                return x
+            wins_a = ImageWindowExtractor(images=imgs, image_read_fn=read_fn, tiling=tiling, store_dir=store_dir)
+            n_reads = len(reads)
+            wins_b = ImageWindowExtractor(images=imgs, image_read_fn=read_fn, tiling=tiling, store_dir=store_dir)
+            # Only the first image is read to determine the image shape
+            self.assertEqual(len(reads), n_reads + 1)
+            self.assertEqual(wins_a.store_path, wins_b.store_path)
+            self.assertTrue(isinstance(wins_b.X, np.memmap))
+            self.assertTrue((wins_b.X[1] == np.rollaxis(imgs[1], 2, 0)).all())
+            # A different pad mode uses a different store
+            wins_c = ImageWindowExtractor(images=imgs, image_read_fn=read_fn, tiling=tiling, store_dir=store_dir,
+                                          pad_mode='constant')
+            self.assertNotEqual(wins_a.store_path, wins_c.store_path)
+            del wins_a, wins_b, wins_c
+        finally:
+            shutil.rmtree(store_dir)
+
+
+    def test_workers(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(50,50,3)) for _ in range(5)]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(2,2))
+        serial = ImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling)
+        threaded = ImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling, workers=3)
+        self.assertTrue((serial.X == threaded.X).all())
+
+
 class Test_CacheingImageWindowExtractor (unittest.TestCase):
     def test_simple(self):
         img0 = np.random.uniform(0.0, 1.0, size=(100,100,3))
@@ -1072,6 +2157,135 @@ class Test_CacheingImageWindowExtractor (unittest.TestCase):
         self.assertTrue(np.isclose(assembler.get_image(3)[8:-8,8:-8,:], img3_ds_us[8:-8,8:-8,:]).all())
 
 
+    def test_cache(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(50,50,3)) for _ in range(4)]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(2,2))
+        # Byte budget of two preprocessed images
+        wins = CacheingImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling, cache_size=None,
+                                            cache_bytes=2*3*50*50*8)
+        wins.get_windows_by_coords(np.array([[0, 1, 1], [1, 1, 1], [0, 2, 2]]))
+        self.assertEqual(wins.cache.stats()['misses'], 2)
+        wins.get_windows_by_coords(np.array([[2, 1, 1]]))
+        self.assertEqual(len(wins.cache), 2)
+        self.assertEqual(wins.cache.evictions, 1)
+        # A second extractor with the same images and tiling shares the cached images
+        wins2 = CacheingImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling, cache_size=None,
+                                             cache=wins.cache)
+        self.assertTrue((wins2.get_windows_by_coords(np.array([[2, 3, 4]])) == imgs[2][6:22,8:24,:].transpose(2,0,1)).all())
+        self.assertEqual(wins.cache.hits, 1)
+
+
+class Test_MultiSourceImageWindowExtractor (unittest.TestCase):
+    def test_aligned(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(48,48,3)) for _ in range(3)]
+        labels = [np.random.randint(0, 5, size=(48,48)) for _ in range(3)]
+        reads = []
+        def read_fn(i):
+            reads.append(i)
+            return [imgs[i], labels[i]]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(4,4))
+        wins = MultiSourceImageWindowExtractor(images=[0, 1, 2], image_read_fn=read_fn, tiling=tiling,
+                                               downsample=(2,2), downsample_mode=['mean', 'nearest'])
+        self.assertEqual(wins.source_n_channels, [3, 1])
+        batches = list(wins.batch_iterator(64, shuffle_rng=np.random.RandomState(12345)))
+        # One read for the first image to determine shapes, then one read per image group
+        self.assertEqual(len(reads), 4)
+        x, y = batches[0]
+        self.assertEqual(x.shape, (64, 3, 8, 8))
+        self.assertEqual(y.shape, (64, 1, 8, 8))
+        self.assertEqual(y.dtype, labels[0].dtype)
+        x, y = wins.get_window(1*9*9 + 2*9 + 3)
+        self.assertTrue(np.allclose(x, skimage.transform.downscale_local_mean(imgs[1], (2,2,1))[4:12,6:14].transpose(2,0,1)))
+        self.assertTrue((y[0] == labels[1][9:25:2,13:29:2]).all())
+
+
+class Test_RegionImageWindowExtractor (unittest.TestCase):
+    def test_pad_index_map(self):
+        v = np.arange(-12, 17)
+        for mode in ['reflect', 'symmetric', 'edge', 'wrap', 'constant']:
+            for length in [1, 2, 5]:
+                if mode == 'reflect' and length == 1:
+                    continue
+                x = np.arange(length) + 1
+                padded = np.pad(x, (12, 16 - length + 1), mode=mode)
+                index, valid = pad_index_map(v, length, mode)
+                self.assertTrue((np.where(valid, x[index], 0) == padded).all(), msg='{} {}'.format(mode, length))
+
+    def test_matches_whole_image(self):
+        rng = np.random.RandomState(12345)
+        imgs = [rng.uniform(0.0, 1.0, size=(70, 90, 3)) for _ in range(2)]
+        reads = []
+        def read_region(i, y0, x0, h, w):
+            self.assertTrue(y0 >= 0 and x0 >= 0 and y0 + h <= 70 and x0 + w <= 90)
+            reads.append((h, w))
+            return imgs[i][y0:y0 + h, x0:x0 + w]
+        for pad_mode in ['reflect', 'symmetric', 'edge', 'constant']:
+            for downsample in [None, (2, 2)]:
+                tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(8, 8),
+                                                    data_pad_or_crop=[(-4, 20), (10, -2)],
+                                                    mode=tiling_scheme.TILING_MODE_PAD)
+                whole = ImageWindowExtractor(images=[0, 1], image_read_fn=lambda i: imgs[i], tiling=tiling,
+                                             pad_mode=pad_mode, downsample=downsample)
+                region = RegionImageWindowExtractor(images=[0, 1], read_region_fn=read_region,
+                                                    image_shape_fn=lambda i: imgs[i].shape, tiling=tiling,
+                                                    pad_mode=pad_mode, downsample=downsample,
+                                                    region_tile_shape=(32, 32))
+                self.assertEqual(region.N, whole.N)
+                ndx = np.arange(region.N)
+                self.assertTrue(np.allclose(region.get_windows(ndx), whole.get_windows(ndx)),
+                                msg='{} {}'.format(pad_mode, downsample))
+        # Only region tiles are read, and each only once
+        self.assertTrue(max(reads) <= (32, 32))
+        self.assertEqual(region.cache.misses, len(region.cache))
+
+    def test_non_uniform(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(40, 40)), np.random.uniform(0.0, 1.0, size=(30, 50))]
+        wins = RegionNonUniformImageWindowExtractor(
+            images=[0, 1], read_region_fn=lambda i, y0, x0, h, w: imgs[i][y0:y0 + h, x0:x0 + w],
+            image_shape_fn=lambda i: imgs[i].shape, tiling=tiling_scheme.TilingScheme(tile_shape=(10, 10)),
+            region_tile_shape=(16, 16))
+        self.assertEqual(wins.N, 16 + 15)
+        # Far apart windows are read separately, not as their bounding box
+        self.assertEqual(sorted([list(c) for c in _window_clusters(np.array([0, 30, 4, 34]), np.array([0, 0, 30, 40]),
+                                                                   (10, 10))]), [[0], [1], [2], [3]])
+        self.assertEqual([list(c) for c in _window_clusters(np.array([0, 10, 20]), np.array([0, 5, 0]), (10, 10))],
+                         [[0, 1, 2]])
+        self.assertTrue((wins.get_windows(np.array([17]))[0, 0] == imgs[1][0:10, 10:20]).all())
+
+
+class Test_RandomWindowSampler (unittest.TestCase):
+    def test_uniform(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(40,40,3)) for _ in range(3)]
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(8,8), data_pad_or_crop=[(4,4), (4,4)])
+        wins = ImageWindowExtractor(images=imgs, image_read_fn=lambda x: x, tiling=tiling)
+        self.assertEqual(wins.img_shape, (48, 48))
+        rng = np.random.RandomState(12345)
+        img_i, y, x = wins.random_pixel_coords(2000, rng, image_weights=[0.0, 1.0, 3.0])
+        self.assertFalse((img_i == 0).any())
+        self.assertTrue(0.7 < (img_i == 2).mean() < 0.8)
+        # Offsets cover the padded image
+        self.assertEqual((y.min(), y.max(), x.min(), x.max()), (0, 32, 0, 32))
+        windows = wins.get_windows_by_pixel_coords(img_i[:5], y[:5], x[:5])
+        for i in range(5):
+            self.assertTrue((windows[i] == wins.X[img_i[i], :, y[i]:y[i]+16, x[i]:x[i]+16]).all())
+        batches = list(RandomWindowSampler(wins, n_samples=100).batch_iterator(32, shuffle_rng=rng))
+        self.assertEqual([b[0].shape[0] for b in batches], [32, 32, 32, 4])
+
+    def test_non_uniform(self):
+        imgs = [np.random.uniform(0.0, 1.0, size=(40,40,3)), np.random.uniform(0.0, 1.0, size=(30,40,3)),
+                np.random.uniform(0.0, 1.0, size=(40,40,3))]
+        wins = NonUniformImageWindowExtractor(images=imgs, image_read_fn=lambda x: x,
+                                              image_shape_fn=lambda x: x.shape,
+                                              tiling=tiling_scheme.TilingScheme(tile_shape=(16, 16)))
+        # Images are grouped by shape
+        self.assertEqual(list(wins.image_order), [0, 2, 1])
+        img_i, y, x = wins.random_pixel_coords(500, np.random.RandomState(12345), image_weights=[0.0, 1.0, 0.0])
+        self.assertTrue((img_i == 2).all())
+        self.assertTrue(y.max() <= 14)
+        windows = wins.get_windows_by_pixel_coords(img_i, y, x)
+        self.assertTrue((windows[0] == imgs[1][y[0]:y[0]+16, x[0]:x[0]+16].transpose(2, 0, 1)).all())
+
+
 class Test_NonUniformImageWindowExtractor (unittest.TestCase):
     def test_simple(self):
         # Images of non-uniform size
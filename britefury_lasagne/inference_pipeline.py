@@ -0,0 +1,257 @@
+"""
+Bounded-memory sliding-window inference
+
+Applies a dense prediction network to images one image (or a small group of images) at a time:
+each group is read and split into windows, the windows are predicted in mini-batches, the predictions are
+assembled into output images and the output images are passed to a write function. Reading, prediction and
+writing run in separate threads connected by bounded queues, so they overlap while the number of
+images held in memory stays constant, regardless of the number of images processed.
+
+>>> pipeline = inference_pipeline.SlidingWindowInference.from_dnn(
+...     seg_net, tiling_scheme.TilingScheme(tile_shape=(256, 256), step_shape=(192, 192),
+...                                         mode=tiling_scheme.TILING_MODE_PAD),
+...     blend=image_window_extractor.BLEND_GAUSSIAN)
+>>> pipeline.process(paths, read_image, lambda path, pred: np.save(path + '.pred.npy', pred))
+
+Prediction runs in the calling thread.
+"""
+import threading
+import time
+import six
+from six.moves import queue
+import numpy as np
+
+from britefury_lasagne import image_window_extractor
+
+
+_STOP = object()
+
+
+class SlidingWindowInference (object):
+    """
+    Dense sliding-window inference over a stream of images.
+
+    The prediction function must generate dense predictions whose spatial shape is that of the input
+    windows, e.g. a fully convolutional segmentation network with 'same' padding. If windows overlap
+    (`step_shape < tile_shape`), use `blend` to average the predictions where they overlap.
+    """
+    def __init__(self, predict_fn, tiling, pad_mode='reflect', downsample=None, postprocess_fn=None,
+                 batchsize=64, output_index=0, out_dtype=np.float32, blend=None, upsample_order=0,
+                 queue_size=2):
+        """
+        :param predict_fn: mini-batch prediction function of the form `fn(*batch_inputs) -> list of arrays`,
+            e.g. as returned by `BasicDNN.predict_batch_fn`
+        :param tiling: a `tiling_scheme.TilingScheme` used to split images into windows
+        :param pad_mode: (default='reflect') the padding mode used by the extractor and assembler
+        :param downsample: [optional] the downsampling factor applied to images before extracting windows;
+            predictions are upsampled to match
+        :param postprocess_fn: [optional] a function applied to mini-batches of windows before prediction,
+            as used by `ImageWindowExtractor`
+        :param batchsize: (default=64) the mini-batch size
+        :param output_index: (default=0) the index of the prediction function output that is assembled
+        :param out_dtype: (default=np.float32) the data type of the output images
+        :param blend: [optional] how overlapping predictions are combined; see `ImageWindowAssembler`
+        :param upsample_order: (default=0) the interpolation order used to upsample predictions if
+            `downsample` is given
+        :param queue_size: (default=2) the maximum number of groups waiting between stages; bounds the
+            number of groups in memory at once to `2 * queue_size + 3`
+        """
+        self.predict_fn = predict_fn
+        self.tiling = tiling
+        self.pad_mode = pad_mode
+        self.downsample = downsample
+        self.postprocess_fn = postprocess_fn
+        self.batchsize = batchsize
+        self.output_index = output_index
+        self.out_dtype = out_dtype
+        self.blend = blend
+        self.upsample_order = upsample_order
+        self.queue_size = queue_size
+
+    @classmethod
+    def from_dnn(cls, dnn, tiling, temperature=None, tta=None, **kwargs):
+        """
+        Construct a pipeline that uses the predictions of a `basic_dnn.BasicDNN`
+
+        :param dnn: a `basic_dnn.BasicDNN` instance
+        :param tiling: a `tiling_scheme.TilingScheme` used to split images into windows
+        :param temperature: [optional] softmax temperature used by classifier objectives
+        :param tta: [optional] a `tta.TestTimeAugmentation` instance
+        :return: a `SlidingWindowInference`
+        """
+        return cls(dnn.predict_batch_fn(temperature=temperature, tta=tta), tiling, **kwargs)
+
+    def _groups(self, images, group_size):
+        group = []
+        for image in images:
+            group.append(image)
+            if len(group) == group_size:
+                yield group
+                group = []
+        if len(group) > 0:
+            yield group
+
+    def predict_group(self, extractor):
+        """
+        Predict all windows of the images in an extractor, accumulating them in an assembler
+
+        :param extractor: an `ImageWindowExtractor`
+        :return: an `ImageWindowAssembler`
+        """
+        assembler = None
+        for start in six.moves.range(0, extractor.N, self.batchsize):
+            indices = np.arange(start, min(start + self.batchsize, extractor.N))
+            pred = self.predict_fn(extractor.get_windows(indices))[self.output_index]
+            if assembler is None:
+                if pred.ndim != 4 or pred.shape[2:] != tuple(extractor.tiling.tile_shape):
+                    raise ValueError('Predictions should have shape (N, C, {}, {}), not {}'.format(
+                        extractor.tiling.tile_shape[0], extractor.tiling.tile_shape[1], pred.shape))
+                assembler = extractor.assembler(image_n_channels=pred.shape[1], upsample_order=self.upsample_order,
+                                                pad_mode=self.pad_mode, img_dtype=self.out_dtype, blend=self.blend)
+            assembler.set_windows(indices, pred)
+        return assembler
+
+    def process(self, images, image_read_fn, write_fn, group_size=1):
+        """
+        Predict and write the output images for a sequence of images
+
+        :param images: a sequence or iterator of images or image identifiers (e.g. paths)
+        :param image_read_fn: a function of the form `fn(image) -> np.array[H,W,C]`
+        :param write_fn: a function of the form `fn(image, prediction)` called with each input image identifier
+            and its prediction as an `np.array[H,W,C]`, in order
+        :param group_size: (default=1) the number of images processed together; all images in a group
+            must have the same shape
+        :return: a dict with the entries `'n_images'`, `'read_time'`, `'predict_time'` and `'write_time'`,
+            the last three being the total time in seconds spent in each stage
+        """
+        read_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        stats = {'n_images': 0, 'read_time': 0.0, 'predict_time': 0.0, 'write_time': 0.0}
+        errors = []
+        abort = threading.Event()
+
+        def put(q, item):
+            # Give up if another stage has failed, rather than blocking on a full queue forever
+            while not abort.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def reader():
+            try:
+                for group in self._groups(images, group_size):
+                    t0 = time.time()
+                    extractor = image_window_extractor.ImageWindowExtractor(
+                        group, image_read_fn, self.tiling, pad_mode=self.pad_mode, downsample=self.downsample,
+                        postprocess_fn=self.postprocess_fn)
+                    stats['read_time'] += time.time() - t0
+                    if not put(read_queue, (group, extractor)):
+                        return
+            except Exception as e:
+                errors.append(e)
+                abort.set()
+            finally:
+                put(read_queue, _STOP)
+
+        def writer():
+            try:
+                while not abort.is_set():
+                    try:
+                        item = write_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is _STOP:
+                        return
+                    group, assembler = item
+                    t0 = time.time()
+                    for i, image in enumerate(group):
+                        write_fn(image, assembler.get_image(i))
+                    stats['write_time'] += time.time() - t0
+                    stats['n_images'] += len(group)
+            except Exception as e:
+                errors.append(e)
+                abort.set()
+
+        reader_thread = threading.Thread(target=reader)
+        writer_thread = threading.Thread(target=writer)
+        reader_thread.daemon = writer_thread.daemon = True
+        reader_thread.start()
+        writer_thread.start()
+
+        try:
+            while not abort.is_set():
+                try:
+                    item = read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if item is _STOP:
+                    break
+                group, extractor = item
+                t0 = time.time()
+                assembler = self.predict_group(extractor)
+                stats['predict_time'] += time.time() - t0
+                del extractor
+                if not put(write_queue, (group, assembler)):
+                    break
+        except Exception:
+            abort.set()
+            raise
+        finally:
+            # Drain the read queue so that a blocked reader can exit, then let the writer finish
+            while reader_thread.is_alive():
+                try:
+                    read_queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            while writer_thread.is_alive():
+                try:
+                    write_queue.put(_STOP, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            writer_thread.join()
+
+        if len(errors) > 0:
+            raise errors[0]
+        return stats
+
+
+import unittest
+
+class Test_SlidingWindowInference (unittest.TestCase):
+    def test_process(self):
+        from britefury_lasagne import tiling_scheme
+        rng = np.random.RandomState(12345)
+        images = {'a': rng.uniform(size=(50, 60, 3)), 'b': rng.uniform(size=(40, 40, 3)),
+                  'c': rng.uniform(size=(50, 60, 3))}
+        tiling = tiling_scheme.TilingScheme(tile_shape=(16, 16), step_shape=(8, 8),
+                                            mode=tiling_scheme.TILING_MODE_PAD)
+        batch_sizes = []
+        def predict_fn(x):
+            batch_sizes.append(x.shape[0])
+            return [x[:, :1] * 2.0]
+        written = []
+        pipeline = SlidingWindowInference(predict_fn, tiling, batchsize=32, blend=image_window_extractor.BLEND_MEAN)
+        stats = pipeline.process(['a', 'b', 'c'], lambda k: images[k], lambda k, pred: written.append((k, pred)))
+        self.assertEqual(stats['n_images'], 3)
+        self.assertEqual([k for k, _ in written], ['a', 'b', 'c'])
+        for k, pred in written:
+            self.assertEqual(pred.shape, images[k].shape[:2] + (1,))
+            self.assertTrue(np.allclose(pred[:, :, 0], images[k][:, :, 0] * 2.0, atol=1e-5))
+        self.assertTrue(max(batch_sizes) <= 32)
+
+    def test_errors(self):
+        from britefury_lasagne import tiling_scheme
+        tiling = tiling_scheme.TilingScheme(tile_shape=(8, 8))
+        def read_fn(k):
+            if k == 3:
+                raise IOError('cannot read {}'.format(k))
+            return np.zeros((16, 16, 1))
+        pipeline = SlidingWindowInference(lambda x: [x], tiling)
+        self.assertRaises(IOError, pipeline.process, range(10), read_fn, lambda k, pred: None)
+        def write_fn(k, pred):
+            raise ValueError('cannot write {}'.format(k))
+        self.assertRaises(ValueError, pipeline.process, range(10), lambda k: np.zeros((16, 16, 1)), write_fn)
@@ -0,0 +1,372 @@
+"""
+Dynamic batching inference server
+
+Collects concurrent single-sample prediction requests into mini-batches so that the network is
+invoked once per mini-batch rather than once per request.
+
+>>> predictor = BatchingPredictor.from_dnn(clf, max_batch_size=64, max_latency=0.005)
+>>> with predictor:
+...     pred_prob = predictor.predict(x)[0]
+
+An HTTP entry point is provided by `serve_http`. Requests are POSTed to `/predict` with a body consisting
+of an NPZ archive (as written by `np.savez`) containing one array per network input for a single sample.
+The response is an NPZ archive containing one array per network output. Statistics are available
+as JSON via a GET request to `/stats`.
+"""
+import json
+import threading
+import time
+import collections
+import six
+from six.moves import queue, socketserver, BaseHTTPServer
+import numpy as np
+
+
+class _PredictionRequest (object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.signature = tuple([(x.shape, x.dtype.str) for x in inputs])
+        self.enqueue_time = time.time()
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_STOP = object()
+
+
+class BatchingPredictor (object):
+    """
+    Wraps a mini-batch prediction function, collecting concurrent single sample requests
+    into mini-batches of up to `max_batch_size` samples. A mini-batch is dispatched once it is full or
+    once the oldest request in it has waited for `max_latency` seconds.
+    """
+    def __init__(self, predict_fn, max_batch_size=64, max_latency=0.005, latency_history=10000):
+        """
+        :param predict_fn: mini-batch prediction function of the form `fn(*batch_inputs) -> list of arrays`,
+            e.g. `BasicDNN._predict_fn`
+        :param max_batch_size: (default=64) the maximum number of samples in a mini-batch
+        :param max_latency: (default=0.005) the maximum time in seconds that a request will wait for
+            other requests to join its mini-batch
+        :param latency_history: (default=10000) the number of most recent request latencies retained for
+            computing latency percentiles
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self._queue = queue.Queue()
+        self._thread = None
+        # Guards `_thread` so that no request can be queued after the worker has been told to stop
+        self._state_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=latency_history)
+        self._n_requests = 0
+        self._n_batches = 0
+
+    @classmethod
+    def from_dnn(cls, dnn, temperature=None, **kwargs):
+        """
+        Construct a predictor that serves the predictions of a `basic_dnn.BasicDNN`
+
+        :param dnn: a `basic_dnn.BasicDNN` instance
+        :param temperature: [optional] softmax temperature used by classifier objectives; if `None`
+            the temperature of each objective at the time of each mini-batch is used
+        :return: a `BatchingPredictor`
+        """
+        if temperature is None:
+            return cls(dnn._predict_fn, **kwargs)
+        else:
+            return cls(dnn.predict_batch_fn(temperature=temperature), **kwargs)
+
+    @classmethod
+    def from_imagenet_model(cls, model, **kwargs):
+        """
+        Construct a predictor that serves the output of the final layer of a pre-trained ImageNet model,
+        e.g. a `pretrained.imagenet_vgg.VGG16Model` or `pretrained.imagenet_resnet.ResNet50Model`
+
+        :param model: a `pretrained.imagenet.AbstractImageNetModel` instance
+        :return: a `BatchingPredictor`
+        """
+        import theano
+        import lasagne
+
+        input_layers = [layer for layer in lasagne.layers.get_all_layers(model.final_layer)
+                        if isinstance(layer, lasagne.layers.InputLayer)]
+        input_vars = [layer.input_var for layer in input_layers]
+        prediction = lasagne.layers.get_output(model.final_layer, deterministic=True)
+        return cls(theano.function(input_vars, [prediction]), **kwargs)
+
+    def start(self):
+        """
+        Start the worker thread that dispatches mini-batches
+        """
+        with self._state_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop the worker thread; requests that are already queued are processed before it exits
+        """
+        with self._state_lock:
+            if self._thread is not None:
+                self._queue.put(_STOP)
+                self._thread.join()
+                self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def predict(self, *sample_inputs):
+        """
+        Predict the outputs for a single sample. Blocks until the mini-batch containing the sample has been
+        processed. May be called concurrently from multiple threads.
+
+        :param sample_inputs: the inputs for the sample, one array per network input, without the
+            sample dimension
+        :return: a list of arrays, one per network output, without the sample dimension
+        """
+        request = _PredictionRequest([np.asarray(x) for x in sample_inputs])
+        with self._state_lock:
+            if self._thread is None:
+                raise RuntimeError('BatchingPredictor has not been started')
+            self._queue.put(request)
+        request.event.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        """
+        Get serving statistics
+
+        :return: a dict with the entries `'queue_depth'`, `'n_requests'`, `'n_batches'`, `'mean_batch_size'`
+            and the latency percentiles in seconds `'latency_p50'`, `'latency_p90'`, `'latency_p99'`
+            (`None` if no requests have been served)
+        """
+        with self._stats_lock:
+            latencies = np.array(self._latencies)
+            n_requests = self._n_requests
+            n_batches = self._n_batches
+        stats = {
+            'queue_depth': self._queue.qsize(),
+            'n_requests': n_requests,
+            'n_batches': n_batches,
+            'mean_batch_size': float(n_requests) / n_batches if n_batches > 0 else None,
+        }
+        for p in (50, 90, 99):
+            stats['latency_p{}'.format(p)] = float(np.percentile(latencies, p)) if len(latencies) > 0 else None
+        return stats
+
+    def _worker(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is _STOP:
+                break
+            requests = [first]
+            deadline = first.enqueue_time + self.max_latency
+            while len(requests) < self.max_batch_size:
+                remaining = deadline - time.time()
+                try:
+                    if remaining > 0.0:
+                        req = self._queue.get(timeout=remaining)
+                    else:
+                        # Out of time; only take requests that are already waiting
+                        req = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if req is _STOP:
+                    stopping = True
+                    break
+                requests.append(req)
+            # Requests whose inputs differ in number, shape or data type cannot be stacked into one mini-batch;
+            # dispatch each group of compatible requests separately, so that a malformed request only causes
+            # its own group to fail rather than every request batched with it
+            groups = collections.OrderedDict()
+            for req in requests:
+                groups.setdefault(req.signature, []).append(req)
+            for group in groups.values():
+                self._process_batch(group)
+
+        # Fail any requests left behind `_STOP` rather than leaving their callers blocked forever
+        while True:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is not _STOP:
+                req.error = RuntimeError('BatchingPredictor stopped')
+                req.event.set()
+
+    def _process_batch(self, requests):
+        try:
+            batch = [np.stack([req.inputs[i] for req in requests], axis=0)
+                     for i in range(len(requests[0].inputs))]
+            outputs = self.predict_fn(*batch)
+        except Exception as e:
+            for req in requests:
+                req.error = e
+                req.event.set()
+            return
+
+        t = time.time()
+        for j, req in enumerate(requests):
+            req.result = [out[j] for out in outputs]
+            req.event.set()
+
+        with self._stats_lock:
+            self._latencies.extend([t - req.enqueue_time for req in requests])
+            self._n_requests += len(requests)
+            self._n_batches += 1
+
+
+class _PredictionRequestHandler (BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            with np.load(six.BytesIO(self.rfile.read(length))) as f:
+                sample_inputs = [f['arr_%d' % i] for i in range(len(f.files))]
+        except Exception:
+            self.send_error(400, 'Request body should be an NPZ archive of input arrays')
+            return
+
+        try:
+            outputs = self.server.predictor.predict(*sample_inputs)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        body = six.BytesIO()
+        np.savez(body, *outputs)
+        self._send(body.getvalue(), 'application/octet-stream')
+
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+        self._send(json.dumps(self.server.predictor.stats()).encode('utf-8'), 'application/json')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _ThreadingHTTPServer (socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve_http(predictor, host='127.0.0.1', port=8080):
+    """
+    Serve predictions over HTTP; see the module docstring for the protocol. Blocks until interrupted.
+    Each HTTP request is handled in its own thread so that concurrent requests are batched together.
+
+    :param predictor: a `BatchingPredictor` instance
+    :param host: (default='127.0.0.1') host name or address to listen on
+    :param port: (default=8080) port to listen on
+    """
+    server = _ThreadingHTTPServer((host, port), _PredictionRequestHandler)
+    server.predictor = predictor
+    predictor.start()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        predictor.stop()
+
+
+import unittest
+
+class Test_BatchingPredictor (unittest.TestCase):
+    def test_batches_and_scatters(self):
+        batch_sizes = []
+        def predict_fn(x):
+            batch_sizes.append(x.shape[0])
+            return [x * 2.0, x.sum(axis=1)]
+
+        results = {}
+        def request(i):
+            results[i] = predictor.predict(np.full((3,), float(i)))
+
+        predictor = BatchingPredictor(predict_fn, max_batch_size=8, max_latency=0.05)
+        with predictor:
+            threads = [threading.Thread(target=request, args=(i,)) for i in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            stats = predictor.stats()
+
+        self.assertEqual(sum(batch_sizes), 20)
+        self.assertTrue(max(batch_sizes) <= 8)
+        self.assertTrue(len(batch_sizes) < 20)
+        for i in range(20):
+            self.assertTrue((results[i][0] == np.full((3,), i * 2.0)).all())
+            self.assertEqual(results[i][1], i * 3.0)
+        self.assertEqual(stats['n_requests'], 20)
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertTrue(stats['latency_p99'] >= stats['latency_p50'])
+
+    def test_malformed_request(self):
+        def predict_fn(x):
+            if x.shape[1:] != (3,):
+                raise ValueError('expected inputs of shape (3,)')
+            return [x * 2.0]
+
+        results = {}
+        errors = {}
+        def request(i, x):
+            try:
+                results[i] = predictor.predict(x)
+            except ValueError as e:
+                errors[i] = e
+
+        predictor = BatchingPredictor(predict_fn, max_batch_size=16, max_latency=0.1)
+        with predictor:
+            inputs = [np.full((3,), float(i)) for i in range(10)]
+            # A request with the wrong shape, and one with the wrong data type
+            inputs[4] = np.zeros((4,))
+            inputs[7] = np.zeros((3,), dtype=np.int32)
+            threads = [threading.Thread(target=request, args=(i, x)) for i, x in enumerate(inputs)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        self.assertEqual(list(errors.keys()), [4])
+        self.assertEqual(sorted(results.keys()), [i for i in range(10) if i != 4])
+        self.assertTrue((results[3][0] == np.full((3,), 6.0)).all())
+
+    def test_stop(self):
+        predictor = BatchingPredictor(lambda x: [x * 2.0], max_batch_size=4, max_latency=0.01)
+        self.assertRaises(RuntimeError, predictor.predict, np.zeros((3,)))
+        with predictor:
+            self.assertTrue((predictor.predict(np.ones((3,)))[0] == 2.0).all())
+        self.assertRaises(RuntimeError, predictor.predict, np.zeros((3,)))
+
+        # A request that reaches the queue after `_STOP` is failed rather than left waiting
+        predictor.start()
+        worker = predictor._thread
+        request = _PredictionRequest([np.zeros((3,))])
+        predictor._queue.put(_STOP)
+        predictor._queue.put(request)
+        worker.join()
+        self.assertTrue(request.event.is_set())
+        self.assertTrue(isinstance(request.error, RuntimeError))
+        predictor.stop()
@@ -0,0 +1,112 @@
+"""
+Threshold-free metrics computed from fixed-size score histograms
+
+Histograms are additive over mini-batches, so these metrics can be accumulated during evaluation in
+constant memory. Scores are probabilities in the range [0, 1] that are binned into `n_bins` equal width bins;
+the resolution of the resulting metrics is limited by the number of bins.
+"""
+import numpy as np
+
+
+def score_bins(scores, n_bins):
+    """
+    Compute the histogram bin index of each score
+
+    :param scores: probabilities in the range [0, 1]
+    :param n_bins: number of bins
+    :return: integer bin indices
+    """
+    return np.clip(np.floor(np.asarray(scores) * n_bins), 0, n_bins - 1).astype(int)
+
+
+def roc_auc_from_histograms(pos_hist, neg_hist):
+    """
+    Compute the area under the ROC curve from histograms of the scores of positive and negative samples.
+    Samples whose scores fall in the same bin are treated as ties.
+
+    :param pos_hist: histogram of the scores of positive samples; shape `(n_bins,)` or `(n_classes, n_bins)`
+    :param neg_hist: histogram of the scores of negative samples; same shape as `pos_hist`
+    :return: the ROC AUC; if the histograms have a class axis, the mean over classes that have both positive
+        and negative samples. `nan` if there are none.
+    """
+    pos_hist = np.atleast_2d(np.asarray(pos_hist, dtype=float))
+    neg_hist = np.atleast_2d(np.asarray(neg_hist, dtype=float))
+    n_pos = pos_hist.sum(axis=1)
+    n_neg = neg_hist.sum(axis=1)
+    # Number of negatives in lower bins than each bin
+    neg_below = np.cumsum(neg_hist, axis=1) - neg_hist
+    wins = (pos_hist * (neg_below + 0.5 * neg_hist)).sum(axis=1)
+    valid = (n_pos > 0) & (n_neg > 0)
+    if not valid.any():
+        return np.nan
+    return float(np.mean(wins[valid] / (n_pos[valid] * n_neg[valid])))
+
+
+def pr_auc_from_histograms(pos_hist, neg_hist):
+    """
+    Compute the area under the precision-recall curve (average precision) from histograms of the scores
+    of positive and negative samples, using each bin boundary as a threshold.
+
+    :param pos_hist: histogram of the scores of positive samples; shape `(n_bins,)` or `(n_classes, n_bins)`
+    :param neg_hist: histogram of the scores of negative samples; same shape as `pos_hist`
+    :return: the average precision; if the histograms have a class axis, the mean over classes that have
+        positive samples. `nan` if there are none.
+    """
+    pos_hist = np.atleast_2d(np.asarray(pos_hist, dtype=float))
+    neg_hist = np.atleast_2d(np.asarray(neg_hist, dtype=float))
+    n_pos = pos_hist.sum(axis=1)
+    # Lower the threshold from the highest bin
+    tp = np.cumsum(pos_hist[:, ::-1], axis=1)
+    fp = np.cumsum(neg_hist[:, ::-1], axis=1)
+    detected = tp + fp
+    precision = np.where(detected > 0, tp / np.where(detected > 0, detected, 1.0), 0.0)
+    valid = n_pos > 0
+    if not valid.any():
+        return np.nan
+    ap = (pos_hist[:, ::-1] * precision).sum(axis=1)
+    return float(np.mean(ap[valid] / n_pos[valid]))
+
+
+def ece_from_histograms(count_hist, confidence_hist, correct_hist):
+    """
+    Compute the expected calibration error from per-bin statistics of the confidence of the predicted class
+
+    :param count_hist: number of samples in each confidence bin
+    :param confidence_hist: sum of the confidences of the samples in each bin
+    :param correct_hist: number of correctly classified samples in each bin
+    :return: the expected calibration error; `nan` if there are no samples
+    """
+    total = np.sum(count_hist)
+    if total == 0:
+        return np.nan
+    return float(np.abs(np.asarray(correct_hist, dtype=float) - np.asarray(confidence_hist, dtype=float)).sum() /
+                 total)
+
+
+import unittest
+
+class Test_Metrics (unittest.TestCase):
+    def test_roc_auc(self):
+        rng = np.random.RandomState(12345)
+        pos = rng.uniform(0.3, 1.0, size=(500,))
+        neg = rng.uniform(0.0, 0.7, size=(700,))
+        n_bins = 1000
+        pos_hist = np.bincount(score_bins(pos, n_bins), minlength=n_bins)
+        neg_hist = np.bincount(score_bins(neg, n_bins), minlength=n_bins)
+        exact = (pos[:, None] > neg[None, :]).mean()
+        self.assertAlmostEqual(roc_auc_from_histograms(pos_hist, neg_hist), exact, places=2)
+        # Perfect separation and chance
+        self.assertEqual(roc_auc_from_histograms([0, 0, 3], [2, 0, 0]), 1.0)
+        self.assertEqual(roc_auc_from_histograms([1, 1], [1, 1]), 0.5)
+        self.assertTrue(np.isnan(roc_auc_from_histograms([0, 0], [1, 1])))
+
+    def test_pr_auc(self):
+        self.assertEqual(pr_auc_from_histograms([0, 0, 3], [2, 0, 0]), 1.0)
+        # Positives in the top bin with an equal number of negatives: precision 0.5
+        self.assertEqual(pr_auc_from_histograms([0, 2], [0, 2]), 0.5)
+        # Class axis
+        self.assertEqual(pr_auc_from_histograms([[0, 2], [0, 0]], [[0, 2], [1, 1]]), 0.5)
+
+    def test_ece(self):
+        self.assertEqual(ece_from_histograms([10, 10], [2.0, 9.0], [2, 9]), 0.0)
+        self.assertAlmostEqual(ece_from_histograms([10, 0], [5.0, 0.0], [10, 0]), 0.5)
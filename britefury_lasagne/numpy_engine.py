@@ -0,0 +1,608 @@
+"""
+NumPy inference engine
+
+Converts a Lasagne network - e.g. the network of a `basic_dnn.BasicDNN` or of a pre-trained ImageNet
+model such as `ResNet50Model` or `VGG16Model` - into a `NumpyNetwork` that evaluates it using
+vectorised NumPy/BLAS operations. Convolutions use im2col and weights that are pre-transposed at conversion time.
+
+The runtime only depends on NumPy; Lasagne and Theano are only needed to convert a network. A converted
+network can be saved with `NumpyNetwork.save` and loaded with `NumpyNetwork.load` in a worker process
+that never imports Theano:
+
+>>> numpy_engine.from_dnn(clf).save('clf_engine.npz')
+>>> # In the worker:
+>>> net = numpy_engine.NumpyNetwork.load('clf_engine.npz')
+>>> pred_prob = net(X)[0]
+
+Supported layers: `InputLayer`, `Conv2DLayer` (and the cuDNN variant), `DilatedConv2DLayer`, `DenseLayer`,
+`NINLayer`, `Pool2DLayer`, `BatchNormLayer`, `ElemwiseSumLayer`, `NonlinearityLayer`, `PadLayer`,
+`FlattenLayer`, `DimshuffleLayer`, and `DropoutLayer` and `GaussianNoiseLayer` (both of which are no-ops
+in deterministic mode).
+"""
+import json
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+#
+# Runtime: NumPy only
+#
+
+def _softmax(x, axis=1):
+    e = np.exp(x - x.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def _apply_nonlinearity(x, config):
+    name = config['nonlinearity']
+    if name == 'linear':
+        return x
+    elif name == 'rectify':
+        return np.maximum(x, 0)
+    elif name == 'leaky_rectify':
+        return np.where(x > 0, x, x * config['leakiness'])
+    elif name == 'sigmoid':
+        return 0.5 * (np.tanh(x * 0.5) + 1)
+    elif name == 'tanh':
+        return np.tanh(x)
+    elif name == 'scaled_tanh':
+        return np.tanh(x * config['scale_in']) * config['scale_out']
+    elif name == 'softplus':
+        return np.logaddexp(0, x)
+    elif name == 'elu':
+        return np.where(x > 0, x, np.expm1(np.minimum(x, 0)))
+    elif name == 'softmax':
+        return _softmax(x * config.get('inv_temperature', 1.0), axis=1)
+    else:
+        raise ValueError('Unknown nonlinearity {}'.format(name))
+
+
+def im2col(x, filter_size, stride=(1, 1), dilation=(1, 1)):
+    """
+    Extract convolution patches from `x` as the rows of a matrix
+
+    :param x: input of shape `(sample, channel, height, width)`
+    :param filter_size: filter size `(fh, fw)`
+    :param stride: stride `(sh, sw)`
+    :param dilation: dilation `(dh, dw)`
+    :return: `(cols, out_h, out_w)` where `cols` has shape `(sample * out_h * out_w, channel * fh * fw)`
+    """
+    N, C, H, W = x.shape
+    fh, fw = filter_size
+    sh, sw = stride
+    dh, dw = dilation
+    out_h = (H - (fh - 1) * dh - 1) // sh + 1
+    out_w = (W - (fw - 1) * dw - 1) // sw + 1
+    s_n, s_c, s_h, s_w = x.strides
+    patches = as_strided(x, shape=(N, out_h, out_w, C, fh, fw),
+                         strides=(s_n, s_h * sh, s_w * sw, s_c, s_h * dh, s_w * dw))
+    return patches.reshape((N * out_h * out_w, C * fh * fw)), out_h, out_w
+
+
+def _pad_spatial(x, pad, value=0):
+    if any(p != (0, 0) for p in pad):
+        x = np.pad(x, [(0, 0)] * (x.ndim - len(pad)) + list(pad), mode='constant', constant_values=value)
+    return x
+
+
+def _op_conv2d(inputs, config, arrays):
+    x, = inputs
+    ph, pw = config['pad']
+    x = _pad_spatial(x, [(ph, ph), (pw, pw)])
+    cols, out_h, out_w = im2col(x, config['filter_size'], config['stride'], config['dilation'])
+    W_mat = arrays['W_mat']
+    y = cols.dot(W_mat).reshape((x.shape[0], out_h, out_w, W_mat.shape[1])).transpose(0, 3, 1, 2)
+    if 'b' in arrays:
+        b = arrays['b']
+        y = y + (b[None, :, None, None] if b.ndim == 1 else b[None])
+    return _apply_nonlinearity(y, config)
+
+
+def _op_dense(inputs, config, arrays):
+    x, = inputs
+    n_lead = config['num_leading_axes']
+    lead_shape = x.shape[:n_lead]
+    y = x.reshape((int(np.prod(lead_shape)), -1)).dot(arrays['W'])
+    if 'b' in arrays:
+        y = y + arrays['b']
+    return _apply_nonlinearity(y.reshape(lead_shape + (y.shape[1],)), config)
+
+
+def _op_nin(inputs, config, arrays):
+    x, = inputs
+    # (sample, channel, spatial...) -> (sample, spatial..., unit) -> (sample, unit, spatial...)
+    y = np.tensordot(x, arrays['W'], axes=[[1], [0]])
+    y = np.rollaxis(y, y.ndim - 1, 1)
+    if 'b' in arrays:
+        b = arrays['b']
+        y = y + b.reshape((1,) + b.shape + (1,) * (y.ndim - 1 - b.ndim))
+    return _apply_nonlinearity(y, config)
+
+
+def _pool_output_length(input_length, pool_size, stride, pad, ignore_border):
+    # Follows `lasagne.layers.pool.pool_output_length`
+    if ignore_border:
+        return (input_length + 2 * pad - pool_size + 1 + stride - 1) // stride
+    elif stride >= pool_size:
+        return (input_length + stride - 1) // stride
+    else:
+        return max(0, (input_length - pool_size + stride - 1) // stride) + 1
+
+
+def _pool_windows(x, pool_size, stride, out_shape):
+    s = x.strides
+    return as_strided(x, shape=x.shape[:2] + tuple(out_shape) + tuple(pool_size),
+                      strides=s[:2] + (s[2] * stride[0], s[3] * stride[1]) + s[2:])
+
+
+def _op_pool2d(inputs, config, arrays):
+    x, = inputs
+    pool_size, stride, pad = config['pool_size'], config['stride'], config['pad']
+    mode = config['mode']
+    out_shape = [_pool_output_length(x.shape[2 + i], pool_size[i], stride[i], pad[i], config['ignore_border'])
+                 for i in range(2)]
+    # Pad the input so that every window lies within it; `interior` marks the elements of the
+    # original input, `region` those within the (explicitly) padded input
+    full_shape = [max((out_shape[i] - 1) * stride[i] + pool_size[i], x.shape[2 + i] + 2 * pad[i])
+                  for i in range(2)]
+    extra = [full_shape[i] - x.shape[2 + i] - 2 * pad[i] for i in range(2)]
+    padding = [(pad[0], pad[0] + extra[0]), (pad[1], pad[1] + extra[1])]
+
+    if mode == 'max':
+        xp = _pad_spatial(x, padding, value=-np.inf)
+        return _pool_windows(np.ascontiguousarray(xp), pool_size, stride, out_shape).max(axis=(4, 5))
+    elif mode in ('average_inc_pad', 'average_exc_pad'):
+        xp = np.ascontiguousarray(_pad_spatial(x, padding, value=0))
+        sums = _pool_windows(xp, pool_size, stride, out_shape).sum(axis=(4, 5))
+        counted = np.zeros((1, 1) + tuple(full_shape), dtype=x.dtype)
+        if mode == 'average_inc_pad':
+            counted[:, :, :x.shape[2] + 2 * pad[0], :x.shape[3] + 2 * pad[1]] = 1
+        else:
+            counted[:, :, pad[0]:pad[0] + x.shape[2], pad[1]:pad[1] + x.shape[3]] = 1
+        counts = _pool_windows(counted, pool_size, stride, out_shape).sum(axis=(4, 5))
+        return sums / np.maximum(counts, 1)
+    else:
+        raise ValueError('Unknown pooling mode {}'.format(mode))
+
+
+def _op_scale_shift(inputs, config, arrays):
+    # Batch normalisation in inference mode: `(x - mean) * inv_std * gamma + beta` folded into
+    # a single scale and shift
+    x, = inputs
+    return x * arrays['scale'] + arrays['shift']
+
+
+def _op_elemwise_sum(inputs, config, arrays):
+    y = None
+    for x, c in zip(inputs, config['coeffs']):
+        x = x * c if c != 1 else x
+        y = x if y is None else y + x
+    return y
+
+
+def _op_nonlinearity(inputs, config, arrays):
+    x, = inputs
+    return _apply_nonlinearity(x, config)
+
+
+def _op_pad(inputs, config, arrays):
+    x, = inputs
+    pad = [tuple(p) for p in config['width']]
+    return _pad_spatial(x, pad, value=config['val'])
+
+
+def _op_flatten(inputs, config, arrays):
+    x, = inputs
+    outdim = config['outdim']
+    return x.reshape(x.shape[:outdim - 1] + (-1,))
+
+
+def _op_dimshuffle(inputs, config, arrays):
+    x, = inputs
+    pattern = config['pattern']
+    dims = [p for p in pattern if p != 'x']
+    y = x.transpose(dims)
+    return y.reshape([1 if p == 'x' else x.shape[p] for p in pattern])
+
+
+def _op_argmax(inputs, config, arrays):
+    x, = inputs
+    return np.argmax(x, axis=1).astype(np.int32)
+
+
+def _op_identity(inputs, config, arrays):
+    x, = inputs
+    return x
+
+
+_OP_FUNCTIONS = {
+    'conv2d': _op_conv2d,
+    'dense': _op_dense,
+    'nin': _op_nin,
+    'pool2d': _op_pool2d,
+    'scale_shift': _op_scale_shift,
+    'elemwise_sum': _op_elemwise_sum,
+    'nonlinearity': _op_nonlinearity,
+    'pad': _op_pad,
+    'flatten': _op_flatten,
+    'dimshuffle': _op_dimshuffle,
+    'argmax': _op_argmax,
+    'identity': _op_identity,
+}
+
+
+class NumpyNetwork (object):
+    """
+    A network evaluated using NumPy.
+
+    The network is a list of nodes in topological order. Each node is a dict with the entries
+    `'type'` (`'input'` or a key of `_OP_FUNCTIONS`), `'name'`, `'inputs'` (indices of the nodes whose
+    values it consumes), `'config'` (JSON serialisable settings) and `'arrays'` (a dict of NumPy arrays).
+    """
+    def __init__(self, nodes, input_nodes, output_nodes, dtype=np.float32):
+        """
+        :param nodes: list of nodes in topological order
+        :param input_nodes: indices of the nodes that receive the network inputs
+        :param output_nodes: indices of the nodes whose values are the network outputs
+        :param dtype: data type that inputs are converted to
+        """
+        self.nodes = nodes
+        self.input_nodes = list(input_nodes)
+        self.output_nodes = list(output_nodes)
+        self.dtype = np.dtype(dtype)
+
+        # The index of the last node that uses the value of each node; values are released after that
+        self._last_use = list(range(len(nodes)))
+        for i, node in enumerate(nodes):
+            for j in node['inputs']:
+                self._last_use[j] = i
+        for j in self.output_nodes:
+            self._last_use[j] = len(nodes)
+
+    def __call__(self, *inputs):
+        """
+        Evaluate the network on a mini-batch
+
+        :param inputs: one array per network input
+        :return: a list of arrays, one per network output
+        """
+        if len(inputs) != len(self.input_nodes):
+            raise ValueError('Network has {} inputs, {} provided'.format(len(self.input_nodes), len(inputs)))
+        values = [None] * len(self.nodes)
+        for node_i, x in zip(self.input_nodes, inputs):
+            values[node_i] = np.asarray(x, dtype=self.dtype)
+        for i, node in enumerate(self.nodes):
+            if node['type'] != 'input':
+                op_fn = _OP_FUNCTIONS[node['type']]
+                values[i] = op_fn([values[j] for j in node['inputs']], node['config'], node['arrays'])
+            for j in node['inputs']:
+                if self._last_use[j] == i:
+                    values[j] = None
+        return [values[j] for j in self.output_nodes]
+
+    def predict(self, X, batchsize=500):
+        """
+        Evaluate the network on a data set in mini-batches
+
+        :param X: a list of arrays, one per network input
+        :param batchsize: the mini-batch size
+        :return: a list of arrays, one per network output
+        """
+        N = len(X[0])
+        results = [self(*[x[i:i + batchsize] for x in X]) for i in range(0, N, batchsize)]
+        return [np.concatenate(list(r), axis=0) for r in zip(*results)]
+
+    def save(self, path):
+        """
+        Save the network to an NPZ file
+
+        :param path: the path of the file
+        """
+        arrays = {}
+        spec_nodes = []
+        for i, node in enumerate(self.nodes):
+            array_names = {}
+            for name, arr in node['arrays'].items():
+                key = '{}_{}'.format(i, name)
+                arrays[key] = arr
+                array_names[name] = key
+            spec_nodes.append({'type': node['type'], 'name': node['name'], 'inputs': node['inputs'],
+                               'config': node['config'], 'arrays': array_names})
+        spec = {'nodes': spec_nodes, 'input_nodes': self.input_nodes, 'output_nodes': self.output_nodes,
+                'dtype': self.dtype.name}
+        np.savez(path, __spec__=np.array(json.dumps(spec)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a network saved using `save`
+
+        :param path: the path of the file
+        :return: a `NumpyNetwork`
+        """
+        with np.load(path) as f:
+            spec = json.loads(str(f['__spec__']))
+            nodes = []
+            for node in spec['nodes']:
+                node['arrays'] = {name: f[key] for name, key in node['arrays'].items()}
+                nodes.append(node)
+        return cls(nodes, spec['input_nodes'], spec['output_nodes'], dtype=spec['dtype'])
+
+
+#
+# Conversion from Lasagne; requires Lasagne
+#
+
+def _nonlinearity_config(nonlinearity):
+    import lasagne
+    from . import dnn_objective
+    nl = lasagne.nonlinearities
+
+    if nonlinearity is None or nonlinearity is nl.linear or nonlinearity is nl.identity:
+        return {'nonlinearity': 'linear'}
+    for name in ('rectify', 'sigmoid', 'tanh', 'softplus', 'elu', 'softmax'):
+        if nonlinearity is getattr(nl, name, None):
+            return {'nonlinearity': name}
+    if isinstance(nonlinearity, nl.LeakyRectify):
+        return {'nonlinearity': 'leaky_rectify', 'leakiness': float(nonlinearity.leakiness)}
+    if isinstance(nonlinearity, nl.ScaledTanH):
+        return {'nonlinearity': 'scaled_tanh', 'scale_in': float(nonlinearity.scale_in),
+                'scale_out': float(nonlinearity.scale_out)}
+    if isinstance(nonlinearity, dnn_objective.TemperatureSoftmax):
+        return {'nonlinearity': 'softmax', 'inv_temperature': float(1.0 / nonlinearity.temperature)}
+    raise TypeError('Nonlinearity {} not supported by the NumPy engine'.format(nonlinearity))
+
+
+def _conv_pad(pad, filter_size):
+    if pad == 'valid':
+        return [0, 0]
+    elif pad == 'full':
+        return [f - 1 for f in filter_size]
+    elif pad == 'same':
+        return [f // 2 for f in filter_size]
+    else:
+        return [int(p) for p in pad]
+
+
+def _as_pair(x):
+    if isinstance(x, (tuple, list)):
+        return [int(v) for v in x]
+    return [int(x), int(x)]
+
+
+def _convert_layer(layer, float_dtype):
+    """
+    Convert a Lasagne layer to a node type, config and arrays
+    """
+    import lasagne
+    from . import network_conversion
+    L = lasagne.layers
+
+    def value(p):
+        return np.asarray(p.get_value() if hasattr(p, 'get_value') else p.eval(), dtype=float_dtype)
+
+    def bias(arrays, layer):
+        if getattr(layer, 'b', None) is not None:
+            arrays['b'] = value(layer.b)
+        return arrays
+
+    if isinstance(layer, L.DilatedConv2DLayer):
+        W = value(layer.W)
+        if layer.flip_filters:
+            W = W[:, :, ::-1, ::-1]
+        # Dilated conv weights are (in_chn, out_chn, h, w)
+        W = W.transpose(1, 0, 2, 3)
+        config = {'filter_size': list(W.shape[2:]), 'stride': [1, 1], 'dilation': _as_pair(layer.dilation),
+                  'pad': _conv_pad(layer.pad, W.shape[2:])}
+        config.update(_nonlinearity_config(layer.nonlinearity))
+        return 'conv2d', config, bias({'W_mat': np.ascontiguousarray(W.reshape((W.shape[0], -1)).T)}, layer)
+    elif isinstance(layer, network_conversion._CONV2D_STD_LAYER_TYPES):
+        W = value(layer.W)
+        if layer.flip_filters:
+            W = W[:, :, ::-1, ::-1]
+        config = {'filter_size': list(W.shape[2:]), 'stride': _as_pair(layer.stride),
+                  'dilation': [1, 1], 'pad': _conv_pad(layer.pad, W.shape[2:])}
+        config.update(_nonlinearity_config(layer.nonlinearity))
+        return 'conv2d', config, bias({'W_mat': np.ascontiguousarray(W.reshape((W.shape[0], -1)).T)}, layer)
+    elif isinstance(layer, L.DenseLayer):
+        config = {'num_leading_axes': int(getattr(layer, 'num_leading_axes', 1))}
+        config.update(_nonlinearity_config(layer.nonlinearity))
+        return 'dense', config, bias({'W': value(layer.W)}, layer)
+    elif isinstance(layer, L.NINLayer):
+        config = _nonlinearity_config(layer.nonlinearity)
+        return 'nin', config, bias({'W': value(layer.W)}, layer)
+    elif isinstance(layer, L.Pool2DLayer):
+        config = {'pool_size': _as_pair(layer.pool_size), 'stride': _as_pair(layer.stride),
+                  'pad': _as_pair(layer.pad), 'ignore_border': bool(layer.ignore_border), 'mode': layer.mode}
+        return 'pool2d', config, {}
+    elif isinstance(layer, L.BatchNormLayer):
+        ndim = len(layer.input_shape)
+        axes = layer.axes
+        param_shape = value(layer.mean).shape
+        bshape = []
+        param_dims = iter(param_shape)
+        for i in range(ndim):
+            bshape.append(1 if i in axes else next(param_dims))
+        scale = value(layer.inv_std)
+        if layer.gamma is not None:
+            scale = scale * value(layer.gamma)
+        shift = -value(layer.mean) * scale
+        if layer.beta is not None:
+            shift = shift + value(layer.beta)
+        return 'scale_shift', {}, {'scale': scale.reshape(bshape), 'shift': shift.reshape(bshape)}
+    elif isinstance(layer, L.ElemwiseSumLayer):
+        coeffs = layer.coeffs
+        if not isinstance(coeffs, (list, tuple)):
+            coeffs = [coeffs] * len(layer.input_layers)
+        return 'elemwise_sum', {'coeffs': [float(c) for c in coeffs]}, {}
+    elif isinstance(layer, L.NonlinearityLayer):
+        return 'nonlinearity', _nonlinearity_config(layer.nonlinearity), {}
+    elif isinstance(layer, L.PadLayer):
+        n_spatial = len(layer.input_shape) - layer.batch_ndim
+        width = layer.width
+        if isinstance(width, int):
+            width = [(width, width)] * n_spatial
+        else:
+            width = [(w, w) if isinstance(w, int) else tuple(w) for w in width]
+        return 'pad', {'width': [list(w) for w in width], 'val': float(layer.val)}, {}
+    elif isinstance(layer, L.FlattenLayer):
+        return 'flatten', {'outdim': int(layer.outdim)}, {}
+    elif isinstance(layer, L.DimshuffleLayer):
+        return 'dimshuffle', {'pattern': list(layer.pattern)}, {}
+    elif isinstance(layer, (L.DropoutLayer, L.GaussianNoiseLayer)):
+        return 'identity', {}, {}
+    else:
+        raise TypeError('Layer {} of type {} not supported by the NumPy engine'.format(
+            layer.name, type(layer).__name__))
+
+
+def from_layers(final_layers, input_layers=None, output_postprocess=None, output_argmax=None):
+    """
+    Convert a Lasagne network to a `NumpyNetwork`
+
+    :param final_layers: a Lasagne layer or list of layers that are the outputs of the network
+    :param input_layers: [optional] a list of `InputLayer` instances that defines the order of the inputs;
+        if `None` the input layers are used in the order that Lasagne finds them
+    :param output_postprocess: [optional] a list with an entry for each final layer that is either
+        `None` or a nonlinearity config dict (e.g. `{'nonlinearity': 'softmax'}`) applied to the output
+    :param output_argmax: [optional] a list with an entry for each final layer; if an entry is `True`
+        the output is replaced by the index of its maximum along the channel axis
+    :return: a `NumpyNetwork`
+    """
+    import lasagne
+    from lasagne.utils import floatX
+
+    if isinstance(final_layers, lasagne.layers.Layer):
+        final_layers = [final_layers]
+    float_dtype = floatX(np.zeros((0,))).dtype
+
+    layers = lasagne.layers.get_all_layers(final_layers)
+    layer_to_node = {}
+    nodes = []
+    found_input_nodes = []
+    for layer in layers:
+        if isinstance(layer, lasagne.layers.InputLayer):
+            node = {'type': 'input', 'name': layer.name, 'inputs': [], 'config': {}, 'arrays': {}}
+            found_input_nodes.append(len(nodes))
+        else:
+            if isinstance(layer, lasagne.layers.MergeLayer):
+                in_layers = layer.input_layers
+            else:
+                in_layers = [layer.input_layer]
+            node_type, config, arrays = _convert_layer(layer, float_dtype)
+            node = {'type': node_type, 'name': layer.name, 'inputs': [layer_to_node[l] for l in in_layers],
+                    'config': config, 'arrays': arrays}
+        layer_to_node[layer] = len(nodes)
+        nodes.append(node)
+
+    if input_layers is None:
+        input_nodes = found_input_nodes
+    else:
+        input_nodes = [layer_to_node[layer] for layer in input_layers]
+
+    output_nodes = []
+    for i, layer in enumerate(final_layers):
+        out_node = layer_to_node[layer]
+        post = output_postprocess[i] if output_postprocess is not None else None
+        if post is not None:
+            nodes.append({'type': 'nonlinearity', 'name': None, 'inputs': [out_node], 'config': post,
+                          'arrays': {}})
+            out_node = len(nodes) - 1
+        if output_argmax is not None and output_argmax[i]:
+            nodes.append({'type': 'argmax', 'name': None, 'inputs': [out_node], 'config': {}, 'arrays': {}})
+            out_node = len(nodes) - 1
+        output_nodes.append(out_node)
+
+    return NumpyNetwork(nodes, input_nodes, output_nodes, dtype=float_dtype)
+
+
+def from_dnn(dnn):
+    """
+    Convert the network of a `basic_dnn.BasicDNN` to a `NumpyNetwork` whose outputs match the predictions
+    of `dnn._predict_fn`
+
+    :param dnn: a `basic_dnn.BasicDNN` instance
+    :return: a `NumpyNetwork`
+    """
+    import lasagne
+    from . import dnn_objective
+
+    input_layers = [layer for layer in lasagne.layers.get_all_layers(dnn.final_layers)
+                    if isinstance(layer, lasagne.layers.InputLayer)]
+    var_to_layer = {layer.input_var: layer for layer in input_layers}
+    ordered_inputs = [var_to_layer[v] for v in dnn.input_vars]
+
+    final_layers = []
+    post = []
+    argmax = []
+    for obj in dnn.objectives:
+        if isinstance(obj, dnn_objective.ClassifierObjective):
+            if obj.prediction_mode == obj.PREDICTION_TOPK:
+                raise TypeError('The \'topk\' prediction mode is not supported by the NumPy engine')
+            final_layers.append(obj.objective_layer)
+            is_argmax = obj.prediction_mode == obj.PREDICTION_ARGMAX
+            post.append(_nonlinearity_config(obj.softmax) if obj.softmax is not None and not is_argmax else None)
+            argmax.append(is_argmax)
+        elif isinstance(obj, dnn_objective.RegressorObjective):
+            final_layers.append(obj.objective_layer)
+            post.append(None)
+            argmax.append(False)
+        else:
+            raise TypeError('Objective of type {} not supported by the NumPy engine'.format(type(obj).__name__))
+    return from_layers(final_layers, input_layers=ordered_inputs, output_postprocess=post, output_argmax=argmax)
+
+
+def from_imagenet_model(model):
+    """
+    Convert the network of a pre-trained ImageNet model (see `pretrained.imagenet`) to a `NumpyNetwork`
+
+    :param model: a `pretrained.imagenet.AbstractImageNetModel` instance
+    :return: a `NumpyNetwork`
+    """
+    return from_layers(model.final_layer)
+
+
+import unittest
+
+class Test_NumpyEngine (unittest.TestCase):
+    def test_conv2d(self):
+        rng = np.random.RandomState(12345)
+        x = rng.normal(size=(2, 3, 9, 8))
+        W = rng.normal(size=(4, 3, 3, 2))
+        b = rng.normal(size=(4,))
+        for stride, dilation, pad in [((1, 1), (1, 1), (0, 0)), ((2, 1), (1, 1), (1, 1)), ((1, 1), (2, 2), (0, 0))]:
+            config = {'filter_size': [3, 2], 'stride': list(stride), 'dilation': list(dilation), 'pad': list(pad),
+                      'nonlinearity': 'linear'}
+            y = _op_conv2d([x], config, {'W_mat': W.reshape((4, -1)).T, 'b': b})
+
+            xp = np.pad(x, [(0, 0), (0, 0), (pad[0], pad[0]), (pad[1], pad[1])], mode='constant')
+            out_h = (xp.shape[2] - 2 * dilation[0] - 1) // stride[0] + 1
+            out_w = (xp.shape[3] - 1 * dilation[1] - 1) // stride[1] + 1
+            expected = np.zeros((2, 4, out_h, out_w))
+            for i in range(out_h):
+                for j in range(out_w):
+                    y0, x0 = i * stride[0], j * stride[1]
+                    patch = xp[:, :, y0:y0 + 2 * dilation[0] + 1:dilation[0], x0:x0 + dilation[1] + 1:dilation[1]]
+                    expected[:, :, i, j] = np.tensordot(patch, W, axes=[[1, 2, 3], [1, 2, 3]]) + b
+            self.assertTrue(np.allclose(y, expected))
+
+    def test_pool2d(self):
+        x = np.random.RandomState(12345).normal(size=(2, 3, 7, 7))
+        y = _op_pool2d([x], {'pool_size': [2, 2], 'stride': [2, 2], 'pad': [0, 0], 'ignore_border': True,
+                             'mode': 'max'}, {})
+        self.assertTrue(np.allclose(y, x[:, :, :6, :6].reshape((2, 3, 3, 2, 3, 2)).max(axis=(3, 5))))
+
+        y = _op_pool2d([x], {'pool_size': [2, 2], 'stride': [2, 2], 'pad': [0, 0], 'ignore_border': False,
+                             'mode': 'max'}, {})
+        self.assertEqual(y.shape, (2, 3, 4, 4))
+        self.assertTrue(np.allclose(y[:, :, 3, 3], x[:, :, 6, 6]))
+
+        y = _op_pool2d([x], {'pool_size': [3, 3], 'stride': [1, 1], 'pad': [1, 1], 'ignore_border': True,
+                             'mode': 'average_exc_pad'}, {})
+        self.assertEqual(y.shape, (2, 3, 7, 7))
+        self.assertTrue(np.allclose(y[:, :, 0, 0], x[:, :, :2, :2].mean(axis=(2, 3))))
+        self.assertTrue(np.allclose(y[:, :, 3, 3], x[:, :, 2:5, 2:5].mean(axis=(2, 3))))
+
+        y = _op_pool2d([x], {'pool_size': [3, 3], 'stride': [1, 1], 'pad': [1, 1], 'ignore_border': True,
+                             'mode': 'average_inc_pad'}, {})
+        self.assertTrue(np.allclose(y[:, :, 0, 0], x[:, :, :2, :2].sum(axis=(2, 3)) / 9.0))
@@ -0,0 +1,197 @@
+"""
+Name keyed parameter storage
+
+Parameters are stored in a directory that contains an uncompressed `.npy` file for each parameter
+and an `index.json` file that maps parameter keys to files. Parameter keys are of the form
+`'<layer path>/<parameter name>'`, where the layer path is the layer name, or if the layer
+has no name, its index in the network followed by its type, e.g. `'conv1/W'` or `'3_DenseLayer/b'`.
+Only named layers are robust to changes in the network architecture; unnamed layers are keyed by position,
+so inserting, removing or reordering layers can cause the parameters of an unnamed layer to be loaded
+into another layer of the same type whose parameters have matching shapes.
+
+As the parameters are stored in separate uncompressed files they can be memory mapped, and a subset of them
+can be loaded without reading the rest.
+"""
+import os
+import json
+import collections
+import numpy as np
+import lasagne
+
+_INDEX_FILENAME = 'index.json'
+_FORMAT_VERSION = 1
+
+
+def layer_path(layer, index):
+    """
+    Get the path used to identify a layer in parameter keys
+
+    :param layer: a Lasagne layer
+    :param index: the index of the layer in the list of layers returned by `lasagne.layers.get_all_layers`
+    :return: the layer path as a string
+    """
+    if layer.name:
+        return layer.name
+    else:
+        return '{}_{}'.format(index, type(layer).__name__)
+
+
+def _param_name(layer, param):
+    name = param.name or 'param'
+    if layer.name and name.startswith(layer.name + '.'):
+        name = name[len(layer.name) + 1:]
+    return name
+
+
+def network_param_keys(final_layers, updates=None):
+    """
+    Generate keys for the parameters of a network
+
+    :param final_layers: a Lasagne layer or list of layers that when followed backward will
+            result in all layers being visited
+    :param updates: [optional] an updates dictionary or list of `(param, update)` pairs; parameters
+            that are not part of the network (e.g. optimiser state) will be given keys of the form
+            `'updates/<index>_<name>'`
+    :return: an `OrderedDict` mapping key to parameter (a Theano shared variable)
+
+    Raises `ValueError` if two parameters have the same key, e.g. if two layers have the same name;
+    otherwise one of them would silently be left out when saving and loading.
+
+    Note that unnamed layers are keyed by their position in the network, so name the layers of networks
+    whose architecture may change.
+    """
+    keyed = collections.OrderedDict()
+    seen = set()
+
+    def add(key, param):
+        if key in keyed:
+            raise ValueError('Parameter key {} is not unique; give the layers in the network '
+                             'unique names'.format(key))
+        keyed[key] = param
+        seen.add(param)
+
+    for i, layer in enumerate(lasagne.layers.get_all_layers(final_layers)):
+        path = layer_path(layer, i)
+        for param in layer.params.keys():
+            if param not in seen:
+                add('{}/{}'.format(path, _param_name(layer, param)), param)
+
+    if updates is not None:
+        if isinstance(updates, dict):
+            params = list(updates.keys())
+        elif isinstance(updates, (list, tuple)):
+            params = [upd[0] for upd in updates]
+        else:
+            raise TypeError('updates should be a dict mapping parameter to update expression '
+                            'or a sequence of tuples of (parameter, update_expression) pairs')
+        n_updates = 0
+        for p in params:
+            if p not in seen:
+                add('updates/{}_{}'.format(n_updates, p.name or 'param'), p)
+                n_updates += 1
+
+    return keyed
+
+
+def save_named_params(path, named_values):
+    """
+    Save named parameter values to the directory at `path`, creating it if necessary
+
+    :param path: the path of the directory
+    :param named_values: an `OrderedDict` mapping key to NumPy array
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    entries = []
+    for i, (key, value) in enumerate(named_values.items()):
+        value = np.asarray(value)
+        filename = '{:05d}.npy'.format(i)
+        np.save(os.path.join(path, filename), value)
+        entries.append({'key': key, 'file': filename, 'shape': list(value.shape), 'dtype': str(value.dtype)})
+    with open(os.path.join(path, _INDEX_FILENAME), 'w') as f:
+        json.dump({'format': _FORMAT_VERSION, 'params': entries}, f, indent=1)
+
+
+def load_named_params_index(path):
+    """
+    Load the index of a named parameter directory
+
+    :param path: the path of the directory
+    :return: an `OrderedDict` mapping key to a dict with the entries `'file'`, `'shape'` and `'dtype'`
+    """
+    with open(os.path.join(path, _INDEX_FILENAME), 'r') as f:
+        index = json.load(f)
+    if index.get('format') != _FORMAT_VERSION:
+        raise ValueError('Unknown named parameter format {} in {}'.format(index.get('format'), path))
+    return collections.OrderedDict([(entry['key'], entry) for entry in index['params']])
+
+
+def load_named_params(path, keys=None, mmap_mode='r'):
+    """
+    Load named parameter values from the directory at `path`
+
+    :param path: the path of the directory
+    :param keys: [optional] the keys of the parameters to load; if `None` all are loaded.
+        Raises `KeyError` if a key is not present.
+    :param mmap_mode: (default='r') the memory map mode passed to `np.load`; `None` to read into memory
+    :return: an `OrderedDict` mapping key to NumPy array
+    """
+    index = load_named_params_index(path)
+    if keys is None:
+        keys = list(index.keys())
+    values = collections.OrderedDict()
+    for key in keys:
+        try:
+            entry = index[key]
+        except KeyError:
+            raise KeyError('No parameter with key {} in {}'.format(key, path))
+        values[key] = np.load(os.path.join(path, entry['file']), mmap_mode=mmap_mode)
+    return values
+
+
+def is_named_params_path(path):
+    """
+    Determine if `path` is a named parameter directory
+
+    :param path: the path
+    :return: `True` if `path` is a directory that contains a named parameter index
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, _INDEX_FILENAME))
+
+
+import unittest
+
+class Test_param_store (unittest.TestCase):
+    def test_save_load(self):
+        import shutil, tempfile
+        path = tempfile.mkdtemp()
+        try:
+            values = collections.OrderedDict([('conv1/W', np.arange(24, dtype=np.float32).reshape((2, 3, 2, 2))),
+                                              ('3_DenseLayer/b', np.zeros((5,), dtype=np.float64))])
+            save_named_params(path, values)
+            self.assertTrue(is_named_params_path(path))
+            index = load_named_params_index(path)
+            self.assertEqual(list(index.keys()), ['conv1/W', '3_DenseLayer/b'])
+            self.assertEqual(index['conv1/W']['shape'], [2, 3, 2, 2])
+            loaded = load_named_params(path)
+            self.assertEqual(list(loaded.keys()), list(values.keys()))
+            for key in values.keys():
+                self.assertEqual(loaded[key].dtype, values[key].dtype)
+                self.assertTrue((loaded[key] == values[key]).all())
+            subset = load_named_params(path, keys=['3_DenseLayer/b'], mmap_mode=None)
+            self.assertEqual(list(subset.keys()), ['3_DenseLayer/b'])
+            self.assertRaises(KeyError, load_named_params, path, keys=['missing/W'])
+        finally:
+            shutil.rmtree(path)
+
+    def test_keys(self):
+        net = lasagne.layers.InputLayer(shape=(None, 4))
+        net = lasagne.layers.DenseLayer(net, num_units=3, name='fc')
+        net = lasagne.layers.DenseLayer(net, num_units=2)
+        self.assertEqual(list(network_param_keys(net).keys()), ['fc/W', 'fc/b', '2_DenseLayer/W', '2_DenseLayer/b'])
+
+    def test_duplicate_keys(self):
+        net = lasagne.layers.InputLayer(shape=(None, 4))
+        net = lasagne.layers.DenseLayer(net, num_units=3, name='fc')
+        net = lasagne.layers.DenseLayer(net, num_units=2, name='fc')
+        self.assertRaises(ValueError, network_param_keys, net)
@@ -0,0 +1,151 @@
+"""
+Profiling of Theano functions and Lasagne networks
+
+Theano profiles the nodes of the optimised graph of a compiled function; after optimisation these nodes
+can no longer be reliably attributed to the Lasagne layers that generated them. `op_report` therefore
+aggregates profiling statistics per op, while `layer_report` measures each layer separately by compiling
+a function per layer and evaluating it on the layer's actual input for a sample mini-batch.
+"""
+import time
+import collections
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+
+from . import param_store
+
+
+def new_profile_stats(name):
+    """
+    Create a Theano `ProfileStats` instance that is not printed at exit
+
+    :param name: name used in messages
+    :return: a `theano.compile.profiling.ProfileStats` instance
+    """
+    return theano.compile.profiling.ProfileStats(atexit_print=False, message=name)
+
+
+def _var_bytes(var, shape):
+    if shape is None or any(s is None for s in shape):
+        return 0
+    return int(np.prod(shape)) * np.dtype(var.dtype).itemsize
+
+
+def op_report(profile):
+    """
+    Aggregate the statistics gathered by a `ProfileStats` instance per op
+
+    :param profile: a `theano.compile.profiling.ProfileStats` instance
+    :return: a dict with the entries `'n_calls'` (the number of times the function was called),
+        `'call_time'` (total time spent in the function in seconds) and `'ops'`, a list of dicts, one per op
+        sorted by time in descending order, with the entries `'op'`, `'op_class'`, `'time'`, `'n_calls'`,
+        `'n_nodes'`, `'fraction'` (of the total time of all ops) and `'output_bytes'` (total size of the
+        outputs of the last call of each node)
+    """
+    ops = collections.OrderedDict()
+    for key, t in profile.apply_time.items():
+        node = key[1] if isinstance(key, tuple) else key
+        op_name = str(node.op)
+        entry = ops.get(op_name)
+        if entry is None:
+            entry = {'op': op_name, 'op_class': type(node.op).__name__, 'time': 0.0, 'n_calls': 0,
+                     'n_nodes': 0, 'output_bytes': 0}
+            ops[op_name] = entry
+        entry['time'] += t
+        entry['n_calls'] += profile.apply_callcount.get(key, 0)
+        entry['n_nodes'] += 1
+        for var in node.outputs:
+            entry['output_bytes'] += _var_bytes(var, profile.variable_shape.get(var))
+
+    total_time = sum(entry['time'] for entry in ops.values())
+    for entry in ops.values():
+        entry['fraction'] = entry['time'] / total_time if total_time > 0.0 else 0.0
+
+    return {
+        'n_calls': profile.fct_callcount,
+        'call_time': profile.fct_call_time,
+        'ops': sorted(ops.values(), key=lambda e: e['time'], reverse=True),
+    }
+
+
+def layer_report(final_layers, input_vars, batch, n_repeats=5):
+    """
+    Time each layer of a network on a sample mini-batch. The network is evaluated layer by layer;
+    each layer is compiled into a separate function that is timed on the output of the layers that precede it.
+    Note that this prevents Theano from optimising across layer boundaries, so the sum of the layer
+    times will generally exceed the time taken by the complete network.
+
+    :param final_layers: a Lasagne layer or list of layers that when followed backward will
+            result in all layers being visited
+    :param input_vars: the input variables of the network, a list of Theano variables
+    :param batch: a mini-batch; a list of arrays, one per input variable
+    :param n_repeats: (default=5) the number of times each layer function is run; the mean time is reported
+    :return: a list of dicts, one per layer, with the entries `'layer'` (the layer path as used by
+        `param_store`), `'type'`, `'time'` (in seconds), `'fraction'` (of the total time of all layers),
+        `'output_shape'`, `'output_bytes'` and `'param_bytes'`
+    """
+    values = {}
+    layers = []
+    for i, layer in enumerate(lasagne.layers.get_all_layers(final_layers)):
+        param_bytes = sum([p.get_value(borrow=True).nbytes for p in layer.get_params()])
+        if isinstance(layer, lasagne.layers.InputLayer):
+            for var, x in zip(input_vars, batch):
+                if var is layer.input_var:
+                    values[layer] = np.asarray(x)
+                    break
+            else:
+                raise ValueError('Input layer {} does not use any of the input variables'.format(layer.name))
+            t = 0.0
+        else:
+            if isinstance(layer, lasagne.layers.MergeLayer):
+                in_values = [values[l] for l in layer.input_layers]
+            else:
+                in_values = [values[layer.input_layer]]
+            in_vars = [T.TensorType(x.dtype, (False,) * x.ndim)() for x in in_values]
+            if isinstance(layer, lasagne.layers.MergeLayer):
+                out_expr = layer.get_output_for(in_vars, deterministic=True)
+            else:
+                out_expr = layer.get_output_for(in_vars[0], deterministic=True)
+            fn = theano.function(in_vars, out_expr)
+            # Warm up
+            y = fn(*in_values)
+            t0 = time.time()
+            for _ in range(n_repeats):
+                y = fn(*in_values)
+            t = (time.time() - t0) / n_repeats
+            values[layer] = np.asarray(y)
+
+        layers.append({'layer': param_store.layer_path(layer, i), 'type': type(layer).__name__, 'time': t,
+                       'output_shape': values[layer].shape, 'output_bytes': values[layer].nbytes,
+                       'param_bytes': param_bytes})
+
+    total_time = sum(entry['time'] for entry in layers)
+    for entry in layers:
+        entry['fraction'] = entry['time'] / total_time if total_time > 0.0 else 0.0
+    return layers
+
+
+def format_report(report, max_ops=20):
+    """
+    Format a report generated by `BasicDNN.profile_report` as a text table
+
+    :param report: the report dict
+    :param max_ops: (default=20) the maximum number of ops listed for each function
+    :return: the table as a string
+    """
+    lines = []
+    for fn_name, fn_report in report['functions'].items():
+        lines.append('Function {}: {} calls, {:.3f}s'.format(fn_name, fn_report['n_calls'], fn_report['call_time']))
+        lines.append('  {:>7}  {:>10}  {:>8}  {:>12}  {}'.format('%', 'time', 'calls', 'out bytes', 'op'))
+        for entry in fn_report['ops'][:max_ops]:
+            lines.append('  {:>6.1%}  {:>9.4f}s  {:>8}  {:>12}  {}'.format(
+                entry['fraction'], entry['time'], entry['n_calls'], entry['output_bytes'], entry['op']))
+    if report.get('layers') is not None:
+        lines.append('Layers:')
+        lines.append('  {:>7}  {:>10}  {:>12}  {:>12}  {}'.format('%', 'time', 'out bytes', 'param bytes', 'layer'))
+        for entry in report['layers']:
+            lines.append('  {:>6.1%}  {:>9.4f}s  {:>12}  {:>12}  {} ({})'.format(
+                entry['fraction'], entry['time'], entry['output_bytes'], entry['param_bytes'],
+                entry['layer'], entry['type']))
+    return '\n'.join(lines)
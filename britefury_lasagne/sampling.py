@@ -0,0 +1,194 @@
+"""
+Loss prioritised sampling for online hard example mining
+
+`LossPrioritisedSampler` is a data source that draws mini-batches with probability proportional to
+a priority derived from each sample's most recent training loss. Priorities are stored in a `SumTree`,
+so sampling and updating a mini-batch takes `O(batch_size * log(N))` time.
+
+>>> clf = basic_dnn.simple_classifier(build_net, per_sample_loss=True)
+>>> sampler = sampling.LossPrioritisedSampler([train_X, train_y], epoch_size=len(train_X))
+>>> clf.train_prioritised(sampler, val_set=[val_X, val_y], num_epochs=100)
+"""
+import numpy as np
+import lasagne
+from batchup import data_source
+
+
+class SumTree (object):
+    """
+    A binary tree in which each internal node holds the sum of the priorities of its children, supporting
+    vectorised priority updates and sampling proportional to priority.
+    """
+    def __init__(self, capacity):
+        """
+        :param capacity: the number of leaves (samples)
+        """
+        self.capacity = capacity
+        self._n_leaves = 2
+        while self._n_leaves < capacity:
+            self._n_leaves *= 2
+        # Node `i` has children `2i` and `2i+1`; the root is node 1 and the leaves start at `_n_leaves`
+        self._tree = np.zeros((self._n_leaves * 2,), dtype=np.float64)
+
+    @property
+    def total(self):
+        """
+        The sum of all priorities
+        """
+        return self._tree[1]
+
+    def get(self, indices):
+        """
+        Get the priorities of the samples identified by `indices`
+
+        :param indices: sample indices
+        :return: priorities as an array
+        """
+        return self._tree[np.asarray(indices) + self._n_leaves]
+
+    def update(self, indices, priorities):
+        """
+        Set the priorities of the samples identified by `indices`
+
+        :param indices: sample indices
+        :param priorities: the new priorities
+        """
+        nodes = np.asarray(indices) + self._n_leaves
+        self._tree[nodes] = priorities
+        # Recompute the sums on the paths from the updated leaves to the root, one level at a time
+        nodes = np.unique(nodes // 2)
+        while True:
+            self._tree[nodes] = self._tree[nodes * 2] + self._tree[nodes * 2 + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """
+        Find the samples at which the cumulative sum of priorities exceeds `values`
+
+        :param values: values in the range `[0, total)`
+        :return: sample indices; always samples with a positive priority, if there are any
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=int)
+        while nodes[0] < self._n_leaves:
+            left = nodes * 2
+            left_sum = self._tree[left]
+            go_right = values >= left_sum
+            values = np.where(go_right, values - left_sum, values)
+            nodes = np.where(go_right, left + 1, left)
+        # Guard against rounding leading to empty leaves beyond the capacity
+        indices = np.minimum(nodes - self._n_leaves, self.capacity - 1)
+        # Rounding can also lead to a leaf with zero priority, whose importance sampling weight would be
+        # infinite; move these to the nearest preceding leaf with a positive priority
+        zero = self._tree[indices + self._n_leaves] <= 0.0
+        if zero.any():
+            positive = np.flatnonzero(self._tree[self._n_leaves:self._n_leaves + self.capacity] > 0.0)
+            if len(positive) > 0:
+                j = np.searchsorted(positive, indices[zero], side='right') - 1
+                indices[zero] = positive[np.maximum(j, 0)]
+        return indices
+
+
+class LossPrioritisedSampler (data_source.AbstractDataSource):
+    """
+    A data source that draws samples from a sequence of array-likes with probability proportional to
+    `(loss + epsilon) ** alpha`, where `loss` is the sample's most recent training loss.
+
+    Each mini-batch is a list consisting of a batch from each array-like followed by the importance sampling
+    weights `(N * P(i)) ** -beta` (normalised by their maximum within the mini-batch) and the sample indices.
+    Pass the sample indices and their losses to `update_priorities` after each training step;
+    `BasicDNN.train_prioritised` does this.
+    """
+    def __init__(self, arrays, alpha=0.6, beta=0.4, epsilon=1e-6, epoch_size=None, rng=None):
+        """
+        :param arrays: a list of array-likes, e.g. `[X, y]`
+        :param alpha: (default=0.6) priority exponent; 0 gives uniform sampling
+        :param beta: (default=0.4) importance sampling weight exponent; 1 fully compensates for
+            the non-uniform sampling
+        :param epsilon: (default=1e-6) added to losses so that all samples have a non-zero probability
+        :param epoch_size: [optional] the number of samples drawn per epoch; defaults to the number of samples
+        :param rng: [optional] a `np.random.RandomState` used for sampling
+        """
+        self.arrays = arrays
+        self.N = len(arrays[0])
+        for a in arrays[1:]:
+            if len(a) != self.N:
+                raise ValueError('Arrays have inconsistent lengths; {} and {}'.format(self.N, len(a)))
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.epoch_size = epoch_size if epoch_size is not None else self.N
+        self.rng = rng if rng is not None else np.random.RandomState()
+
+        # All samples start with the same priority so that each is likely to be visited early
+        self.tree = SumTree(self.N)
+        self.tree.update(np.arange(self.N), np.ones((self.N,)))
+
+    def num_samples(self, **kwargs):
+        return self.epoch_size
+
+    def update_priorities(self, indices, losses):
+        """
+        Update the priorities of samples from their training losses
+
+        :param indices: sample indices
+        :param losses: per-sample losses
+        """
+        priorities = (np.abs(np.asarray(losses, dtype=np.float64)) + self.epsilon) ** self.alpha
+        self.tree.update(indices, priorities)
+
+    def sample_indices(self, n):
+        """
+        Draw sample indices with probability proportional to priority, using stratified sampling over the
+        cumulative priority
+
+        :param n: the number of samples to draw
+        :return: `(indices, weights)`
+        """
+        total = self.tree.total
+        bounds = np.arange(n) * (total / n)
+        values = bounds + self.rng.uniform(0.0, total / n, size=(n,))
+        indices = self.tree.find(values)
+        probs = self.tree.get(indices) / total
+        weights = (self.N * probs) ** -self.beta
+        weights = weights / weights.max()
+        return indices, weights
+
+    def batch_iterator(self, batch_size, shuffle=None, **kwargs):
+        # Sampling is always random, so `shuffle` is ignored; accepting `**kwargs` also allows use with
+        # `batch.batch_iterator`, which passes `shuffle_rng`
+        for i in range(0, self.epoch_size, batch_size):
+            n = min(batch_size, self.epoch_size - i)
+            indices, weights = self.sample_indices(n)
+            batch = [a[indices] for a in self.arrays]
+            yield batch + [lasagne.utils.floatX(weights), indices]
+
+
+import unittest
+
+class Test_SumTree (unittest.TestCase):
+    def test_update_and_find(self):
+        tree = SumTree(5)
+        tree.update(np.arange(5), np.array([1.0, 2.0, 3.0, 0.0, 4.0]))
+        self.assertEqual(tree.total, 10.0)
+        self.assertEqual(list(tree.find([0.5, 1.5, 3.5, 5.99, 6.0, 9.99])), [0, 1, 2, 2, 4, 4])
+        tree.update([2], [0.0])
+        self.assertEqual(tree.total, 7.0)
+        self.assertEqual(list(tree.find([3.5])), [4])
+        self.assertEqual(list(tree.get([1, 2])), [2.0, 0.0])
+
+    def test_find_zero_priority(self):
+        tree = SumTree(4)
+        tree.update(np.arange(4), np.array([0.0, 1.0, 2.0, 0.0]))
+        # Values at or beyond the total, as can arise from rounding, must not select zero priority leaves
+        self.assertEqual(list(tree.find([0.0, 2.999, 3.0, 3.5])), [1, 2, 2, 2])
+
+    def test_proportional(self):
+        tree = SumTree(4)
+        priorities = np.array([1.0, 0.0, 3.0, 6.0])
+        tree.update(np.arange(4), priorities)
+        samples = tree.find(np.random.RandomState(12345).uniform(0.0, tree.total, size=(20000,)))
+        freq = np.bincount(samples, minlength=4) / 20000.0
+        self.assertTrue(np.allclose(freq, priorities / priorities.sum(), atol=0.02))
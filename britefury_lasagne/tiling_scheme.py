@@ -28,8 +28,9 @@ def padding_to_slice(p):
     return slice(start, stop)
 
 def crop_to_slice(c):
-    start = -c[0] if c[0] > 0 else None
-    stop = c[1] if c[1] > 0 else None
+    # Negative values are cropping; positive values are padding and are ignored
+    start = -c[0] if c[0] < 0 else None
+    stop = c[1] if c[1] < 0 else None
     return slice(start, stop)
 
 def _add_pad_or_crop(x, y):
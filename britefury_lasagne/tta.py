@@ -0,0 +1,230 @@
+"""
+Test-time augmentation
+
+Builds augmented variants of a mini-batch in one step, evaluates them as a single larger mini-batch
+and inverts and averages the predictions:
+
+>>> aug = tta.TestTimeAugmentation(hflip=True, rot90=True)
+>>> pred_prob = clf.predict(X, tta=aug)[0]
+
+Inputs with 4 dimensions `(sample, channel, height, width)` are augmented; other inputs are repeated for
+each variant. Outputs with 4 or more dimensions are treated as dense spatial predictions (e.g. from
+a `ClassifierObjective` with 2 spatial dimensions) and have the inverse geometric transform applied
+to their last two axes before averaging; other outputs are averaged as they are.
+"""
+import numpy as np
+
+
+CROPS_CENTRE = 'centre'
+CROPS_FIVE = 'five'
+
+
+def _apply_geometric(x, transform):
+    k, hflip, vflip = transform
+    if hflip:
+        x = x[..., ::-1]
+    if vflip:
+        x = x[..., ::-1, :]
+    if k != 0:
+        x = np.rot90(x, k, axes=(x.ndim - 2, x.ndim - 1))
+    return x
+
+
+def _invert_geometric(x, transform):
+    k, hflip, vflip = transform
+    if k != 0:
+        x = np.rot90(x, -k, axes=(x.ndim - 2, x.ndim - 1))
+    if vflip:
+        x = x[..., ::-1, :]
+    if hflip:
+        x = x[..., ::-1]
+    return x
+
+
+class TestTimeAugmentation (object):
+    """
+    Test-time augmentation using flips, 90 degree rotations and multiple crops.
+    """
+    # Prevent test runners from collecting this class as a test case
+    __test__ = False
+
+    def __init__(self, hflip=True, vflip=False, rot90=False, crop_size=None, crops=CROPS_FIVE):
+        """
+        :param hflip: (default=True) include horizontally flipped variants
+        :param vflip: (default=False) include vertically flipped variants
+        :param rot90: (default=False) include variants rotated by 90, 180 and 270 degrees; requires square inputs
+        :param crop_size: [optional] `(height, width)`; if given, each variant is evaluated on multiple crops
+            of this size. Multi-crop can only be used with networks whose outputs are not spatial.
+        :param crops: (default='five') the positions of the crops; `'five'` for the four corners and the centre,
+            `'centre'` for the centre only, or a list of `(y, x)` offsets
+        """
+        flips = [(False, False)]
+        if hflip:
+            flips.append((True, False))
+        if vflip:
+            flips.append((False, True))
+        if hflip and vflip:
+            flips.append((True, True))
+        rotations = [0, 1, 2, 3] if rot90 else [0]
+
+        # Remove duplicate transforms (e.g. a horizontal and vertical flip is a 180 degree rotation)
+        # by comparing their effect on a test pattern
+        pattern = np.arange(9).reshape((3, 3))
+        self.transforms = []
+        seen = set()
+        for k in rotations:
+            for h, v in flips:
+                transform = (k, h, v)
+                signature = tuple(_apply_geometric(pattern, transform).ravel())
+                if signature not in seen:
+                    seen.add(signature)
+                    self.transforms.append(transform)
+
+        self.rot90 = rot90
+        self.crop_size = tuple(crop_size) if crop_size is not None else None
+        self.crops = crops
+
+    def _crop_offsets(self, img_shape):
+        if self.crop_size is None:
+            return [None]
+        ch, cw = self.crop_size
+        h, w = img_shape
+        if ch > h or cw > w:
+            raise ValueError('crop_size {} is larger than the input {}'.format(self.crop_size, img_shape))
+        centre = ((h - ch) // 2, (w - cw) // 2)
+        if self.crops == CROPS_FIVE:
+            return [(0, 0), (0, w - cw), (h - ch, 0), (h - ch, w - cw), centre]
+        elif self.crops == CROPS_CENTRE:
+            return [centre]
+        else:
+            return [tuple(c) for c in self.crops]
+
+    def _image_shape(self, batch):
+        for x in batch:
+            if x.ndim == 4:
+                return x.shape[2:]
+        raise ValueError('Test-time augmentation requires at least one input of shape '
+                         '(sample, channel, height, width)')
+
+    def variants(self, img_shape):
+        """
+        Get the variants that will be generated for inputs with a spatial shape of `img_shape`
+
+        :param img_shape: the `(height, width)` of the spatial inputs
+        :return: a list of `(transform, crop_offset)` tuples
+        """
+        crop_offsets = self._crop_offsets(img_shape)
+        return [(t, c) for c in crop_offsets for t in self.transforms]
+
+    def augment_batch(self, batch):
+        """
+        Build the augmented variants of a mini-batch
+
+        :param batch: a list of input arrays
+        :return: a list of input arrays, each of which consists of the variants concatenated along
+            the sample axis
+        """
+        img_shape = self._image_shape(batch)
+        variants = self.variants(img_shape)
+        if self.rot90:
+            shape = self.crop_size if self.crop_size is not None else img_shape
+            if shape[0] != shape[1]:
+                raise ValueError('90 degree rotations require square inputs, not {}'.format(shape))
+
+        aug_batch = []
+        for x in batch:
+            if x.ndim == 4:
+                parts = []
+                for transform, crop in variants:
+                    if crop is not None:
+                        y0, x0 = crop
+                        x_v = x[:, :, y0:y0 + self.crop_size[0], x0:x0 + self.crop_size[1]]
+                    else:
+                        x_v = x
+                    parts.append(_apply_geometric(x_v, transform))
+                aug_batch.append(np.concatenate(parts, axis=0))
+            else:
+                aug_batch.append(np.concatenate([x] * len(variants), axis=0))
+        return aug_batch
+
+    def merge_predictions(self, predictions, batch):
+        """
+        Invert and average the predictions made for the variants built by `augment_batch`
+
+        :param predictions: a list of predicted outputs for the augmented mini-batch
+        :param batch: the original (un-augmented) mini-batch
+        :return: a list of predicted outputs for the original mini-batch
+        """
+        img_shape = self._image_shape(batch)
+        variants = self.variants(img_shape)
+        N = batch[0].shape[0]
+        merged = []
+        for pred in predictions:
+            spatial = pred.ndim >= 4
+            if spatial and self.crop_size is not None:
+                raise ValueError('Multi-crop test-time augmentation cannot be used with spatial outputs')
+            if np.issubdtype(pred.dtype, np.integer):
+                raise ValueError('Integer predictions (e.g. from a classifier in \'argmax\' or \'topk\' '
+                                 'prediction mode) cannot be averaged')
+            acc = None
+            for i, (transform, crop) in enumerate(variants):
+                p = pred[i * N:(i + 1) * N]
+                if spatial:
+                    p = _invert_geometric(p, transform)
+                acc = p.astype(np.float64) if acc is None else acc + p
+            merged.append((acc / float(len(variants))).astype(pred.dtype))
+        return merged
+
+    def wrap(self, predict_fn):
+        """
+        Wrap a mini-batch prediction function so that it applies test-time augmentation
+
+        :param predict_fn: a function of the form `fn(*batch_inputs) -> list of arrays`
+        :return: a function of the same form
+        """
+        def predict_batch(*batch):
+            batch = [np.asarray(x) for x in batch]
+            return self.merge_predictions(predict_fn(*self.augment_batch(batch)), batch)
+        return predict_batch
+
+
+import unittest
+
+class Test_TestTimeAugmentation (unittest.TestCase):
+    def test_transforms(self):
+        self.assertEqual(len(TestTimeAugmentation(hflip=True, vflip=True).transforms), 4)
+        self.assertEqual(len(TestTimeAugmentation(hflip=True, vflip=True, rot90=True).transforms), 8)
+        self.assertEqual(len(TestTimeAugmentation(hflip=False, rot90=True).transforms), 4)
+
+    def test_dense_identity(self):
+        # A dense prediction function that is equivariant to the transforms should give the same result
+        x = np.random.RandomState(12345).normal(size=(3, 2, 5, 5))
+        calls = []
+        def predict_fn(x):
+            calls.append(x.shape[0])
+            return [x * 2.0, x.sum(axis=(2, 3))]
+        aug = TestTimeAugmentation(hflip=True, vflip=True, rot90=True)
+        dense, summed = aug.wrap(predict_fn)(x)
+        self.assertEqual(calls, [24])
+        self.assertTrue(np.allclose(dense, x * 2.0))
+        self.assertTrue(np.allclose(summed, x.sum(axis=(2, 3))))
+
+    def test_dense_non_equivariant(self):
+        # Predict the row index of each pixel; un-inverted rotations would change it
+        x = np.zeros((2, 1, 4, 4))
+        def predict_fn(x):
+            return [np.broadcast_to(np.arange(4.0)[None, None, :, None], x.shape).copy()]
+        aug = TestTimeAugmentation(hflip=True, rot90=True)
+        dense, = aug.wrap(predict_fn)(x)
+        # Averaged over transforms that map rows to rows, reversed rows and columns
+        self.assertEqual(dense.shape, (2, 1, 4, 4))
+        self.assertTrue(np.allclose(dense, dense[:, :, ::-1, ::-1]))
+
+    def test_multi_crop(self):
+        x = np.arange(2 * 1 * 6 * 6, dtype=float).reshape((2, 1, 6, 6))
+        aug = TestTimeAugmentation(hflip=False, crop_size=(4, 4))
+        pred, = aug.wrap(lambda x: [x.mean(axis=(1, 2, 3))[:, None]])(x)
+        expected = np.mean([x[:, :, y:y + 4, xx:xx + 4].mean(axis=(1, 2, 3))
+                            for y, xx in [(0, 0), (0, 2), (2, 0), (2, 2), (1, 1)]], axis=0)
+        self.assertTrue(np.allclose(pred[:, 0], expected))
+        self.assertRaises(ValueError, aug.wrap(lambda x: [x]), x)
@@ -0,0 +1,165 @@
+"""
+Benchmark the `RegressorObjective` loss reductions
+
+Compares the current `dnn_objective.RegressorObjective` against the previous implementation (reproduced below
+as `BaselineRegressorObjective`), which reduced the training and evaluation squared error tensors separately
+for the training cost, the logged loss and the per-sample loss.
+
+For each objective a dense regression network is built and its training and evaluation functions compiled.
+The script reports:
+- graph size; the number of apply nodes in the optimised graph of each compiled function
+- step time; the mean time in milliseconds taken by a training step and an evaluation step
+
+Run from the root of the repository, with Theano and Lasagne installed:
+
+    python examples/regressor_objective_benchmark.py
+    python examples/regressor_objective_benchmark.py --mask
+    python examples/regressor_objective_benchmark.py --target_shape 8 64 64 --mask
+
+`--target_shape` gives the shape of each target sample; one dimension for a vector regression network,
+three (channels, height, width) for a dense per-pixel regression network. `--mask` adds a mask that is
+broadcast across channels.
+Set `THEANO_FLAGS=device=cuda,floatX=float32` to benchmark on a GPU. Results depend on the Theano version
+and device, so record them alongside those details.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+import numpy as np
+import theano
+import theano.tensor as T
+import lasagne
+
+from britefury_lasagne import dnn_objective
+
+
+class BaselineRegressorObjective (dnn_objective.RegressorObjective):
+    """
+    The `RegressorObjective.build` implementation prior to the restructured loss reductions
+    """
+    def __init__(self, name, objective_layer, target_expr, mask_expr=None, n_target_spatial_dims=0,
+                 cost_weight=1.0, nan_targets=False):
+        super(BaselineRegressorObjective, self).__init__(name, objective_layer, target_expr, mask_expr=mask_expr,
+                                                         cost_weight=cost_weight, nan_targets=nan_targets)
+        self.n_target_spatial_dims = n_target_spatial_dims
+
+    def build(self):
+        target_expr = self.target_expr
+        mask_expr = self.mask_expr
+        if self.nan_targets:
+            is_nan = T.isnan(target_expr)
+            target_expr = T.switch(is_nan, 0, target_expr)
+            valid = (1 - is_nan).astype(theano.config.floatX)
+            mask_expr = mask_expr * valid if mask_expr is not None else valid
+
+        train_pred = lasagne.layers.get_output(self.objective_layer)
+        train_loss = lasagne.objectives.squared_error(train_pred, target_expr)
+        if mask_expr is not None:
+            train_loss = train_loss * mask_expr
+
+        eval_pred = lasagne.layers.get_output(self.objective_layer, deterministic=True)
+        eval_loss = lasagne.objectives.squared_error(eval_pred, target_expr)
+        if mask_expr is not None:
+            eval_loss = eval_loss * mask_expr
+
+        if self.n_target_spatial_dims == 0:
+            train_loss_batch = train_loss.sum()
+            eval_loss_batch = eval_loss.sum()
+        else:
+            train_loss_batch = train_loss.mean(axis=tuple(range(2, 2 + self.n_target_spatial_dims))).sum()
+            eval_loss_batch = eval_loss.mean(axis=tuple(range(2, 2 + self.n_target_spatial_dims))).sum()
+
+        return dnn_objective.ObjectiveOutput(train_cost=train_loss.mean() * self.cost_weight,
+                                             train_results=[train_loss_batch],
+                                             train_results_str_fn=None,
+                                             eval_results=[eval_loss_batch],
+                                             eval_results_str_fn=None,
+                                             prediction=eval_pred,
+                                             train_sample_loss=train_loss.flatten(2).mean(axis=1))
+
+
+def build_network(input_var, input_size, target_shape, n_hidden):
+    """
+    Build a dense regression network; fully connected hidden layers followed by a fully connected output layer
+    reshaped to `target_shape`
+    """
+    net = lasagne.layers.InputLayer((None, input_size), input_var=input_var)
+    for i in range(2):
+        net = lasagne.layers.DenseLayer(net, n_hidden)
+        net = lasagne.layers.DropoutLayer(net, p=0.1)
+    net = lasagne.layers.DenseLayer(net, int(np.prod(target_shape)), nonlinearity=None)
+    if len(target_shape) > 1:
+        net = lasagne.layers.ReshapeLayer(net, ([0],) + tuple(target_shape))
+    return net
+
+
+def build_functions(objective_cls, input_size, target_shape, n_hidden, mask):
+    """
+    Compile training and evaluation functions for a network trained with `objective_cls`
+
+    :return: tuple `(train_fn, eval_fn)`
+    """
+    n_spatial = len(target_shape) - 1
+    tensor_type = T.TensorType(theano.config.floatX, (False,) * (len(target_shape) + 1))
+    input_var = T.matrix('x')
+    target_var = tensor_type('y')
+    mask_var = tensor_type('m') if mask else None
+    net = build_network(input_var, input_size, target_shape, n_hidden)
+    objective = objective_cls('y', net, target_var, mask_expr=mask_var, n_target_spatial_dims=n_spatial)
+    out = objective.build()
+
+    params = lasagne.layers.get_all_params(net, trainable=True)
+    updates = lasagne.updates.adam(out.train_cost, params)
+    inputs = [input_var, target_var] + ([mask_var] if mask else [])
+    train_fn = theano.function(inputs, [out.train_cost] + out.train_results + [out.train_sample_loss],
+                               updates=updates)
+    eval_fn = theano.function(inputs, out.eval_results)
+    return train_fn, eval_fn
+
+
+def time_fn(fn, args, n_steps):
+    # Warm up before timing
+    fn(*args)
+    t0 = time.time()
+    for i in range(n_steps):
+        fn(*args)
+    return (time.time() - t0) / n_steps * 1000.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark RegressorObjective loss reductions')
+    parser.add_argument('--input_size', type=int, default=256)
+    parser.add_argument('--target_shape', type=int, nargs='+', default=[64])
+    parser.add_argument('--n_hidden', type=int, default=512)
+    parser.add_argument('--batchsize', type=int, default=128)
+    parser.add_argument('--n_steps', type=int, default=200)
+    parser.add_argument('--mask', action='store_true', default=False)
+    args = parser.parse_args()
+
+    # The mask is broadcast across channels
+    mask_shape = (args.batchsize, 1) + tuple(args.target_shape[1:])
+    rng = np.random.RandomState(12345)
+    x = rng.normal(size=(args.batchsize, args.input_size)).astype(theano.config.floatX)
+    y = rng.normal(size=(args.batchsize,) + tuple(args.target_shape)).astype(theano.config.floatX)
+    data = [x, y]
+    if args.mask:
+        data.append((rng.uniform(size=mask_shape) > 0.25).astype(theano.config.floatX))
+
+    print('Theano {}, device={}, floatX={}'.format(theano.__version__, theano.config.device,
+                                                    theano.config.floatX))
+    print('input_size={}, target_shape={}, n_hidden={}, batchsize={}, mask={}'.format(
+        args.input_size, tuple(args.target_shape), args.n_hidden, args.batchsize, args.mask))
+    print('{:<10} {:>12} {:>11} {:>15} {:>14}'.format('objective', 'train nodes', 'eval nodes',
+                                                      'train step (ms)', 'eval step (ms)'))
+    for name, objective_cls in [('baseline', BaselineRegressorObjective),
+                                ('current', dnn_objective.RegressorObjective)]:
+        train_fn, eval_fn = build_functions(objective_cls, args.input_size, args.target_shape, args.n_hidden,
+                                            args.mask)
+        print('{:<10} {:>12} {:>11} {:>15.3f} {:>14.3f}'.format(
+            name, len(train_fn.maker.fgraph.apply_nodes), len(eval_fn.maker.fgraph.apply_nodes),
+            time_fn(train_fn, data, args.n_steps), time_fn(eval_fn, data, args.n_steps)))
+
+
+if __name__ == '__main__':
+    main()